@@ -0,0 +1,37 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:25
+
+from django.db import migrations, models
+
+
+def fill_paths(apps, schema_editor):
+    Category = apps.get_model('categories', 'Category')
+    parents = dict(Category.objects.values_list('id', 'parent_id'))
+
+    def path_of(category_id):
+        ids = []
+        # Stop on a cycle rather than loop forever
+        while category_id is not None and category_id not in ids:
+            ids.append(category_id)
+            category_id = parents.get(category_id)
+        return '/' + ''.join(f'{ancestor_id}/' for ancestor_id in reversed(ids))
+
+    categories = list(Category.objects.only('id'))
+    for category in categories:
+        category.path = path_of(category.id)
+    Category.objects.bulk_update(categories, ['path'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Ids from the root category down to this one', max_length=1024, verbose_name='Path'),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
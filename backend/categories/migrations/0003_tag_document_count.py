@@ -0,0 +1,36 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:27
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_documents(apps, schema_editor):
+    # One UPDATE filling every tag's count from the tag links
+    Tag = apps.get_model('categories', 'Tag')
+    DocumentTag = apps.get_model('documents', 'DocumentTag')
+    document_count = DocumentTag.objects.filter(
+        organization_id=OuterRef('organization_id'),
+        name=OuterRef('name'),
+        document__is_latest=True
+    ).exclude(document__status='deleted').order_by().values('name').annotate(
+        total=Count('id')
+    ).values('total')
+    Tag.objects.update(document_count=Coalesce(Subquery(document_count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0002_category_path'),
+        ('documents', '0026_documenttag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='document_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Document Count'),
+        ),
+        migrations.RunPython(count_documents, migrations.RunPython.noop),
+    ]
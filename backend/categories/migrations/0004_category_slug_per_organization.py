@@ -0,0 +1,22 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0003_tag_document_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='category',
+            name='slug',
+            field=models.SlugField(blank=True, max_length=255, verbose_name='Slug'),
+        ),
+        migrations.AddConstraint(
+            model_name='category',
+            constraint=models.UniqueConstraint(fields=('organization', 'slug'), name='unique_category_slug_per_organization'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:57
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils.text import slugify
+
+
+def separate_duplicate_slugs(apps, schema_editor):
+    # Renamed tags kept their old slug, so a new tag with the old name could
+    # share it; all but the oldest get a slug from their name and id
+    Tag = apps.get_model('categories', 'Tag')
+    duplicates = Tag.objects.order_by().values('organization_id', 'slug').annotate(
+        total=Count('id')
+    ).filter(total__gt=1)
+    for duplicate in duplicates:
+        tags = Tag.objects.filter(
+            organization_id=duplicate['organization_id'], slug=duplicate['slug']
+        ).order_by('id')
+        for tag in list(tags)[1:]:
+            slug = f"{(slugify(tag.name) or 'tag')[:90]}-{tag.id}"
+            Tag.objects.filter(pk=tag.pk).update(slug=slug)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0004_category_slug_per_organization'),
+    ]
+
+    operations = [
+        migrations.RunPython(separate_duplicate_slugs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='tag',
+            constraint=models.UniqueConstraint(fields=('organization', 'slug'), name='unique_tag_slug_per_organization'),
+        ),
+    ]
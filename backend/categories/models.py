@@ -1,6 +1,7 @@
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
 from django.utils.translation import gettext_lazy as _
-from django.utils.text import slugify
 
 class Category(models.Model):
     """
@@ -8,7 +9,7 @@ class Category(models.Model):
     """
     name = models.CharField(_("Name"), max_length=255)
     description = models.TextField(_("Description"), blank=True)
-    slug = models.SlugField(_("Slug"), max_length=255, unique=True, blank=True)
+    slug = models.SlugField(_("Slug"), max_length=255, blank=True)
     
     # Organization ownership
     organization = models.ForeignKey(
@@ -28,6 +29,16 @@ class Category(models.Model):
         blank=True
     )
     
+    # Materialized path: ids of the ancestors and the category itself, e.g. "/3/17/42/"
+    path = models.CharField(
+        _("Path"),
+        max_length=1024,
+        blank=True,
+        db_index=True,
+        editable=False,
+        help_text=_("Ids from the root category down to this one")
+    )
+    
     # Metadata
     created_at = models.DateTimeField(_("Created At"), auto_now_add=True)
     updated_at = models.DateTimeField(_("Updated At"), auto_now=True)
@@ -47,22 +58,53 @@ class Category(models.Model):
             models.Index(fields=['organization']),
             models.Index(fields=['parent']),
         ]
+        constraints = [
+            models.UniqueConstraint(fields=['organization', 'slug'], name='unique_category_slug_per_organization'),
+        ]
     
     def __str__(self):
         return self.name
     
+    def is_ancestor_of(self, category):
+        """Check whether a category is this one or lies in its subtree."""
+        return bool(self.path) and category is not None and category.path.startswith(self.path)
+    
     def save(self, *args, **kwargs):
-        # Generate slug if not provided
+        parent = Category.objects.filter(pk=self.parent_id).only('path').first() if self.parent_id else None
+        if self.is_ancestor_of(parent):
+            raise ValueError("A category cannot be moved into its own subtree.")
+        
+        # Generate slug if not provided, unique within the organization (see documents.slugs)
         if not self.slug:
-            self.slug = slugify(self.name)
-        super().save(*args, **kwargs)
+            from documents.slugs import save_with_slug
+            save_with_slug(self, self.name, super().save, *args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+        
+        # Keep the materialized path (and those of the subtree, on re-parent) up to date
+        old_path = self.path
+        new_path = f"{parent.path if parent else '/'}{self.pk}/"
+        if new_path != old_path:
+            Category.objects.filter(pk=self.pk).update(path=new_path)
+            if old_path:
+                Category.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                    path=Concat(Value(new_path), Substr('path', len(old_path) + 1))
+                )
+            self.path = new_path
+    
+    @property
+    def ancestor_ids(self):
+        """Ids of the categories from the root down to this one."""
+        return [int(part) for part in self.path.strip('/').split('/') if part]
     
     @property
     def full_path(self):
         """Return the full path of the category (including parent categories)."""
-        if self.parent:
-            return f"{self.parent.full_path} > {self.name}"
-        return self.name
+        ancestor_ids = self.ancestor_ids[:-1]
+        if not ancestor_ids:
+            return self.name
+        names = dict(Category.objects.filter(id__in=ancestor_ids).values_list('id', 'name'))
+        return ' > '.join([names[ancestor_id] for ancestor_id in ancestor_ids if ancestor_id in names] + [self.name])
     
     @property
     def document_count(self):
@@ -72,10 +114,11 @@ class Category(models.Model):
     @property
     def all_documents_count(self):
         """Return the number of documents in this category and all subcategories (excluding deleted ones and only counting latest versions)."""
-        count = self.documents.exclude(status='deleted').filter(is_latest=True).count()
-        for child in self.children.all():
-            count += child.all_documents_count
-        return count
+        from documents.models import TextDocument
+        return TextDocument.objects.filter(
+            category__path__startswith=self.path,
+            is_latest=True
+        ).exclude(status='deleted').count()
 
 
 class Tag(models.Model):
@@ -99,27 +142,45 @@ class Tag(models.Model):
     # Color for UI display
     color = models.CharField(_("Color"), max_length=20, blank=True, help_text=_("Color code (e.g., #FF5733)"))
     
+    # Latest, non-deleted documents with this tag, kept current by documents.tags
+    document_count = models.PositiveIntegerField(_("Document Count"), default=0, editable=False)
+    
     class Meta:
         verbose_name = _("Tag")
         verbose_name_plural = _("Tags")
         ordering = ['name']
         unique_together = [['organization', 'name']]
+        constraints = [
+            models.UniqueConstraint(fields=['organization', 'slug'], name='unique_tag_slug_per_organization'),
+        ]
     
     def __str__(self):
         return self.name
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored name so a rename also renames the slug
+        if 'name' in field_names:
+            instance._loaded_name = values[field_names.index('name')]
+        return instance
+    
     def save(self, *args, **kwargs):
-        # Generate slug if not provided
+        # A renamed tag gets the slug of its new name, leaving the old one free for a new tag
+        if self.slug and self.name != getattr(self, '_loaded_name', self.name):
+            self.slug = ''
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'slug'}
+        
+        # Documents may carry the tag before it is created (or renamed to)
+        from documents.tags import counted_tag_links
+        self.document_count = counted_tag_links(self.organization_id).filter(name=self.name).count()
+        
+        # Generate slug if not provided, unique within the organization (see documents.slugs)
         if not self.slug:
-            self.slug = slugify(self.name)
-        super().save(*args, **kwargs)
-    
-    @property
-    def document_count(self):
-        """Return the number of documents with this tag (excluding deleted ones and only counting latest versions)."""
-        from documents.models import TextDocument
-        return TextDocument.objects.filter(
-            organization=self.organization, 
-            tags__contains=[self.name],
-            is_latest=True
-        ).exclude(status='deleted').count()
+            from documents.slugs import save_with_slug
+            save_with_slug(self, self.name, super().save, *args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+        self._loaded_name = self.name
@@ -24,6 +24,12 @@ class CategorySerializer(serializers.ModelSerializer):
             return obj.documents_count
         # Fall back to the property
         return obj.document_count
+    
+    def validate_parent(self, value):
+        """Check that a category is not moved under itself or one of its subcategories."""
+        if self.instance is not None and self.instance.is_ancestor_of(value):
+            raise serializers.ValidationError("A category cannot be moved into its own subtree.")
+        return value
 
 
 class CategoryTreeSerializer(serializers.ModelSerializer):
@@ -31,7 +37,7 @@ class CategoryTreeSerializer(serializers.ModelSerializer):
     
     children = serializers.SerializerMethodField()
     document_count = serializers.SerializerMethodField(read_only=True)
-    all_documents_count = serializers.IntegerField(read_only=True)
+    all_documents_count = serializers.SerializerMethodField(read_only=True)
     
     class Meta:
         model = Category
@@ -48,10 +54,20 @@ class CategoryTreeSerializer(serializers.ModelSerializer):
         # Fall back to the property
         return obj.document_count
     
+    def get_all_documents_count(self, obj):
+        """Get the count including subcategories, as summed by the tree view or from the property."""
+        if hasattr(obj, 'subtree_documents_count'):
+            return obj.subtree_documents_count
+        return obj.all_documents_count
+    
     def get_children(self, obj):
-        """Get the children of the category."""
-        children = obj.children.all()
-        return CategoryTreeSerializer(children, many=True).data
+        """Get the children of the category, from the tree built by the view when there is one."""
+        children_by_parent = self.context.get('children')
+        if children_by_parent is not None:
+            children = children_by_parent.get(obj.id, [])
+        else:
+            children = obj.children.all()
+        return CategoryTreeSerializer(children, many=True, context=self.context).data
 
 
 class CategoryListSerializer(serializers.ModelSerializer):
@@ -0,0 +1,31 @@
+from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Category
+from .tree import invalidate_category_tree
+
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender='documents.TextDocument')
+def invalidate_category_tree_cache(sender, instance, signal, **kwargs):
+    """
+    Categories and documents both shape the tree (documents through its counts,
+    so only saves that move a document between counts matter).
+    Wait for the commit so no process can cache the old rows under the new version.
+    """
+    if signal is post_save and sender is not Category and not getattr(instance, 'category_counts_changed', True):
+        return
+    organization_id = instance.organization_id
+    transaction.on_commit(lambda: invalidate_category_tree(organization_id))
+
+
+@receiver(post_delete, sender=Category)
+def detach_subtree_paths(sender, instance, **kwargs):
+    """Children of a deleted category become roots, so their subtree paths lose its prefix."""
+    if instance.path:
+        Category.objects.filter(path__startswith=instance.path).update(
+            path=Concat(Value('/'), Substr('path', len(instance.path) + 1))
+        )
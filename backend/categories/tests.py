@@ -0,0 +1,275 @@
+from unittest import mock
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from rest_framework.test import APIClient
+from rest_framework import status
+from accounts.models import Organization
+from documents.models import BackgroundJob, TextDocument
+from documents.tags import rewrite_tag_names
+from documents.tasks import run_tag_rewrite_job
+from .models import Category, Tag
+
+User = get_user_model()
+
+
+class CategoryTestMixin:
+    """Shared fixtures for category and tag tests."""
+
+    def setUp(self):
+        # The cached category tree is keyed by ids that the next test's rows can reuse
+        cache.clear()
+        self.client = APIClient()
+        self.organization = Organization.objects.create(
+            name='Test Organization',
+            subscription_plan='basic'
+        )
+        self.user = User.objects.create_user(
+            username='writer',
+            email='writer@example.com',
+            password='writerpass123',
+            organization=self.organization,
+            role='admin'
+        )
+        self.client.force_authenticate(user=self.user)
+
+
+class CategoryTreeTests(CategoryTestMixin, TestCase):
+    """Test materialized category paths and the cached category tree."""
+
+    def setUp(self):
+        super().setUp()
+        self.root = Category.objects.create(name='Root', organization=self.organization)
+        self.middle = Category.objects.create(name='Middle', organization=self.organization, parent=self.root)
+        self.leaf = Category.objects.create(name='Leaf', organization=self.organization, parent=self.middle)
+
+    def add_document(self, category):
+        with self.captureOnCommitCallbacks(execute=True):
+            return TextDocument.objects.create(
+                title='Document', content='<p>Text.</p>', created_by=self.user,
+                organization=self.organization, category=category
+            )
+
+    def test_paths_follow_moves_and_deletes(self):
+        """Test that moving or deleting a category updates the paths of its subtree."""
+        self.assertEqual(self.leaf.path, f'/{self.root.id}/{self.middle.id}/{self.leaf.id}/')
+        self.assertEqual(self.leaf.full_path, 'Root > Middle > Leaf')
+
+        self.middle.parent = None
+        self.middle.save()
+        self.leaf.refresh_from_db()
+        self.assertEqual(self.leaf.path, f'/{self.middle.id}/{self.leaf.id}/')
+
+        self.middle.delete()
+        self.leaf.refresh_from_db()
+        self.assertEqual(self.leaf.path, f'/{self.leaf.id}/')
+
+    def test_slugs_are_unique_per_organization(self):
+        """Test that category slugs only have to be unique within an organization."""
+        other = Organization.objects.create(name='Other Organization', subscription_plan='basic')
+        self.assertEqual(Category.objects.create(name='Root', organization=other).slug, 'root')
+
+        self.leaf.name = 'Leaf 2'
+        self.leaf.save()
+        duplicate = Category.objects.create(name='Leaf', organization=self.organization)
+        self.assertRegex(duplicate.slug, r'^leaf-[a-z0-9]{4}$')
+
+    def test_category_cannot_move_into_its_subtree(self):
+        """Test that re-parenting a category under its own descendant is rejected."""
+        response = self.client.patch(
+            f'/api/v1/categories/{self.root.slug}', {'parent': self.leaf.id}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.root.parent = self.leaf
+        with self.assertRaises(ValueError):
+            self.root.save()
+
+    def test_tree_is_cached_until_documents_change(self):
+        """Test that the tree is served from the cache and rebuilt after a document is added."""
+        self.add_document(self.leaf)
+        response = self.client.get('/api/v1/categories/tree')
+        self.assertEqual(response.data[0]['all_documents_count'], 1)
+
+        with self.assertNumQueries(0):
+            self.client.get('/api/v1/categories/tree')
+
+        self.add_document(self.middle)
+        response = self.client.get('/api/v1/categories/tree')
+        [root] = response.data
+        self.assertEqual(root['all_documents_count'], 2)
+        self.assertEqual(root['children'][0]['document_count'], 1)
+        self.assertEqual(root['children'][0]['children'][0]['name'], 'Leaf')
+
+    def test_content_edits_keep_the_cached_tree(self):
+        """Test that only saves changing a document's category, status or latest flag rebuild the tree."""
+        document = self.add_document(self.leaf)
+        self.client.get('/api/v1/categories/tree')
+
+        document = TextDocument.objects.get(pk=document.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            document.content = '<p>Edited text.</p>'
+            document.save()
+        with self.assertNumQueries(0):
+            self.client.get('/api/v1/categories/tree')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            document.status = 'deleted'
+            document.save()
+        response = self.client.get('/api/v1/categories/tree')
+        self.assertEqual(response.data[0]['all_documents_count'], 0)
+
+
+class TagCountTests(CategoryTestMixin, TestCase):
+    """Test tag links and the stored tag document counts."""
+
+    def setUp(self):
+        super().setUp()
+        self.news = Tag.objects.create(name='news', organization=self.organization)
+        self.draft = Tag.objects.create(name='draft', organization=self.organization)
+
+    def add_document(self, tags):
+        return TextDocument.objects.create(
+            title='Document', content='<p>Text.</p>', created_by=self.user,
+            organization=self.organization, tags=tags
+        )
+
+    def assertCounts(self, news, draft):
+        self.news.refresh_from_db()
+        self.draft.refresh_from_db()
+        self.assertEqual((self.news.document_count, self.draft.document_count), (news, draft))
+
+    def test_counts_follow_document_changes(self):
+        """Test that tag counts are kept current as documents are tagged, versioned and deleted."""
+        first = self.add_document(['news', 'draft'])
+        second = self.add_document(['news'])
+        self.assertCounts(2, 1)
+
+        first.tags = ['news']
+        first.save()
+        self.assertCounts(2, 0)
+
+        second.create_new_version()
+        self.assertCounts(2, 0)
+
+        second.status = 'deleted'
+        second.save()
+        self.assertCounts(1, 0)
+
+        first.delete()
+        self.assertCounts(0, 0)
+
+    def test_tag_created_after_documents_is_counted(self):
+        """Test that a new tag starts with the number of documents already carrying it."""
+        self.add_document(['later'])
+        tag = Tag.objects.create(name='later', organization=self.organization)
+        self.assertEqual(tag.document_count, 1)
+
+    def test_document_list_filters_by_tag_links(self):
+        """Test that ?tags= returns only documents with every given tag."""
+        both = self.add_document(['news', 'draft'])
+        self.add_document(['news'])
+
+        response = self.client.get('/api/v1/documents', {'tags': 'news,draft'})
+        self.assertEqual([document['id'] for document in response.data['results']], [both.id])
+
+        response = self.client.get(f'/api/v1/tags/{self.news.slug}/documents')
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_tag_list_reads_stored_counts(self):
+        """Test that the tag list serves stored counts without counting documents."""
+        self.add_document(['news'])
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/tags')
+        counts = {tag['name']: tag['document_count'] for tag in response.data['results']}
+        self.assertEqual(counts, {'news': 1, 'draft': 0})
+
+
+class TagRewriteTests(CategoryTestMixin, TestCase):
+    """Test renaming and merging tags across documents."""
+
+    def setUp(self):
+        super().setUp()
+        self.news = Tag.objects.create(name='news', organization=self.organization)
+        self.breaking = Tag.objects.create(name='breaking', organization=self.organization)
+        self.documents = [
+            TextDocument.objects.create(
+                title=f'Story {number}', content='<p>Text.</p>', created_by=self.user,
+                organization=self.organization, tags=tags
+            )
+            for number, tags in enumerate([['breaking', 'news', 'local'], ['breaking'], ['local']])
+        ]
+
+    def stored_tags(self):
+        return [document.tags for document in TextDocument.objects.filter(organization=self.organization).order_by('id')]
+
+    def test_rename_rewrites_every_version(self):
+        """Test that renaming a tag rewrites documents and their older versions."""
+        self.documents[1].create_new_version()
+
+        response = self.client.post(f'/api/v1/tags/{self.news.slug}/rename', {'name': 'updates'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['status'], response.data['total'], response.data['processed']), ('done', 1, 1))
+        self.assertEqual(self.stored_tags(), [['breaking', 'updates', 'local'], ['breaking'], ['local'], ['breaking']])
+        self.news.refresh_from_db()
+        self.assertEqual((self.news.name, self.news.document_count), ('updates', 1))
+
+        response = self.client.post(f'/api/v1/tags/{self.news.slug}/rename', {'name': 'breaking'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_renamed_tag_gets_a_new_slug(self):
+        """Test that a renamed tag leaves its old slug to a new tag of the old name."""
+        self.client.post(f'/api/v1/tags/{self.news.slug}/rename', {'name': 'updates'}, format='json')
+        self.news.refresh_from_db()
+        self.assertEqual(self.news.slug, 'updates')
+
+        response = self.client.patch(f'/api/v1/tags/{self.breaking.slug}', {'name': 'Urgent'}, format='json')
+        self.assertEqual(response.data['slug'], 'urgent')
+
+        self.assertEqual(Tag.objects.create(name='news', organization=self.organization).slug, 'news')
+        self.assertEqual(self.client.get('/api/v1/tags/news').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/api/v1/tags/updates').data['name'], 'updates')
+
+    def test_merge_removes_duplicates(self):
+        """Test that merging replaces the tag on documents without repeating the target."""
+        response = self.client.post(f'/api/v1/tags/{self.breaking.slug}/merge', {'into': self.news.slug}, format='json')
+        self.assertEqual(response.data['job_type'], 'tag_merge')
+        self.assertEqual(self.stored_tags(), [['news', 'local'], ['news'], ['local']])
+        self.assertFalse(Tag.objects.filter(name='breaking').exists())
+        self.news.refresh_from_db()
+        self.assertEqual(self.news.document_count, 2)
+
+    def test_merged_tag_is_kept_until_the_job_succeeds(self):
+        """Test that a merge deletes its tag only once every document has been rewritten."""
+        url = f'/api/v1/tags/{self.breaking.slug}/merge'
+        with mock.patch('documents.tags.TAG_REWRITE_INLINE_LIMIT', 1), \
+                mock.patch('documents.tasks.run_tag_rewrite_job.delay'):
+            response = self.client.post(url, {'into': self.news.slug}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertTrue(Tag.objects.filter(pk=self.breaking.pk).exists())
+
+        with mock.patch('documents.tags.rewrite_tag_names', side_effect=RuntimeError('database went away')):
+            run_tag_rewrite_job(str(response.data['uuid']))
+        self.assertEqual(BackgroundJob.objects.get(uuid=response.data['uuid']).status, 'failed')
+        self.assertTrue(Tag.objects.filter(pk=self.breaking.pk).exists())
+
+        response = self.client.post(url, {'into': self.news.slug}, format='json')
+        self.assertEqual(response.data['status'], 'done')
+        self.assertFalse(Tag.objects.filter(pk=self.breaking.pk).exists())
+
+    def test_large_rewrites_run_in_the_background(self):
+        """Test that rewrites over the inline limit are queued as a job."""
+        with mock.patch('documents.tags.TAG_REWRITE_INLINE_LIMIT', 1), \
+                mock.patch('documents.tasks.run_tag_rewrite_job.delay') as delay:
+            response = self.client.post(f'/api/v1/tags/{self.breaking.slug}/rename', {'name': 'urgent'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = BackgroundJob.objects.get(uuid=response.data['uuid'])
+        delay.assert_called_once_with(str(job.uuid))
+        self.assertEqual((job.status, job.total), ('queued', 2))
+
+    def test_rewrite_reports_progress_per_chunk(self):
+        """Test that documents are rewritten in chunks with progress after each."""
+        progress = []
+        done = rewrite_tag_names(self.organization.id, ['breaking', 'local'], 'news', progress.append, chunk_size=2)
+        self.assertEqual((done, progress), (3, [2, 3]))
+        self.assertEqual(self.stored_tags(), [['news'], ['news'], ['news']])
@@ -0,0 +1,82 @@
+"""
+Category tree building and caching.
+
+Each category stores a materialized path of its ancestors' ids (see
+Category.path), so subtrees and ancestors are found with one query. The
+serialized tree is cached per organization under a version stamp; saving or
+deleting a category or document bumps the stamp (see categories.signals), so
+stale trees are never read and simply expire.
+"""
+
+import uuid
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+TREE_CACHE_TIMEOUT = 60 * 60
+
+
+def tree_version_key(organization_id):
+    return f"categories:tree_version:{organization_id}"
+
+
+def tree_version(organization_id):
+    """Return the organization's tree version stamp, creating it if needed."""
+    key = tree_version_key(organization_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_category_tree(organization_id):
+    """Make every process rebuild the organization's category tree on its next read."""
+    cache.set(tree_version_key(organization_id), uuid.uuid4().hex, timeout=None)
+
+
+def annotate_document_counts(queryset):
+    """Annotate categories with their number of latest, non-deleted documents."""
+    return queryset.annotate(
+        documents_count=Count('documents', filter=~Q(documents__status='deleted') & Q(documents__is_latest=True))
+    )
+
+
+def build_category_tree(categories):
+    """
+    Link a list of categories (annotated with documents_count) into a tree.
+    Sets subtree_documents_count on every category and returns the roots and
+    a parent id -> children mapping.
+    """
+    children = defaultdict(list)
+    by_id = {category.id: category for category in categories}
+    for category in categories:
+        category.subtree_documents_count = category.documents_count
+        # A parent outside the list makes the category a root of what was loaded
+        parent_id = category.parent_id if category.parent_id in by_id else None
+        children[parent_id].append(category)
+
+    # Deepest categories first, so each subtree total is complete before it is added to its parent
+    for category in sorted(categories, key=lambda category: category.path.count('/'), reverse=True):
+        if category.parent_id in by_id:
+            by_id[category.parent_id].subtree_documents_count += category.subtree_documents_count
+
+    return children[None], children
+
+
+def get_category_tree(organization_id, serialize):
+    """
+    Return the organization's serialized category tree from the cache, or
+    build it with one query and `serialize(roots, children)` and cache it.
+    """
+    from .models import Category
+
+    key = f"categories:tree:{organization_id}:{tree_version(organization_id)}"
+    tree = cache.get(key)
+    if tree is None:
+        categories = list(annotate_document_counts(Category.objects.filter(organization_id=organization_id)))
+        roots, children = build_category_tree(categories)
+        tree = serialize(roots, children)
+        cache.set(key, tree, TREE_CACHE_TIMEOUT)
+    return tree
@@ -1,7 +1,6 @@
 from rest_framework import viewsets, permissions, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from django.db.models import Count, Q, F
 
 from .models import Category, Tag
 from .serializers import (
@@ -11,6 +10,7 @@ from .serializers import (
     TagSerializer,
     TagListSerializer,
 )
+from .tree import annotate_document_counts, get_category_tree
 from accounts.permissions import IsSameOrganization
 
 class CategoryViewSet(viewsets.ModelViewSet):
@@ -40,9 +40,7 @@ class CategoryViewSet(viewsets.ModelViewSet):
         
         # Annotate with document count (using a different name to avoid conflict with property)
         # Exclude deleted documents and only count latest versions
-        queryset = queryset.annotate(
-            documents_count=Count('documents', filter=~Q(documents__status='deleted') & Q(documents__is_latest=True))
-        )
+        queryset = annotate_document_counts(queryset)
         
         return queryset
     
@@ -60,18 +58,11 @@ class CategoryViewSet(viewsets.ModelViewSet):
     
     @action(detail=False, methods=['get'])
     def tree(self, request):
-        """Return a tree structure of categories."""
-        # Get only root categories (no parent)
-        root_categories = self.get_queryset().filter(parent__isnull=True)
-        
-        # Annotate with document count (using a different name to avoid conflict with property)
-        # Exclude deleted documents and only count latest versions
-        root_categories = root_categories.annotate(
-            documents_count=Count('documents', filter=~Q(documents__status='deleted') & Q(documents__is_latest=True))
-        )
+        """Return a tree structure of categories (cached per organization, see categories.tree)."""
+        def serialize(root_categories, children):
+            return CategoryTreeSerializer(root_categories, many=True, context={'children': children}).data
         
-        serializer = CategoryTreeSerializer(root_categories, many=True)
-        return Response(serializer.data)
+        return Response(get_category_tree(request.user.organization_id, serialize))
     
     @action(detail=True, methods=['get'])
     def documents(self, request, slug=None):
@@ -80,6 +71,7 @@ class CategoryViewSet(viewsets.ModelViewSet):
         
         # Import here to avoid circular imports
         from documents.models import TextDocument
+        from documents.pagination import paginate_documents
         from documents.serializers import TextDocumentListSerializer
         
         # Get documents in this category
@@ -101,8 +93,7 @@ class CategoryViewSet(viewsets.ModelViewSet):
         if latest_only:
             documents = documents.filter(is_latest=True)
         
-        serializer = TextDocumentListSerializer(documents, many=True)
-        return Response(serializer.data)
+        return paginate_documents(request, documents, TextDocumentListSerializer)
 
 
 class TagViewSet(viewsets.ModelViewSet):
@@ -122,16 +113,7 @@ class TagViewSet(viewsets.ModelViewSet):
         # Base queryset - tags from user's organization
         queryset = Tag.objects.filter(organization=user.organization)
         
-        # Annotate with document count (excluding deleted documents and only counting latest versions)
-        queryset = queryset.annotate(
-            document_count=Count(
-                'organization__documents',
-                filter=Q(
-                    organization__documents__tags__contains=[F('name')]
-                ) & ~Q(organization__documents__status='deleted') & Q(organization__documents__is_latest=True)
-            )
-        )
-        
+        # document_count is stored on the tag and kept current by documents.tags
         return queryset
     
     def get_serializer_class(self):
@@ -144,6 +126,82 @@ class TagViewSet(viewsets.ModelViewSet):
         """Create a new tag."""
         serializer.save(organization=self.request.user.organization)
     
+    def perform_update(self, serializer):
+        """Update a tag, carrying a new name over to the documents that use it."""
+        previous_name = serializer.instance.name
+        tag = serializer.save()
+        if tag.name != previous_name:
+            self._rewrite_documents('tag_rename', [previous_name], tag.name)
+    
+    def _rewrite_documents(self, job_type, sources, target):
+        """Rename tags on the organization's documents (see documents.tags) and return the job response."""
+        from documents.serializers import BackgroundJobSerializer
+        from documents.tags import start_tag_rewrite
+        
+        job = start_tag_rewrite(self.request.user.organization, self.request.user, job_type, sources, target)
+        response_status = status.HTTP_202_ACCEPTED if job.status in ('queued', 'running') else status.HTTP_200_OK
+        return Response(BackgroundJobSerializer(job).data, status=response_status)
+    
+    @action(detail=True, methods=['post'])
+    def rename(self, request, slug=None):
+        """
+        Rename a tag and every use of it in the organization's documents.
+        Returns the BackgroundJob doing the rewrite; large ones finish in the background.
+        """
+        tag = self.get_object()
+        name = request.data.get('name')
+        
+        if not isinstance(name, str) or not name.strip():
+            return Response(
+                {"detail": "No tag name provided."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        name = name.strip()
+        
+        if name == tag.name:
+            return Response(
+                {"detail": "The tag already has this name."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if Tag.objects.filter(organization=request.user.organization, name=name).exists():
+            return Response(
+                {"detail": "A tag with this name already exists. Merge the tags instead."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        previous_name = tag.name
+        tag.name = name
+        tag.save()
+        return self._rewrite_documents('tag_rename', [previous_name], name)
+    
+    @action(detail=True, methods=['post'])
+    def merge(self, request, slug=None):
+        """
+        Merge this tag into another one (given by slug in `into`): documents
+        get the other tag instead and this tag is deleted once the job has
+        rewritten them all. Returns the BackgroundJob.
+        """
+        tag = self.get_object()
+        target = Tag.objects.filter(
+            organization=request.user.organization,
+            slug=request.data.get('into')
+        ).first()
+        
+        if target is None:
+            return Response(
+                {"detail": "Tag to merge into not found."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if target.id == tag.id:
+            return Response(
+                {"detail": "A tag cannot be merged into itself."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        return self._rewrite_documents('tag_merge', [tag.name], target.name)
+    
     @action(detail=True, methods=['get'])
     def documents(self, request, slug=None):
         """Return documents with this tag."""
@@ -151,12 +209,14 @@ class TagViewSet(viewsets.ModelViewSet):
         
         # Import here to avoid circular imports
         from documents.models import TextDocument
+        from documents.pagination import paginate_documents
+        from documents.tags import filter_by_tags
         from documents.serializers import TextDocumentListSerializer
         
         # Get documents with this tag
-        documents = TextDocument.objects.filter(
-            organization=request.user.organization,
-            tags__contains=[tag.name]
+        documents = filter_by_tags(
+            TextDocument.objects.filter(organization=request.user.organization),
+            [tag.name]
         )
         
         # Apply filters
@@ -172,5 +232,4 @@ class TagViewSet(viewsets.ModelViewSet):
         if latest_only:
             documents = documents.filter(is_latest=True)
         
-        serializer = TextDocumentListSerializer(documents, many=True)
-        return Response(serializer.data)
+        return paginate_documents(request, documents, TextDocumentListSerializer)
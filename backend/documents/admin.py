@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.utils.translation import gettext_lazy as _
-from .models import TextDocument, Comment, DocumentPDFExport, AIPromptTemplate, AIModelSettings, DocumentLengthSettings, StyleConstraint
+from .models import TextDocument, Comment, DocumentPDFExport, AIPromptTemplate, AIModelSettings, DocumentLengthSettings, StyleConstraint, BackgroundJob
 
 @admin.register(TextDocument)
 class TextDocumentAdmin(admin.ModelAdmin):
@@ -95,6 +95,10 @@ class AIModelSettingsAdmin(admin.ModelAdmin):
         (None, {
             'fields': ('model_name', 'max_tokens')
         }),
+        (_('Prompt Budget'), {
+            'fields': ('context_window', 'reference_token_budget'),
+            'description': _('Reference documents are packed into the reference budget, capped so the prompt and completion fit in the context window.')
+        }),
         (_('Temperature Settings'), {
             'fields': ('temperature', 'analysis_temperature'),
             'description': _('Control the creativity level separately for document generation and style analysis.')
@@ -133,7 +137,7 @@ class StyleConstraintAdmin(admin.ModelAdmin):
     list_display = ('name', 'organization', 'created_by', 'is_active', 'updated_at')
     list_filter = ('is_active', 'organization', 'created_at')
     search_fields = ('name', 'description', 'constraints')
-    readonly_fields = ('created_at', 'updated_at')
+    readonly_fields = ('analysis_key', 'created_at', 'updated_at')
     filter_horizontal = ('reference_documents',)
     fieldsets = (
         (None, {
@@ -144,10 +148,18 @@ class StyleConstraintAdmin(admin.ModelAdmin):
             'description': _('JSON object containing condensed style instructions for document generation.')
         }),
         (_('Organization & References'), {
-            'fields': ('organization', 'created_by', 'reference_documents'),
+            'fields': ('organization', 'created_by', 'reference_documents', 'analysis_key'),
             'description': _('Organization and reference documents used to create this style constraint.')
         }),
         (_('Timestamps'), {
             'fields': ('created_at', 'updated_at')
         }),
     )
+
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ('uuid', 'job_type', 'status', 'organization', 'created_by', 'created_at', 'finished_at')
+    list_filter = ('job_type', 'status', 'created_at')
+    search_fields = ('uuid', 'created_by__username', 'organization__name')
+    readonly_fields = ('uuid', 'created_at', 'started_at', 'finished_at')
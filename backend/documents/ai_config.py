@@ -0,0 +1,150 @@
+"""
+Process-wide cache for AI configuration.
+
+Prompt templates, model settings and document length settings change rarely
+but are read several times per generation. Each worker process keeps a
+snapshot per organization; a version stamp in the shared Django cache is
+bumped whenever any of those rows is saved or deleted (see documents.signals),
+so every worker drops its snapshots on the next read. Snapshots are also
+reloaded after SNAPSHOT_TTL seconds, which bounds how stale a process can get
+if an invalidation is missed.
+"""
+
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db.models import Q
+
+VERSION_KEY = 'documents:ai_config:version'
+
+# How long a process trusts its last version check before asking the shared cache again
+VERSION_CHECK_INTERVAL = 2  # seconds
+
+# How long a process keeps a snapshot at most, invalidated or not
+SNAPSHOT_TTL = 60  # seconds
+
+# Default model and temperature values - used when no AIModelSettings row exists
+DEFAULT_MODEL = "gpt-3.5-turbo-0125"
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_MAX_TOKENS = 4000
+DEFAULT_CONTEXT_WINDOW = 16385
+DEFAULT_REFERENCE_TOKEN_BUDGET = 3000
+
+# organization id (None for global-only) -> (load time, snapshot)
+_snapshots = {}
+_version = {'value': None, 'checked_at': 0.0}
+
+
+def _shared_version():
+    """Return the current shared version stamp, creating it if needed."""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def _check_version():
+    """Drop local snapshots if another process has invalidated the config."""
+    now = time.monotonic()
+    if now - _version['checked_at'] < VERSION_CHECK_INTERVAL and _version['value'] is not None:
+        return
+
+    version = _shared_version()
+    if version != _version['value']:
+        _snapshots.clear()
+        _version['value'] = version
+    _version['checked_at'] = now
+
+
+def invalidate_ai_config():
+    """Invalidate cached AI configuration in this and every other process."""
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+    _snapshots.clear()
+    _version['value'] = None
+
+
+def _load_model_settings():
+    """Load the default model settings, mirroring the admin's is_default rules."""
+    from .models import AIModelSettings
+
+    model_settings = AIModelSettings.objects.filter(is_active=True).order_by('-is_default', 'id').first()
+    if model_settings:
+        return {
+            'model': model_settings.model_name,
+            'temperature': model_settings.temperature,
+            'analysis_temperature': model_settings.analysis_temperature,
+            'max_tokens': model_settings.max_tokens,
+            'context_window': model_settings.context_window,
+            'reference_token_budget': model_settings.reference_token_budget
+        }
+
+    return {
+        'model': DEFAULT_MODEL,
+        'temperature': DEFAULT_TEMPERATURE,
+        'analysis_temperature': DEFAULT_TEMPERATURE,  # Use same default for analysis
+        'max_tokens': DEFAULT_MAX_TOKENS,
+        'context_window': DEFAULT_CONTEXT_WINDOW,
+        'reference_token_budget': DEFAULT_REFERENCE_TOKEN_BUDGET
+    }
+
+
+def _load_snapshot(organization_id):
+    """Read all AI configuration for an organization in three queries."""
+    from .models import AIPromptTemplate, DocumentLengthSettings
+
+    org_filter = Q(organization__isnull=True)
+    if organization_id is not None:
+        org_filter |= Q(organization_id=organization_id)
+
+    # Organization templates win over global ones; within each, keep the
+    # first by the model's default ordering (template_type, name)
+    org_templates = {}
+    global_templates = {}
+    templates = AIPromptTemplate.objects.filter(org_filter, is_active=True).order_by('template_type', 'name', 'id')
+    for template_type, content, org_id in templates.values_list('template_type', 'content', 'organization_id'):
+        target = global_templates if org_id is None else org_templates
+        target.setdefault(template_type, content)
+
+    org_lengths = {}
+    global_lengths = {}
+    lengths = DocumentLengthSettings.objects.filter(org_filter, is_active=True)
+    for length_name, description, target_tokens, org_id in lengths.values_list(
+        'length_name', 'description', 'target_tokens', 'organization_id'
+    ):
+        target = global_lengths if org_id is None else org_lengths
+        target[length_name] = {'description': description, 'target_tokens': target_tokens}
+
+    return {
+        'templates': {**global_templates, **org_templates},
+        'lengths': {**global_lengths, **org_lengths},
+        'model_settings': _load_model_settings(),
+    }
+
+
+def get_ai_config(organization=None):
+    """Return the cached configuration snapshot for an organization."""
+    _check_version()
+    organization_id = organization.pk if organization is not None else None
+    now = time.monotonic()
+    loaded_at, snapshot = _snapshots.get(organization_id, (None, None))
+    if snapshot is None or now - loaded_at >= SNAPSHOT_TTL:
+        snapshot = _load_snapshot(organization_id)
+        _snapshots[organization_id] = (now, snapshot)
+    return snapshot
+
+
+def get_prompt_template(template_type, organization=None):
+    """Return the template content for a type, or None if there is none."""
+    return get_ai_config(organization)['templates'].get(template_type)
+
+
+def get_length_setting(length_name, organization=None):
+    """Return {'description', 'target_tokens'} for a document length, or None."""
+    return get_ai_config(organization)['lengths'].get(length_name)
+
+
+def get_model_settings():
+    """Return a copy of the default model settings."""
+    return dict(get_ai_config()['model_settings'])
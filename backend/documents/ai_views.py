@@ -1,118 +1,73 @@
 from rest_framework import status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from django.views.decorators.csrf import csrf_exempt
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.core.cache import cache
 from rest_framework.response import Response
 from openai import OpenAI
 import json
 import re
 import random
-import tiktoken
 import html
-
-from .models import TextDocument, AIPromptTemplate, AIModelSettings, DocumentLengthSettings, StyleConstraint
-from .serializers import TextDocumentDetailSerializer
+import hashlib
+
+from .models import TextDocument, AIPromptTemplate, StyleConstraint, BackgroundJob
+from .ai_config import (
+    DEFAULT_MODEL, DEFAULT_TEMPERATURE, DEFAULT_MAX_TOKENS, DEFAULT_CONTEXT_WINDOW, DEFAULT_REFERENCE_TOKEN_BUDGET,
+    get_model_settings, get_length_setting
+)
+from .references import MAX_CANDIDATE_DOCUMENTS, pack_references, reference_token_budget, select_reference_documents
+from .similarity import select_relevant_documents
+from . import tokens
+from .content import extract_plain_text
+from .serializers import TextDocumentDetailSerializer, BackgroundJobSerializer
+from .tasks import run_ai_generation_job
 from accounts.permissions import IsSameOrganization
 
-# Constants for document processing
-MAX_REFERENCE_DOCS = 3  # Default number of reference documents
-MAX_CHARS_PER_DOC = 600  # Default characters per document
-MAX_TOTAL_TOKENS = 3000 
-# Default model and temperature values - will be overridden by database settings if available
-DEFAULT_MODEL = "gpt-3.5-turbo-0125"  # Default model if no settings found
-DEFAULT_TEMPERATURE = 0.7             # Default temperature if no settings found
-
 # Function to get the default model settings from database
 def get_default_model_settings():
-    """Get the default model settings from the database"""
-    from .models import AIModelSettings
+    """Get the default model settings (cached per process, see ai_config)"""
     try:
-        # Try to get the default model settings
-        model_settings = AIModelSettings.objects.filter(is_default=True, is_active=True).first()
-        
-        # If no default is set, get any active model
-        if not model_settings:
-            model_settings = AIModelSettings.objects.filter(is_active=True).first()
-            
-        if model_settings:
-            return {
-                'model': model_settings.model_name,
-                'temperature': model_settings.temperature,
-                'analysis_temperature': model_settings.analysis_temperature,
-                'max_tokens': model_settings.max_tokens
-            }
-        
-        # If no settings found, return defaults
-        return {
-            'model': DEFAULT_MODEL,
-            'temperature': DEFAULT_TEMPERATURE,
-            'analysis_temperature': DEFAULT_TEMPERATURE,  # Use same default for analysis
-            'max_tokens': 4000  # Default max tokens
-        }
+        return get_model_settings()
     except Exception as e:
         print(f"Error getting model settings: {str(e)}")
         return {
             'model': DEFAULT_MODEL,
             'temperature': DEFAULT_TEMPERATURE,
             'analysis_temperature': DEFAULT_TEMPERATURE,  # Use same default for analysis
-            'max_tokens': 4000  # Default max tokens
+            'max_tokens': DEFAULT_MAX_TOKENS,
+            'context_window': DEFAULT_CONTEXT_WINDOW,
+            'reference_token_budget': DEFAULT_REFERENCE_TOKEN_BUDGET
         }
 
 def count_tokens(text, model=DEFAULT_MODEL):
-    """Count the number of tokens in a text string."""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+    """Count the number of tokens in a text string (encoders are cached per model)."""
+    return tokens.count_tokens(text, model)
 
-def truncate_document(text, max_chars=MAX_CHARS_PER_DOC):
-    """Truncate a document to a maximum character count."""
-    if len(text) <= max_chars:
-        return text
+def prepare_reference_content(queryset, model_settings=None):
+    """
+    Pack reference documents from a queryset or list into the model's reference
+    token budget. Querysets are taken newest first; lists keep their order.
+    """
+    if model_settings is None:
+        model_settings = get_default_model_settings()
     
-    # Simply take the first max_chars characters
-    return text[:max_chars]
-
-def prepare_reference_content(queryset):
-    """Prepare reference content from a queryset or list of documents."""
-    # Sample documents if needed
     if hasattr(queryset, 'filter') and hasattr(queryset, 'order_by'):
         # It's a queryset
-        if queryset.count() > MAX_REFERENCE_DOCS:
-            sampled_docs = list(queryset.order_by('-updated_at')[:MAX_REFERENCE_DOCS])
-        else:
-            sampled_docs = list(queryset)
+        documents = list(queryset.order_by('-updated_at')[:MAX_CANDIDATE_DOCUMENTS])
     else:
         # It's already a list
-        if len(queryset) > MAX_REFERENCE_DOCS:
-            sampled_docs = queryset[:MAX_REFERENCE_DOCS]
-        else:
-            sampled_docs = queryset
-    
-    # Build content
-    document_contents = []
-    total_tokens = 0
-    
-    for doc in sampled_docs:
-        # Truncate the document
-        truncated_text = truncate_document(doc.plain_text)
-        
-        # Create document snippet
-        doc_snippet = f"Title: {doc.title}\n\nContent: {truncated_text}\n\n"
-        
-        # Check token count
-        doc_tokens = count_tokens(doc_snippet)
-        
-        # If adding this document would exceed our token limit, skip it
-        if total_tokens + doc_tokens > MAX_TOTAL_TOKENS and document_contents:
-            continue
-        
-        document_contents.append(doc_snippet)
-        total_tokens += doc_tokens
-        
-        # If we've reached our token limit, stop adding documents
-        if total_tokens >= MAX_TOTAL_TOKENS:
-            break
+        documents = list(queryset)[:MAX_CANDIDATE_DOCUMENTS]
     
-    # Return the combined content
-    return "\n---\n".join(document_contents)
+    budget = reference_token_budget(model_settings)
+    return pack_references(documents, budget, model_settings['model'])
+
+def reference_titles(queryset):
+    """Titles of the documents prepare_reference_content would use, in the same order."""
+    if hasattr(queryset, 'filter') and hasattr(queryset, 'order_by'):
+        return list(queryset.order_by('-updated_at').values_list('title', flat=True)[:MAX_CANDIDATE_DOCUMENTS])
+    return [doc.title for doc in list(queryset)[:MAX_CANDIDATE_DOCUMENTS]]
 
 def extract_title_from_content(content):
     """
@@ -149,9 +104,7 @@ def generate_title_from_content(content, model=None):
     
     try:
         # Extract plain text from HTML for better title generation
-        plain_text = re.sub(r'<[^>]*>', ' ', content)
-        plain_text = html.unescape(plain_text)
-        plain_text = re.sub(r'\s+', ' ', plain_text).strip()
+        plain_text = extract_plain_text(content)
         
         # Truncate to first 1000 characters for title generation
         truncated_text = plain_text[:1000] + ("..." if len(plain_text) > 1000 else "")
@@ -316,6 +269,39 @@ Keep your response under 100 words. Focus only on the most distinctive and impor
         return None
 
 
+# Bump when the built-in style analysis or condensation prompts change
+STYLE_ANALYSIS_VERSION = 1
+STYLE_ANALYSIS_CACHE_TIMEOUT = 60 * 60 * 24 * 30  # 30 days
+
+
+def style_analysis_key(combined_content, organization=None, model=None):
+    """
+    Hash identifying a style analysis by what actually goes into it: the reference
+    text, the prompt templates in effect and the model settings. Editing a reference
+    document changes the key; the same text under other document ids does not.
+    """
+    model_settings = get_default_model_settings()
+    parts = [
+        str(STYLE_ANALYSIS_VERSION),
+        str(organization.pk) if organization else '',
+        model or model_settings['model'],
+        str(model_settings['analysis_temperature']),
+        AIPromptTemplate.get_template('style_analysis', organization) or '',
+        AIPromptTemplate.get_template('style_condensation', organization) or '',
+        combined_content,
+    ]
+    return hashlib.sha256('\x00'.join(parts).encode('utf-8')).hexdigest()
+
+
+def find_style_constraint(analysis_key, organization):
+    """Return the newest active style constraint stored for an analysis key, if any."""
+    return StyleConstraint.objects.filter(
+        analysis_key=analysis_key,
+        organization=organization,
+        is_active=True
+    ).order_by('-created_at').first()
+
+
 def analyze_document_style(combined_content, model=None, user=None):
     """
     Analyze the style of the provided documents and generate a detailed style guide.
@@ -329,14 +315,30 @@ def analyze_document_style(combined_content, model=None, user=None):
         model_settings = get_default_model_settings()
         model = model_settings['model']
     
+    # Get the organization from the user if provided
+    organization = user.organization if user else None
+    
+    # Serve repeat analyses of the same text from the cache, or from a stored style constraint
+    analysis_key = style_analysis_key(combined_content, organization, model)
+    cache_key = f"documents:style_analysis:{analysis_key}"
+    cached_analysis = cache.get(cache_key)
+    if cached_analysis is None:
+        existing_constraint = find_style_constraint(analysis_key, organization)
+        if existing_constraint and existing_constraint.constraints.get('condensed_style'):
+            cached_analysis = {
+                'style_guide': existing_constraint.constraints.get('full_style_guide', ''),
+                'condensed_style': existing_constraint.constraints['condensed_style']
+            }
+            cache.set(cache_key, cached_analysis, STYLE_ANALYSIS_CACHE_TIMEOUT)
+    if cached_analysis is not None:
+        print(f"USING CACHED STYLE ANALYSIS: {analysis_key}")
+        return {**cached_analysis, 'analysis_key': analysis_key}
+    
     try:
         # Get OpenAI API key from settings
         from django.conf import settings
         client = OpenAI(api_key=settings.OPENAI_API_KEY)
         
-        # Get the organization from the user if provided
-        organization = user.organization if user else None
-        
         # Get style analysis template from database or use default
         template = AIPromptTemplate.get_template('style_analysis', organization)
         
@@ -425,10 +427,18 @@ Format your response as a comprehensive style guide with clear sections and spec
         # Also generate a condensed version of the style guide
         condensed_style = condense_style_guide(style_guide, model, user)
         
+        # Only cache complete analyses so a failed condensation is retried next time
+        if condensed_style:
+            cache.set(cache_key, {
+                'style_guide': style_guide,
+                'condensed_style': condensed_style
+            }, STYLE_ANALYSIS_CACHE_TIMEOUT)
+        
         # Return both the full style guide and the condensed version
         return {
             'style_guide': style_guide,
-            'condensed_style': condensed_style
+            'condensed_style': condensed_style,
+            'analysis_key': analysis_key
         }
         
     except Exception as e:
@@ -437,13 +447,22 @@ Format your response as a comprehensive style guide with clear sections and spec
         return None
 
 
-def create_style_constraint(style_guide, condensed_style, user, document_ids=None):
+def create_style_constraint(style_guide, condensed_style, user, document_ids=None, analysis_key=''):
     """
     Create a StyleConstraint object from a style guide and condensed style.
+    If a constraint already exists for the same analysis key it is reused.
     """
     from .models import StyleConstraint, TextDocument
     
     try:
+        if analysis_key:
+            existing_constraint = find_style_constraint(analysis_key, user.organization)
+            if existing_constraint:
+                if document_ids:
+                    existing_constraint.reference_documents.add(*TextDocument.objects.filter(id__in=document_ids))
+                print(f"Reusing style constraint with the same analysis: {existing_constraint.id}")
+                return existing_constraint
+        
         # Create a name for the style constraint based on the user and timestamp
         from django.utils import timezone
         timestamp = timezone.now().strftime("%Y-%m-%d %H:%M")
@@ -493,7 +512,8 @@ def create_style_constraint(style_guide, condensed_style, user, document_ids=Non
             },
             organization=user.organization,
             created_by=user,
-            is_active=True
+            is_active=True,
+            analysis_key=analysis_key
         )
         
         # Add reference documents if provided
@@ -510,31 +530,193 @@ def create_style_constraint(style_guide, condensed_style, user, document_ids=Non
         # Re-raise the exception so the calling code can handle it
         raise
 
+def generation_limit_response(organization):
+    """Return the response sent when an organization has used up its AI generations."""
+    subscription_plan = organization.get_subscription_plan_display()
+    return Response(
+        {
+            "detail": f"You have reached your monthly AI generation limit for the {subscription_plan} plan. "
+                      f"Please upgrade your subscription to generate more AI documents.",
+            "limit_reached": True,
+            "current_plan": organization.subscription_plan,
+            "upgrade_options": {
+                "creator": {
+                    "name": "Creator",
+                    "price": 9,
+                    "limit": 100
+                },
+                "master": {
+                    "name": "Master",
+                    "price": 19,
+                    "limit": 500
+                }
+            }
+        },
+        status=status.HTTP_403_FORBIDDEN
+    )
+
 @csrf_exempt
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def generate_document_with_ai(request):
     """Generate a new document using AI based on existing documents."""
-    # Get filter parameters
-    tags = request.data.get('tags', [])
-    category_filter = request.data.get('category_filter')
-    document_category = request.data.get('document_category')
-    status_value = request.data.get('status')
-    generation_type = request.data.get('generation_type', 'existing')
-    document_type = request.data.get('document_type', 'summary')
-    concept = request.data.get('concept', '')
-    document_length = request.data.get('document_length', 'medium')
-    title = request.data.get('title', f'AI Generated {document_type.capitalize()}')
-    debug_mode = request.data.get('debug_mode', False)
-    selected_document_ids = request.data.get('selected_document_ids', [])
-    analyze_style_only = request.data.get('analyze_style_only', False)
-    style_guide = request.data.get('style_guide', None)
-    style_constraint_id = request.data.get('style_constraint_id', None)
-    
-    # Get user and organization
+    return run_document_generation(request.user, request.data)
+
+
+@csrf_exempt
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def generate_document_with_ai_stream(request):
+    """
+    Generate a new document using AI, streaming the HTML to the client as
+    server-sent events while the completion is produced.
+    """
+    response = StreamingHttpResponse(
+        stream_document_generation(request.user, request_parameters(request)),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+
+def request_parameters(request):
+    """Return the request data as a plain dict that outlives the request."""
+    return request.data.dict() if hasattr(request.data, 'dict') else dict(request.data)
+
+
+def sse_event(event, data):
+    """Format a single server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+def stream_document_generation(user, data):
+    """
+    Yield server-sent events for a generation: 'status' events while the
+    prompt is prepared, 'token' events as the completion arrives, then
+    'done' with the saved document or 'error'.
+    
+    The document is only created, and the generation only charged, once the
+    completion has finished. If the client disconnects the server closes this
+    generator, which closes the upstream OpenAI stream and cancels the call.
+    """
+    # Sent before any slow work so the client gets its first byte immediately
+    yield sse_event('status', {'stage': 'preparing'})
+    
+    generation = prepare_document_generation(user, data)
+    if isinstance(generation, Response):
+        # Early exits (errors, style analysis only, debug mode) arrive as a single event
+        if generation.status_code >= 400:
+            yield sse_event('error', {'status_code': generation.status_code, **generation.data})
+        else:
+            yield sse_event('done', generation.data)
+        return
+    
+    chunks = []
+    stream = None
+    try:
+        from django.conf import settings
+        client = OpenAI(api_key=settings.OPENAI_API_KEY)
+        
+        print(f"STREAMING OPENAI API with model={generation['model']}, temperature={generation['temperature']}, max_tokens={generation['max_tokens']}...")
+        stream = client.chat.completions.create(
+            model=generation['model'],
+            messages=generation_messages(generation),
+            max_tokens=generation['max_tokens'],
+            temperature=generation['temperature'],
+            timeout=90,
+            stream=True
+        )
+        yield sse_event('status', {'stage': 'generating'})
+        
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if text:
+                chunks.append(text)
+                yield sse_event('token', {'text': text})
+    except Exception as e:
+        response = openai_error_response(e)
+        yield sse_event('error', {'status_code': response.status_code, **response.data})
+        return
+    finally:
+        # Also runs on GeneratorExit when the client has gone away
+        if stream is not None:
+            stream.close()
+    
+    yield sse_event('status', {'stage': 'saving'})
+    response = save_generated_document(user, generation, ''.join(chunks))
+    if response.status_code >= 400:
+        yield sse_event('error', {'status_code': response.status_code, **response.data})
+    else:
+        yield sse_event('done', response.data)
+
+
+@csrf_exempt
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def submit_generation_job(request):
+    """
+    Queue an AI generation as a background job and return the job immediately.
+    Accepts the same parameters as generate_document_with_ai; poll the job
+    status endpoint for the result. Credits are only charged if the job succeeds.
+    """
     user = request.user
     organization = user.organization
     
+    # Fail fast on the limit so clients don't poll a job that can't succeed
+    if not request.data.get('analyze_style_only', False):
+        organization.reset_ai_generations_if_needed()
+        if organization.ai_generations_remaining <= 0:
+            return generation_limit_response(organization)
+    
+    job = BackgroundJob.objects.create(
+        job_type='ai_generation',
+        organization=organization,
+        created_by=user,
+        parameters=request_parameters(request)
+    )
+    
+    try:
+        run_ai_generation_job.delay(str(job.uuid))
+    except Exception as e:
+        print(f"Error queueing generation job {job.uuid}: {str(e)}")
+        job.mark_failed(f"Could not queue generation job: {str(e)}")
+        return Response(
+            {"detail": "Background generation is currently unavailable. Please try again later."},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    
+    return Response(BackgroundJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+def prepare_document_generation(user, data):
+    """
+    Select reference documents, resolve the style guide and build the prompt.
+    Returns a Response for anything that ends the request early (errors,
+    style-analysis-only and debug mode), otherwise a dict describing the
+    completion to run.
+    """
+    # Get filter parameters
+    tags = data.get('tags', [])
+    category_filter = data.get('category_filter')
+    document_category = data.get('document_category')
+    status_value = data.get('status')
+    generation_type = data.get('generation_type', 'existing')
+    document_type = data.get('document_type', 'summary')
+    concept = data.get('concept', '')
+    document_length = data.get('document_length', 'medium')
+    title = data.get('title', f'AI Generated {document_type.capitalize()}')
+    debug_mode = data.get('debug_mode', False)
+    selected_document_ids = data.get('selected_document_ids', [])
+    analyze_style_only = data.get('analyze_style_only', False)
+    style_guide = data.get('style_guide', None)
+    style_constraint_id = data.get('style_constraint_id', None)
+    
+    # Get organization
+    organization = user.organization
+    
     # Check if this is a full generation (not just style analysis)
     is_full_generation = not analyze_style_only
     
@@ -545,28 +727,7 @@ def generate_document_with_ai(request):
         
         # Check if the organization has reached its AI generation limit
         if organization.ai_generations_remaining <= 0:
-            subscription_plan = organization.get_subscription_plan_display()
-            return Response(
-                {
-                    "detail": f"You have reached your monthly AI generation limit for the {subscription_plan} plan. "
-                              f"Please upgrade your subscription to generate more AI documents.",
-                    "limit_reached": True,
-                    "current_plan": organization.subscription_plan,
-                    "upgrade_options": {
-                        "creator": {
-                            "name": "Creator",
-                            "price": 9,
-                            "limit": 100
-                        },
-                        "master": {
-                            "name": "Master",
-                            "price": 19,
-                            "limit": 500
-                        }
-                    }
-                },
-                status=status.HTTP_403_FORBIDDEN
-            )
+            return generation_limit_response(organization)
     
     # Debug logging
     print(f"AI Generation - Received filters: category_filter={category_filter}, document_category={document_category}, status={status_value}, tags={tags}")
@@ -609,9 +770,6 @@ def generate_document_with_ai(request):
             print(f"DOCUMENT GENERATION - Error retrieving style constraint: {str(e)}")
             style_constraint_id = None
     
-    # Get user for organization
-    user = request.user
-    
     # Get OpenAI API key from settings
     from django.conf import settings
     openai_api_key = settings.OPENAI_API_KEY
@@ -642,96 +800,41 @@ def generate_document_with_ai(request):
         category_filter = int(category_filter)
         print(f"Converted category_filter to integer: {category_filter}")
 
-    # Determine if we need to convert to a list for Python-level filtering
-    needs_python_filtering = bool(tags)
-    
-    # If we need Python-level filtering, convert queryset to list first
-    if needs_python_filtering:
-        print("Converting queryset to list for Python-level filtering")
-        all_docs = list(queryset)
-        print(f"Total documents before filtering: {len(all_docs)}")
-        
-        # Apply all filters at the Python level for consistency
-        filtered_docs = []
-        for doc in all_docs:
-            # Check category filter
-            if category_filter:
-                doc_category_id = doc.category_id
-                if doc_category_id is not None:
-                    doc_category_id = int(doc_category_id)
-                
-                if doc_category_id != category_filter:
-                    print(f"Excluding document {doc.id} with title '{doc.title}' because its category ({doc_category_id}) doesn't match the selected category ({category_filter})")
-                    continue
-            
-            # Check tag filter
-            if tags:
-                doc_tags = doc.tags if doc.tags else []
-                if not all(tag in doc_tags for tag in tags):
-                    print(f"Excluding document {doc.id} with title '{doc.title}' because it doesn't have all required tags")
-                    continue
-            
-            # Document passed all filters
-            filtered_docs.append(doc)
-        
-        # Replace the queryset with our filtered list
-        queryset = filtered_docs
-        print(f"After all Python-level filtering, count: {len(queryset)}")
-    
-    # If we don't need Python-level filtering, use database-level filtering
-    else:
-        # Apply category filter at database level
-        if category_filter:
-            try:
-                print(f"Filtering by category_filter: {category_filter} (type: {type(category_filter)})")
-                queryset = queryset.filter(category_id=category_filter)
-                print(f"After category filtering, count: {queryset.count()}")
-            except Exception as e:
-                print(f"Error filtering by category filter: {str(e)}")
-                return Response(
-                    {"detail": f"Error filtering by category filter: {str(e)}"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-    
-    if status_value:
-        if hasattr(queryset, 'filter'):
-            # It's a queryset, use database-level filtering
-            queryset = queryset.filter(status=status_value)
-            print(f"After status filtering, count: {queryset.count()}")
-        else:
-            # It's a list, use Python-level filtering
-            filtered_queryset = []
-            for doc in queryset:
-                if doc.status == status_value:
-                    filtered_queryset.append(doc)
-                else:
-                    print(f"WARNING: Excluding document {doc.id} with title '{doc.title}' because its status ('{doc.status}') doesn't match the selected status ('{status_value}')")
-            
-            queryset = filtered_queryset
-            print(f"After status filtering, count: {len(queryset)}")
-    
-    # Check if we have documents to work with
-    if hasattr(queryset, 'filter') and hasattr(queryset, 'order_by'):
-        # It's a queryset
+    # Apply category, status and tag filters in the database; only prompt fields are loaded
+    try:
+        queryset = select_reference_documents(
+            queryset,
+            category_id=category_filter,
+            status=status_value,
+            tags=tags
+        )
         if not queryset.exists():
             return Response(
                 {"detail": "No documents found matching the specified filters."},
                 status=status.HTTP_400_BAD_REQUEST
             )
         doc_count = queryset.count()
-    else:
-        # It's a list
-        if not queryset:
-            return Response(
-                {"detail": "No documents found matching the specified filters."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        doc_count = len(queryset)
+    except (TypeError, ValueError) as e:
+        print(f"Error applying document filters: {str(e)}")
+        return Response(
+            {"detail": f"Error applying document filters: {str(e)}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
     
-    # Log the documents being used
+    # Log the documents being used (at most the ones that can make it into the prompt)
     print(f"Using {doc_count} documents for AI generation:")
-    for doc in queryset:
-        print(f"- Document ID: {doc.id}, Title: {doc.title}, Category: {doc.category_id}")
+    for doc_id, doc_title, doc_category_id in queryset.order_by('-updated_at').values_list(
+            'id', 'title', 'category_id')[:MAX_CANDIDATE_DOCUMENTS]:
+        print(f"- Document ID: {doc_id}, Title: {doc_title}, Category: {doc_category_id}")
+    
+    # Without an explicit selection, new content is based on the documents most related to the concept
+    if generation_type == 'new' and concept and not selected_document_ids and not analyze_style_only:
+        relevant_documents = select_relevant_documents(queryset, organization.id, concept)
+        if relevant_documents:
+            queryset = relevant_documents
+            selected_document_ids = [doc.id for doc in relevant_documents]
+            doc_count = len(relevant_documents)
+            print(f"Using {doc_count} documents most similar to the concept: {selected_document_ids}")
     
     # Prepare content from filtered documents using our smart sampling and truncation
     combined_content = prepare_reference_content(queryset)
@@ -766,7 +869,7 @@ def generate_document_with_ai(request):
                     'condensed_style': condensed_style,
                     'style_constraint_id': style_constraint_id,
                     'document_count': doc_count,
-                    'document_titles': [doc.title for doc in queryset],
+                    'document_titles': reference_titles(queryset),
                     'combined_content_length': len(combined_content),
                     'message': 'Using existing style constraint'
                 }, status=status.HTTP_200_OK)
@@ -775,29 +878,13 @@ def generate_document_with_ai(request):
                 # Continue with style analysis as if no style constraint was provided
                 style_constraint_id = None
         
-        # If no style constraint ID was provided, check if there's an existing constraint for these documents
+        # If no style constraint ID was provided, check if these exact reference texts were analyzed before
         if not style_constraint_id and selected_document_ids:
             try:
-                # Find style constraints that have all the selected documents as reference documents
-                from django.db.models import Count
-                from django.db import models
-                
-                # Get style constraints that reference at least one of the selected documents
-                potential_constraints = StyleConstraint.objects.filter(
-                    reference_documents__id__in=selected_document_ids,
-                    is_active=True,
-                    organization=user.organization
-                ).distinct()
-                
-                # Now filter to only those that reference ALL selected documents
-                # We do this by annotating with a count of how many of the selected documents are referenced
-                # and then filtering to only those where the count equals the number of selected documents
-                potential_constraints = potential_constraints.annotate(
-                    doc_count=Count('reference_documents', filter=models.Q(reference_documents__id__in=selected_document_ids))
-                ).filter(doc_count=len(selected_document_ids))
-                
-                # Get the most recent one if multiple exist
-                existing_constraint = potential_constraints.order_by('-created_at').first()
+                existing_constraint = find_style_constraint(
+                    style_analysis_key(combined_content, user.organization),
+                    user.organization
+                )
                 
                 if existing_constraint:
                     # Use the existing style constraint
@@ -815,7 +902,7 @@ def generate_document_with_ai(request):
                         'condensed_style': condensed_style,
                         'style_constraint_id': style_constraint_id,
                         'document_count': doc_count,
-                        'document_titles': [doc.title for doc in queryset],
+                        'document_titles': reference_titles(queryset),
                         'combined_content_length': len(combined_content),
                         'message': 'Found existing style constraint for these documents'
                     }, status=status.HTTP_200_OK)
@@ -833,7 +920,8 @@ def generate_document_with_ai(request):
                     style_analysis_result['style_guide'],
                     style_analysis_result['condensed_style'],
                     user,
-                    selected_document_ids
+                    selected_document_ids,
+                    analysis_key=style_analysis_result['analysis_key']
                 )
                 
                 # Add the style constraint ID to the response if created successfully
@@ -846,7 +934,7 @@ def generate_document_with_ai(request):
                 'condensed_style': style_analysis_result['condensed_style'],
                 'style_constraint_id': style_constraint_id,
                 'document_count': doc_count,
-                'document_titles': [doc.title for doc in queryset],
+                'document_titles': reference_titles(queryset),
                 'combined_content_length': len(combined_content)
             }, status=status.HTTP_200_OK)
         else:
@@ -890,31 +978,15 @@ def generate_document_with_ai(request):
     length_description = length_descriptions.get(document_length, 'medium-length (approximately 750-1500 words)')
     max_tokens = target_tokens.get(document_length, 3000)
     
-    # Try to get settings from database
-    try:
-        # Try to get organization-specific settings first
-        length_setting = DocumentLengthSettings.objects.get(
-            length_name=document_length,
-            organization=user.organization,
-            is_active=True
-        )
-        length_description = length_setting.description
-        max_tokens = length_setting.target_tokens
-        print(f"Using organization-specific settings: length_description={length_description}, max_tokens={max_tokens}")
-    except DocumentLengthSettings.DoesNotExist:
-        try:
-            # Fall back to global settings
-            length_setting = DocumentLengthSettings.objects.get(
-                length_name=document_length,
-                organization=None,
-                is_active=True
-            )
-            length_description = length_setting.description
-            max_tokens = length_setting.target_tokens
-            print(f"Using global settings: length_description={length_description}, max_tokens={max_tokens}")
-        except DocumentLengthSettings.DoesNotExist:
-            # Use the default values initialized above
-            print(f"Using hardcoded defaults: length_description={length_description}, max_tokens={max_tokens}")
+    # Organization-specific settings win over global ones (cached per process)
+    length_setting = get_length_setting(document_length, user.organization)
+    if length_setting:
+        length_description = length_setting['description']
+        max_tokens = length_setting['target_tokens']
+        print(f"Using configured settings: length_description={length_description}, max_tokens={max_tokens}")
+    else:
+        # Use the default values initialized above
+        print(f"Using hardcoded defaults: length_description={length_description}, max_tokens={max_tokens}")
     
     # Get formatting instructions from database or use default
     formatting_instructions = AIPromptTemplate.get_template('formatting', user.organization)
@@ -1115,7 +1187,8 @@ Your response MUST:
                         style_guide,
                         condensed_style,
                         user,
-                        selected_document_ids
+                        selected_document_ids,
+                        analysis_key=style_analysis_result['analysis_key']
                     )
                     style_constraint_id = style_constraint.id
                     print(f"Created new style constraint with ID: {style_constraint_id}")
@@ -1159,16 +1232,12 @@ Your response MUST:
         # Try again with updated variables
         prompt = template.format(**template_vars)
     
-    try:
-        # Set OpenAI API key from settings
-        client = OpenAI(api_key=openai_api_key)
-        
-        # Get system message from database or use default
-        system_message = AIPromptTemplate.get_template('system_message', user.organization)
-        
-        # If no template exists in the database, use the default
-        if not system_message:
-            system_message = """You are a professional writer and style mimic who creates beautifully formatted documents in HTML format while perfectly matching the writing style of provided examples.
+    # Get system message from database or use default
+    system_message = AIPromptTemplate.get_template('system_message', user.organization)
+    
+    # If no template exists in the database, use the default
+    if not system_message:
+        system_message = """You are a professional writer and style mimic who creates beautifully formatted documents in HTML format while perfectly matching the writing style of provided examples.
 
 IMPORTANT: Your output MUST be valid HTML with proper tags for headings, paragraphs, lists, etc. 
 DO NOT return plain text or markdown - ONLY return HTML.
@@ -1199,67 +1268,83 @@ ADDITIONAL CRITICAL INSTRUCTIONS:
 2. If the concept is in Norwegian nynorsk, your response must also be in Norwegian nynorsk, not bokmål
 3. Ensure your response meets the requested length (e.g., 750-1500 words for medium length)
 4. Maintain factual accuracy while expanding on concepts"""
-        
-        # Log the complete prompt and system message for debugging
-        print("=" * 80)
-        print("SYSTEM MESSAGE:")
-        print(system_message)
-        print("-" * 80)
-        print("USER PROMPT:")
-        print(prompt)
-        print("=" * 80)
-        
-        # If debug mode is enabled, return the prompt and system message without calling the API
-        if debug_mode:
-            # Get document count and titles based on whether queryset is a list or queryset
-            if hasattr(queryset, 'filter') and hasattr(queryset, 'order_by'):
-                document_count = queryset.count()
-            else:
-                document_count = len(queryset)
-                
-            document_titles = [doc.title for doc in queryset]
-            
-            # Get model settings from database
-            model_settings = get_default_model_settings()
-            model = model_settings['model']
-            temperature = model_settings['temperature']
-            model_max_tokens = model_settings['max_tokens']
-            
-            # Use the max_tokens from the model settings if available, otherwise use the length-based max_tokens
-            api_max_tokens = model_max_tokens if model_max_tokens else max_tokens
+    
+    # Log the complete prompt and system message for debugging
+    print("=" * 80)
+    print("SYSTEM MESSAGE:")
+    print(system_message)
+    print("-" * 80)
+    print("USER PROMPT:")
+    print(prompt)
+    print("=" * 80)
+    
+    # Get model settings from database
+    model_settings = get_default_model_settings()
+    model = model_settings['model']
+    temperature = model_settings['temperature']
+    model_max_tokens = model_settings['max_tokens']
+    
+    # Use the max_tokens from the model settings if available, otherwise use the length-based max_tokens
+    api_max_tokens = model_max_tokens if model_max_tokens else max_tokens
+    
+    # If debug mode is enabled, return the prompt and system message without calling the API
+    if debug_mode:
+        # Get document count and titles based on whether queryset is a list or queryset
+        if hasattr(queryset, 'filter') and hasattr(queryset, 'order_by'):
+            document_count = queryset.count()
+        else:
+            document_count = len(queryset)
             
-            return Response({
-                'debug': True,
-                'system_message': system_message,
-                'prompt': prompt,
-                'model': model,
-                'temperature': temperature,
-                'max_tokens': api_max_tokens,  # Use the same max_tokens value that would be used in the API call
-                'document_count': document_count,
-                'document_titles': document_titles,
-                'combined_content_length': len(combined_content)
-            }, status=status.HTTP_200_OK)
-        
-        # Get model settings from database
-        model_settings = get_default_model_settings()
-        model = model_settings['model']
-        temperature = model_settings['temperature']
-        model_max_tokens = model_settings['max_tokens']
-        
-        # Use the max_tokens from the model settings if available, otherwise use the length-based max_tokens
-        api_max_tokens = model_max_tokens if model_max_tokens else max_tokens
+        document_titles = reference_titles(queryset)
+        
+        return Response({
+            'debug': True,
+            'system_message': system_message,
+            'prompt': prompt,
+            'model': model,
+            'temperature': temperature,
+            'max_tokens': api_max_tokens,  # Use the same max_tokens value that would be used in the API call
+            'document_count': document_count,
+            'document_titles': document_titles,
+            'combined_content_length': len(combined_content)
+        }, status=status.HTTP_200_OK)
+    
+    return {
+        'system_message': system_message,
+        'prompt': prompt,
+        'model': model,
+        'temperature': temperature,
+        'max_tokens': api_max_tokens,
+        'title': title,
+        'title_provided': bool(data.get('title')),
+        'document_category': document_category,
+        'tags': tags,
+        'is_full_generation': is_full_generation,
+    }
+
+
+def run_document_generation(user, data):
+    """
+    Run the full generation pipeline for a user and return a Response.
+    Shared by the synchronous endpoint and the background job task.
+    """
+    generation = prepare_document_generation(user, data)
+    if isinstance(generation, Response):
+        return generation
+    
+    try:
+        # Set OpenAI API key from settings
+        from django.conf import settings
+        client = OpenAI(api_key=settings.OPENAI_API_KEY)
         
         # Call OpenAI API
         print("=" * 80)
-        print(f"CALLING OPENAI API with model={model}, temperature={temperature}, max_tokens={api_max_tokens}...")
+        print(f"CALLING OPENAI API with model={generation['model']}, temperature={generation['temperature']}, max_tokens={generation['max_tokens']}...")
         response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=api_max_tokens,
-            temperature=temperature,
+            model=generation['model'],
+            messages=generation_messages(generation),
+            max_tokens=generation['max_tokens'],
+            temperature=generation['temperature'],
             timeout=90  # 90 seconds timeout for the OpenAI API call
         )
         print("API RESPONSE RECEIVED")
@@ -1269,93 +1354,118 @@ ADDITIONAL CRITICAL INSTRUCTIONS:
         print(response)
         print("-" * 80)
         
-        # Get generated content and format it for better display
+        # Get generated content
         generated_content = response.choices[0].message.content
         print("GENERATED CONTENT (FIRST 500 CHARS):")
         print(generated_content[:500] + "..." if len(generated_content) > 500 else generated_content)
         print("-" * 80)
-        
-        # Format the content
-        formatted_content = format_content_for_display(generated_content)
-        print("FORMATTED CONTENT (FIRST 500 CHARS):")
-        print(formatted_content[:500] + "..." if len(formatted_content) > 500 else formatted_content)
-        print("=" * 80)
-        
-        # Always try to extract or generate a title unless the user explicitly provided one
-        document_title = title
-        if not request.data.get('title') or title.startswith('AI Generated'):
-            print("User didn't provide a custom title, attempting to extract or generate one")
-            
-            # First try to extract title from H1 tag
-            extracted_title = extract_title_from_content(formatted_content)
-            if extracted_title:
-                print(f"Successfully extracted title from H1 tag: '{extracted_title}'")
-                document_title = extracted_title
-            else:
-                # If no H1 tag found, generate a title using AI
-                print("No H1 tag found, generating title using AI")
-                generated_title = generate_title_from_content(formatted_content)
-                if generated_title:
-                    print(f"Successfully generated title: '{generated_title}'")
-                    document_title = generated_title
-                else:
-                    print(f"Failed to generate title, using default: '{document_title}'")
-        
-        # Handle empty category_id - convert empty string to None
-        category_id = None
-        if document_category and document_category.strip():
-            # Only set category_id if it's not an empty string
-            print(f"Using category ID: {document_category}")
-            category_id = document_category
-        else:
-            print("No category selected, using None for category_id")
-        
-        # Use a transaction to ensure that document creation and counter increment are atomic
-        from django.db import transaction
-        
-        try:
-            with transaction.atomic():
-                # Create new document - let the model's save method handle plain_text extraction
-                new_document = TextDocument.objects.create(
-                    title=document_title,
-                    content=formatted_content,
-                    created_by=user,
-                    organization=user.organization,
-                    category_id=category_id,  # Use the selected document category or None
-                    tags=tags,
-                    status='draft'
-                )
-                
-                # Only increment the AI generations counter if document creation was successful
-                if is_full_generation:
-                    organization.increment_ai_generations_used()
-                
-                # Return the new document
-                serializer = TextDocumentDetailSerializer(new_document)
-                return Response(
-                    {
-                        **serializer.data,
-                        "ai_generations_used": organization.ai_generations_used,
-                        "ai_generations_limit": organization.ai_generation_limit,
-                        "ai_generations_remaining": organization.ai_generations_remaining
-                    }, 
-                    status=status.HTTP_201_CREATED
-                )
-        except Exception as e:
-            # Log the error but don't increment the counter since document creation failed
-            error_message = str(e)
-            print(f"Error creating document: {error_message}")
-            return Response({'error': f"Failed to create document: {error_message}"}, 
-                           status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     except Exception as e:
-        error_message = str(e)
-        print(f"OpenAI API error: {error_message}")
-        
-        # Check if it's a quota exceeded error
-        if 'quota' in error_message.lower() or 'exceeded' in error_message.lower() or 'limit' in error_message.lower():
+        return openai_error_response(e)
+    
+    return save_generated_document(user, generation, generated_content)
+
+
+def generation_messages(generation):
+    """Return the chat messages for a prepared generation."""
+    return [
+        {"role": "system", "content": generation['system_message']},
+        {"role": "user", "content": generation['prompt']}
+    ]
+
+
+def openai_error_response(error):
+    """Return the error response for a failed OpenAI API call."""
+    error_message = str(error)
+    print(f"OpenAI API error: {error_message}")
+    
+    # Check if it's a quota exceeded error
+    if 'quota' in error_message.lower() or 'exceeded' in error_message.lower() or 'limit' in error_message.lower():
+        return Response(
+            {'error': f"OpenAI API quota exceeded: {error_message}. Please check your OpenAI account for details."},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+    
+    return Response({'error': error_message}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def save_generated_document(user, generation, generated_content):
+    """
+    Turn generated HTML into a TextDocument and charge the generation.
+    Returns the Response for the created document.
+    """
+    organization = user.organization
+    
+    # Format the content
+    formatted_content = format_content_for_display(generated_content)
+    print("FORMATTED CONTENT (FIRST 500 CHARS):")
+    print(formatted_content[:500] + "..." if len(formatted_content) > 500 else formatted_content)
+    print("=" * 80)
+    
+    # Always try to extract or generate a title unless the user explicitly provided one
+    title = generation['title']
+    document_title = title
+    if not generation['title_provided'] or title.startswith('AI Generated'):
+        print("User didn't provide a custom title, attempting to extract or generate one")
+        
+        # First try to extract title from H1 tag
+        extracted_title = extract_title_from_content(formatted_content)
+        if extracted_title:
+            print(f"Successfully extracted title from H1 tag: '{extracted_title}'")
+            document_title = extracted_title
+        else:
+            # If no H1 tag found, generate a title using AI
+            print("No H1 tag found, generating title using AI")
+            generated_title = generate_title_from_content(formatted_content)
+            if generated_title:
+                print(f"Successfully generated title: '{generated_title}'")
+                document_title = generated_title
+            else:
+                print(f"Failed to generate title, using default: '{document_title}'")
+    
+    # Handle empty category_id - convert empty string to None
+    category_id = None
+    document_category = generation['document_category']
+    if document_category and str(document_category).strip():
+        # Only set category_id if it's not an empty string
+        print(f"Using category ID: {document_category}")
+        category_id = document_category
+    else:
+        print("No category selected, using None for category_id")
+    
+    # Use a transaction to ensure that document creation and counter increment are atomic
+    from django.db import transaction
+    
+    try:
+        with transaction.atomic():
+            # Create new document - let the model's save method handle plain_text extraction
+            new_document = TextDocument.objects.create(
+                title=document_title,
+                content=formatted_content,
+                created_by=user,
+                organization=organization,
+                category_id=category_id,  # Use the selected document category or None
+                tags=generation['tags'],
+                status='draft'
+            )
+            
+            # Only increment the AI generations counter if document creation was successful
+            if generation['is_full_generation']:
+                organization.increment_ai_generations_used()
+            
+            # Return the new document
+            serializer = TextDocumentDetailSerializer(new_document)
             return Response(
-                {'error': f"OpenAI API quota exceeded: {error_message}. Please check your OpenAI account for details."},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                {
+                    **serializer.data,
+                    "ai_generations_used": organization.ai_generations_used,
+                    "ai_generations_limit": organization.ai_generation_limit,
+                    "ai_generations_remaining": organization.ai_generations_remaining
+                }, 
+                status=status.HTTP_201_CREATED
             )
-        
-        return Response({'error': error_message}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except Exception as e:
+        # Log the error but don't increment the counter since document creation failed
+        error_message = str(e)
+        print(f"Error creating document: {error_message}")
+        return Response({'error': f"Failed to create document: {error_message}"}, 
+                       status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -0,0 +1,81 @@
+"""
+Conditional GET for document and share responses.
+
+Document payloads carry a weak ETag derived from the document's id, version
+and last save, together with its comments and category (both are part of
+the payload), and a matching Last-Modified date. Clients that send a
+current If-None-Match or If-Modified-Since get an empty 304 instead of the
+document body.
+"""
+
+import hashlib
+from datetime import datetime, timezone as dt_timezone
+
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+# Authenticated responses may be stored by the browser but are revalidated on every use
+PRIVATE_CACHE_CONTROL = 'private, no-cache'
+
+# Longest a public share may be served from a shared cache without revalidating
+SHARE_MAX_AGE = 60 * 5
+
+
+def _comment_stamps(document):
+    """Number of comments and the time the latest one changed, from prefetched comments when there are any."""
+    prefetched = getattr(document, '_prefetched_objects_cache', {})
+    if 'comments' in prefetched:
+        comments = prefetched['comments']
+        return len(comments), max((comment.updated_at for comment in comments), default=None)
+    stamps = document.comments.aggregate(total=Count('id'), latest=Max('updated_at'))
+    return stamps['total'], stamps['latest']
+
+
+def document_validators(document):
+    """Return the ETag and Last-Modified time of a document's detail payload."""
+    comment_count, comment_updated_at = _comment_stamps(document)
+    changed = [document.updated_at, comment_updated_at]
+    parts = [document.id, document.version, document.updated_at.timestamp(), comment_count, document.category_id]
+    if comment_updated_at:
+        parts.append(comment_updated_at.timestamp())
+    # A renamed or recoloured category changes the payload too
+    if document.category_id and type(document).category.is_cached(document):
+        changed.append(document.category.updated_at)
+        parts.append(document.category.updated_at.timestamp())
+
+    digest = hashlib.md5(':'.join(map(str, parts)).encode()).hexdigest()
+    return f'W/"{digest}"', max(stamp for stamp in changed if stamp)
+
+
+def not_modified(request, etag, last_modified):
+    """Return a 304 response when the client's copy of a GET is current, otherwise None."""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    return get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+
+
+def set_validators(response, etag, last_modified, cache_control=PRIVATE_CACHE_CONTROL):
+    """Add the validators and caching policy to a response (or a 304)."""
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified.timestamp())
+    response['Cache-Control'] = cache_control
+    return response
+
+
+def share_cache_control(pdf_export):
+    """
+    Public shares may be cached briefly (never past their expiry); PIN-protected ones never.
+    Snapshots are no exception: a deleted share has to stop being served soon.
+    """
+    if pdf_export.pin_protected:
+        return 'private, no-store'
+    max_age = SHARE_MAX_AGE
+    if pdf_export.expires_at:
+        max_age = min(max_age, max(0, int((pdf_export.expires_at - timezone.now()).total_seconds())))
+    return f'public, max-age={max_age}'
+
+
+def from_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
@@ -0,0 +1,230 @@
+"""
+Document content parsing and renditions.
+
+Content arrives as HTML (the current editor), Slate.js JSON (older
+documents) or Markdown (imports and the API). The format is detected once
+and stored on the document; the content is then parsed into one normalized
+tree of elements and text, from which the HTML and plain-text renditions
+are produced. TextDocument.save() stores the renditions whenever the
+content changes, so readers never parse content themselves.
+"""
+
+import html
+import json
+import re
+import threading
+from html.parser import HTMLParser
+
+FORMAT_HTML = 'html'
+FORMAT_SLATE = 'slate'
+FORMAT_MARKDOWN = 'markdown'
+
+FORMAT_CHOICES = [
+    (FORMAT_HTML, 'HTML'),
+    (FORMAT_SLATE, 'Slate JSON'),
+    (FORMAT_MARKDOWN, 'Markdown'),
+]
+
+HTML_START_RE = re.compile(r'^\s*<[a-zA-Z]+[^>]*>')
+
+# Elements that separate words in the plain text
+BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'figcaption', 'figure',
+    'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol', 'p', 'pre',
+    'section', 'table', 'td', 'th', 'tr', 'ul',
+}
+
+# Elements without content or closing tag
+VOID_TAGS = {'area', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+# Elements whose text is never shown
+SKIPPED_TAGS = {'script', 'style', 'template'}
+
+SLATE_BLOCK_TAGS = {
+    'paragraph': 'p',
+    'heading-one': 'h1',
+    'heading-two': 'h2',
+    'block-quote': 'blockquote',
+    'bulleted-list': 'ul',
+    'numbered-list': 'ol',
+    'list-item': 'li',
+}
+
+SLATE_MARK_TAGS = (('bold', 'strong'), ('italic', 'em'), ('underline', 'u'))
+
+MARKDOWN_EXTENSIONS = ['tables', 'fenced_code', 'codehilite', 'nl2br', 'sane_lists']
+
+
+class Element:
+    """An element of the normalized content tree; children are Elements and strings."""
+
+    __slots__ = ('tag', 'attrs', 'children')
+
+    def __init__(self, tag, attrs=None, children=None):
+        self.tag = tag
+        self.attrs = attrs or []
+        self.children = children if children is not None else []
+
+
+def detect_format(content):
+    """Tell which format a content string is in."""
+    if not content:
+        return FORMAT_HTML
+    if HTML_START_RE.search(content):
+        return FORMAT_HTML
+    if content.lstrip().startswith(('[', '{')):
+        try:
+            if isinstance(json.loads(content), (list, dict)):
+                return FORMAT_SLATE
+        except ValueError:
+            pass
+    return FORMAT_MARKDOWN
+
+
+class _TreeBuilder(HTMLParser):
+    """Builds the normalized tree from HTML, closing unclosed elements."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = Element(None)
+        self.stack = [self.root]
+
+    def handle_starttag(self, tag, attrs):
+        element = Element(tag, attrs)
+        self.stack[-1].children.append(element)
+        if tag not in VOID_TAGS:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.stack[-1].children.append(Element(tag, attrs))
+
+    def handle_endtag(self, tag):
+        for position in range(len(self.stack) - 1, 0, -1):
+            if self.stack[position].tag == tag:
+                del self.stack[position:]
+                return
+
+    def handle_data(self, data):
+        self.stack[-1].children.append(data)
+
+
+def parse_html(content):
+    builder = _TreeBuilder()
+    builder.feed(content)
+    builder.close()
+    return builder.root
+
+
+def _slate_node(node):
+    if isinstance(node, list):
+        return [child for item in node for child in _slate_node(item)]
+    if not isinstance(node, dict):
+        return []
+    if 'text' in node:
+        text = node['text'] if isinstance(node['text'], str) else str(node['text'])
+        for mark, tag in SLATE_MARK_TAGS:
+            if node.get(mark):
+                text = Element(tag, children=[text])
+        return [text]
+    children = _slate_node(node.get('children', []))
+    tag = SLATE_BLOCK_TAGS.get(node.get('type', 'paragraph'))
+    return [Element(tag, children=children)] if tag else children
+
+
+def parse_slate(content):
+    try:
+        nodes = json.loads(content)
+    except ValueError:
+        nodes = []
+    return Element(None, children=_slate_node(nodes))
+
+
+_markdown = threading.local()
+
+
+def markdown_to_html(content):
+    """Render Markdown with one reusable converter per thread."""
+    try:
+        import markdown
+    except ImportError:
+        # Without the library, keep the text as paragraphs
+        return ''.join(
+            f"<p>{html.escape(paragraph)}</p>" for paragraph in content.split('\n\n') if paragraph.strip()
+        )
+    converter = getattr(_markdown, 'converter', None)
+    if converter is None:
+        converter = _markdown.converter = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    return converter.reset().convert(content)
+
+
+def parse_content(content, content_format=None):
+    """Parse content into the normalized tree; detects the format unless given."""
+    content_format = content_format or detect_format(content)
+    if content_format == FORMAT_SLATE:
+        return parse_slate(content or '')
+    if content_format == FORMAT_MARKDOWN:
+        return parse_html(markdown_to_html(content or ''))
+    return parse_html(content or '')
+
+
+def tree_to_html(element):
+    parts = []
+
+    def write(node):
+        if isinstance(node, str):
+            parts.append(html.escape(node, quote=False))
+            return
+        if node.tag:
+            attrs = ''.join(
+                f' {name}' if value is None else f' {name}="{html.escape(value)}"'
+                for name, value in node.attrs
+            )
+            parts.append(f"<{node.tag}{attrs}>")
+        for child in node.children:
+            write(child)
+        if node.tag and node.tag not in VOID_TAGS:
+            parts.append(f"</{node.tag}>")
+
+    write(element)
+    return ''.join(parts)
+
+
+def tree_to_text(element):
+    parts = []
+
+    def write(node):
+        if isinstance(node, str):
+            parts.append(node)
+            return
+        if node.tag in SKIPPED_TAGS:
+            return
+        block = node.tag in BLOCK_TAGS
+        if block:
+            parts.append(' ')
+        for child in node.children:
+            write(child)
+        if block:
+            parts.append(' ')
+
+    write(element)
+    return re.sub(r'\s+', ' ', ''.join(parts)).strip()
+
+
+class Renditions:
+    """The format of a content string and its derived HTML and plain text."""
+
+    def __init__(self, content, content_format=None):
+        self.content_format = content_format or detect_format(content)
+        tree = parse_content(content, self.content_format)
+        self.html = tree_to_html(tree)
+        self.plain_text = tree_to_text(tree)
+
+
+def render_content(content, content_format=None):
+    """Parse content once and return its Renditions."""
+    return Renditions(content, content_format)
+
+
+def extract_plain_text(content):
+    """Plain text of content in any format."""
+    return render_content(content).plain_text
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from accounts.models import Organization
+from documents.similarity import SimilarityIndex
+
+
+class Command(BaseCommand):
+    help = 'Builds and saves the document similarity index for each organization'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org_id', type=int, help='Only build the index of this organization')
+
+    def handle(self, *args, **options):
+        organizations = Organization.objects.all()
+        if options['org_id']:
+            organizations = organizations.filter(id=options['org_id'])
+
+        for organization_id in organizations.values_list('id', flat=True):
+            index = SimilarityIndex(organization_id)
+            index.build()
+            index.save()
+            self.stdout.write(f"Indexed {index.size} documents for organization {organization_id}")
+
+        self.stdout.write(self.style.SUCCESS("Successfully built similarity indexes"))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from documents.models import TextDocument
+from documents.versioning import apply_delta, compact_version
+
+
+class Command(BaseCommand):
+    help = 'Stores older document versions as deltas against the next version'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of latest documents per batch')
+        parser.add_argument('--org_id', type=int, help='Only process documents of this organization')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        documents = TextDocument.objects.filter(is_latest=True, parent__isnull=False)
+        if options['org_id']:
+            documents = documents.filter(organization_id=options['org_id'])
+
+        total = documents.count()
+        self.stdout.write(f"Compacting the version history of {total} documents")
+
+        processed = 0
+        compacted = 0
+        last_id = 0
+        while True:
+            batch = list(documents.filter(id__gt=last_id).order_by('id').only('id', 'content', 'parent_id')[:batch_size])
+            if not batch:
+                break
+
+            for document in batch:
+                # Walk back from the latest version, carrying each version's full content
+                newer_content = document.content
+                parent_id = document.parent_id
+                while parent_id:
+                    parent = TextDocument.objects.only('id', 'content', 'content_delta', 'parent_id').get(pk=parent_id)
+                    if parent.content_delta is None:
+                        compact_version(parent.id, newer_content, parent.content)
+                        newer_content = parent.content
+                        compacted += 1
+                    else:
+                        newer_content = apply_delta(parent.content_delta, newer_content)
+                    parent_id = parent.parent_id
+
+            processed += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f"Processed {processed}/{total} documents")
+
+        self.stdout.write(self.style.SUCCESS(f"Successfully compacted {compacted} older versions"))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from documents.models import TextDocument
+
+
+class Command(BaseCommand):
+    help = 'Computes token count, word count, sentence offsets and excerpts for documents in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of documents per batch')
+        parser.add_argument('--org_id', type=int, help='Only process documents of this organization')
+        parser.add_argument('--all', action='store_true', help='Recompute documents that already have statistics')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        documents = TextDocument.objects.exclude(plain_text='')
+        if options['org_id']:
+            documents = documents.filter(organization_id=options['org_id'])
+        if not options['all']:
+            documents = documents.filter(token_count=0)
+
+        total = documents.count()
+        self.stdout.write(f"Computing text statistics for {total} documents")
+
+        updated = 0
+        last_id = 0
+        while True:
+            # Walk the primary key so each batch is a cheap index range scan
+            batch = list(
+                documents.filter(id__gt=last_id).order_by('id').only('id', 'plain_text')[:batch_size]
+            )
+            if not batch:
+                break
+
+            for document in batch:
+                document.update_text_stats()
+            # bulk_update bypasses save(), so updated_at and the slug are left alone
+            TextDocument.objects.bulk_update(batch, ['token_count', 'word_count', 'sentence_offsets', 'excerpt'])
+
+            updated += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f"Updated {updated}/{total} documents")
+
+        self.stdout.write(self.style.SUCCESS(f"Successfully computed text statistics for {updated} documents"))
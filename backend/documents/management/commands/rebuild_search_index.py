@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from documents.models import TextDocument
+from documents.search import supports_full_text_search, document_search_vector, title_content_search_vector
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search vector for all documents in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of documents per batch')
+        parser.add_argument('--org_id', type=int, help='Only rebuild documents of this organization')
+
+    def handle(self, *args, **options):
+        if not supports_full_text_search():
+            self.stdout.write(self.style.WARNING(
+                'Full-text search requires PostgreSQL; this database uses icontains search, nothing to rebuild.'
+            ))
+            return
+
+        batch_size = options['batch_size']
+        documents = TextDocument.objects.all()
+        if options['org_id']:
+            documents = documents.filter(organization_id=options['org_id'])
+
+        total = documents.count()
+        self.stdout.write(f"Rebuilding search vectors for {total} documents")
+
+        updated = 0
+        last_id = 0
+        while True:
+            # Walk the primary key so each batch is a cheap index range scan
+            batch_ids = list(
+                documents.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not batch_ids:
+                break
+
+            updated += TextDocument.objects.filter(id__in=batch_ids).update(
+                search_vector=document_search_vector(),
+                title_content_vector=title_content_search_vector()
+            )
+            last_id = batch_ids[-1]
+            self.stdout.write(f"Updated {updated}/{total} documents")
+
+        self.stdout.write(self.style.SUCCESS(f"Successfully rebuilt search vectors for {updated} documents"))
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.10 on 2026-10-17 00:56
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+from documents.search import (
+    DROP_SEARCH_TRIGGER_SQL,
+    SEARCH_INDEX_SQL,
+    DROP_SEARCH_INDEX_SQL,
+)
+
+# The trigger as first created; documents.search holds the current one
+SEARCH_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION documents_textdocument_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('simple', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(NEW.tags::text, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(NEW.plain_text, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS documents_textdocument_search_vector_trigger ON documents_textdocument;
+CREATE TRIGGER documents_textdocument_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, tags, plain_text ON documents_textdocument
+    FOR EACH ROW EXECUTE PROCEDURE documents_textdocument_search_vector_update();
+"""
+
+
+def create_search_trigger(apps, schema_editor):
+    # Full-text search is PostgreSQL only; other backends fall back to icontains
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(SEARCH_TRIGGER_SQL)
+    schema_editor.execute(SEARCH_INDEX_SQL)
+    # Populate existing rows (the trigger fires on UPDATE OF title)
+    schema_editor.execute("UPDATE documents_textdocument SET title = title;")
+
+
+def drop_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(DROP_SEARCH_INDEX_SQL)
+    schema_editor.execute(DROP_SEARCH_TRIGGER_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0016_add_style_constraint_model'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textdocument',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True, verbose_name='Search Vector'),
+        ),
+        migrations.RunPython(create_search_trigger, drop_search_trigger),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.10 on 2026-10-17 00:57
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('accounts', '0011_user_marketing_consent'),
+        ('documents', '0017_textdocument_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackgroundJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True, verbose_name='UUID')),
+                ('job_type', models.CharField(choices=[('ai_generation', 'AI Document Generation')], max_length=30, verbose_name='Job Type')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=20, verbose_name='Status')),
+                ('parameters', models.JSONField(blank=True, default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='Parameters')),
+                ('result', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='Result')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Started At')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Finished At')),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='background_jobs', to=settings.AUTH_USER_MODEL, verbose_name='Created By')),
+                ('document', models.ForeignKey(blank=True, help_text='Document created by the job, if any', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='background_jobs', to='documents.textdocument', verbose_name='Document')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='background_jobs', to='accounts.organization', verbose_name='Organization')),
+            ],
+            options={
+                'verbose_name': 'Background Job',
+                'verbose_name_plural': 'Background Jobs',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['organization', 'status'], name='documents_b_organiz_1ce057_idx')],
+            },
+        ),
+    ]
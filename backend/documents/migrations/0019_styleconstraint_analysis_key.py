@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0018_backgroundjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='styleconstraint',
+            name='analysis_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64, verbose_name='Analysis Key'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:05
+
+from django.db import migrations, models
+
+# Context windows of the models we ship settings for; others keep the default
+KNOWN_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-3.5-turbo-0125': 16385,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+}
+
+
+def set_known_context_windows(apps, schema_editor):
+    AIModelSettings = apps.get_model('documents', 'AIModelSettings')
+    for model_name, context_window in KNOWN_CONTEXT_WINDOWS.items():
+        AIModelSettings.objects.filter(model_name=model_name).update(context_window=context_window)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0019_styleconstraint_analysis_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aimodelsettings',
+            name='context_window',
+            field=models.IntegerField(default=16385, help_text='Total tokens the model accepts (prompt and completion together)', verbose_name='Context Window'),
+        ),
+        migrations.AddField(
+            model_name='aimodelsettings',
+            name='reference_token_budget',
+            field=models.IntegerField(default=3000, help_text='Maximum tokens of reference documents included in a prompt', verbose_name='Reference Token Budget'),
+        ),
+        migrations.RunPython(set_known_context_windows, migrations.RunPython.noop),
+    ]
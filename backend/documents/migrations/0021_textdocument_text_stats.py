@@ -0,0 +1,28 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0020_aimodelsettings_prompt_budget'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textdocument',
+            name='sentence_offsets',
+            field=models.JSONField(blank=True, default=list, editable=False, help_text='Flat [end, tokens, ...] list: where each sentence of the plain text ends and the tokens up to there', verbose_name='Sentence Offsets'),
+        ),
+        migrations.AddField(
+            model_name='textdocument',
+            name='token_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Token Count'),
+        ),
+        migrations.AddField(
+            model_name='textdocument',
+            name='word_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Word Count'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0021_textdocument_text_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textdocument',
+            name='content_delta',
+            field=models.BinaryField(blank=True, help_text='Older versions only: compressed delta that rebuilds the content from the next version', null=True, verbose_name='Content Delta'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:18
+
+from django.db import migrations, models
+import uuid
+
+
+def assign_lineages(apps, schema_editor):
+    """Give every version chain one lineage and leave a single latest version in each."""
+    TextDocument = apps.get_model('documents', 'TextDocument')
+    lineages = {}
+    latest = {}
+    batch = []
+    # Parents always have a lower version than their children
+    for document in TextDocument.objects.order_by('version', 'id').only('id', 'parent_id', 'is_latest', 'version').iterator():
+        lineage = lineages.get(document.parent_id) or uuid.uuid4()
+        lineages[document.id] = lineage
+        document.lineage = lineage
+        if document.is_latest:
+            # Versions are visited in ascending order, so a later latest wins
+            previous = latest.get(lineage)
+            if previous is not None:
+                previous.is_latest = False
+            latest[lineage] = document
+        batch.append(document)
+
+    TextDocument.objects.bulk_update(batch, ['lineage', 'is_latest'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0022_textdocument_content_delta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textdocument',
+            name='lineage',
+            field=models.UUIDField(editable=False, help_text='Shared by all versions of a document', null=True, verbose_name='Lineage'),
+        ),
+        migrations.RunPython(assign_lineages, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='textdocument',
+            name='lineage',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, help_text='Shared by all versions of a document', verbose_name='Lineage'),
+        ),
+        migrations.AddIndex(
+            model_name='textdocument',
+            index=models.Index(fields=['lineage', 'version'], name='documents_t_lineage_a5a62f_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='textdocument',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_latest', True)), fields=('lineage',), name='unique_latest_version_per_lineage'),
+        ),
+    ]
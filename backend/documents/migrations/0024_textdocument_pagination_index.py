@@ -0,0 +1,17 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0023_textdocument_lineage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='textdocument',
+            index=models.Index(fields=['organization', '-updated_at', '-id'], name='documents_org_updated_idx'),
+        ),
+    ]
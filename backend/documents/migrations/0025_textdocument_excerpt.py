@@ -0,0 +1,27 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:21
+
+from django.db import migrations, models
+from django.db.models.functions import Substr
+
+
+def fill_excerpts(apps, schema_editor):
+    # One UPDATE instead of a pass over every row; compute_document_stats --all
+    # recomputes them on word boundaries
+    TextDocument = apps.get_model('documents', 'TextDocument')
+    TextDocument.objects.update(excerpt=Substr('plain_text', 1, 280))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0024_textdocument_pagination_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textdocument',
+            name='excerpt',
+            field=models.CharField(blank=True, editable=False, help_text='Start of the plain text, shown in document listings', max_length=280, verbose_name='Excerpt'),
+        ),
+        migrations.RunPython(fill_excerpts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_tags(apps, schema_editor):
+    # Mirror every document's tags list into DocumentTag rows, in chunks
+    TextDocument = apps.get_model('documents', 'TextDocument')
+    DocumentTag = apps.get_model('documents', 'DocumentTag')
+    links = []
+    documents = TextDocument.objects.exclude(tags=[]).values_list('id', 'organization_id', 'tags')
+    for document_id, organization_id, tags in documents.iterator(chunk_size=1000):
+        names = {tag for tag in (tags or []) if isinstance(tag, str) and tag and len(tag) <= 255}
+        links.extend(
+            DocumentTag(document_id=document_id, organization_id=organization_id, name=name)
+            for name in names
+        )
+        if len(links) >= 1000:
+            DocumentTag.objects.bulk_create(links, ignore_conflicts=True)
+            links = []
+    DocumentTag.objects.bulk_create(links, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_user_marketing_consent'),
+        ('documents', '0025_textdocument_excerpt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentTag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='Name')),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tag_links', to='documents.textdocument', verbose_name='Document')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.organization', verbose_name='Organization')),
+            ],
+            options={
+                'verbose_name': 'Document Tag',
+                'verbose_name_plural': 'Document Tags',
+                'indexes': [models.Index(fields=['organization', 'name'], name='documents_d_organiz_380daf_idx')],
+                'unique_together': {('document', 'name')},
+            },
+        ),
+        migrations.RunPython(link_tags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0026_documenttag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='processed',
+            field=models.PositiveIntegerField(default=0, verbose_name='Processed'),
+        ),
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='total',
+            field=models.PositiveIntegerField(default=0, verbose_name='Total'),
+        ),
+        migrations.AlterField(
+            model_name='backgroundjob',
+            name='job_type',
+            field=models.CharField(choices=[('ai_generation', 'AI Document Generation'), ('tag_rename', 'Tag Rename'), ('tag_merge', 'Tag Merge')], max_length=30, verbose_name='Job Type'),
+        ),
+    ]
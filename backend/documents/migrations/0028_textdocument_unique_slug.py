@@ -0,0 +1,35 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:34
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def separate_duplicate_slugs(apps, schema_editor):
+    # Concurrent creates could share a slug; all but the oldest document get
+    # a suffix from their lineage, on every version
+    TextDocument = apps.get_model('documents', 'TextDocument')
+    duplicates = TextDocument.objects.filter(is_latest=True).order_by().values('organization_id', 'slug').annotate(
+        total=Count('id')
+    ).filter(total__gt=1)
+    for duplicate in duplicates:
+        lineages = TextDocument.objects.filter(
+            is_latest=True, organization_id=duplicate['organization_id'], slug=duplicate['slug']
+        ).order_by('id').values_list('lineage', flat=True)
+        for lineage in list(lineages)[1:]:
+            slug = f"{(duplicate['slug'] or 'document')[:240]}-{lineage.hex[:8]}"
+            TextDocument.objects.filter(lineage=lineage).update(slug=slug)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0027_backgroundjob_progress'),
+    ]
+
+    operations = [
+        migrations.RunPython(separate_duplicate_slugs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='textdocument',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_latest', True)), fields=('organization', 'slug'), name='unique_latest_slug_per_organization'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0028_textdocument_unique_slug'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textdocument',
+            name='content_format',
+            field=models.CharField(blank=True, choices=[('html', 'HTML'), ('slate', 'Slate JSON'), ('markdown', 'Markdown')], editable=False, help_text='Format the content was detected as; empty until the renditions are stored', max_length=20, verbose_name='Content Format'),
+        ),
+        migrations.AddField(
+            model_name='textdocument',
+            name='content_html',
+            field=models.TextField(blank=True, editable=False, help_text='HTML rendition of the content', verbose_name='Content HTML'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0029_textdocument_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentpdfexport',
+            name='snapshot',
+            field=models.BinaryField(blank=True, help_text='Compressed payload frozen when the share was created; served instead of the live document', null=True, verbose_name='Snapshot'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-17 01:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0030_documentpdfexport_snapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backgroundjob',
+            name='job_type',
+            field=models.CharField(choices=[('ai_generation', 'AI Document Generation'), ('tag_rename', 'Tag Rename'), ('tag_merge', 'Tag Merge'), ('pdf_render', 'PDF Render')], max_length=30, verbose_name='Job Type'),
+        ),
+    ]
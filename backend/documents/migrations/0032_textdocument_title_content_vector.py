@@ -0,0 +1,52 @@
+# Generated by Django 4.2.10 on 2026-10-17 02:05
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+from documents.search import SEARCH_TRIGGER_SQL, TITLE_CONTENT_INDEX_SQL, DROP_TITLE_CONTENT_INDEX_SQL
+
+# The trigger before it also maintained title_content_vector
+PREVIOUS_SEARCH_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION documents_textdocument_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('simple', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(NEW.tags::text, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(NEW.plain_text, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+
+def create_title_content_vector(apps, schema_editor):
+    # Full-text search is PostgreSQL only; other backends fall back to icontains
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(SEARCH_TRIGGER_SQL)
+    schema_editor.execute(TITLE_CONTENT_INDEX_SQL)
+    # Populate existing rows (the trigger fires on UPDATE OF title)
+    schema_editor.execute("UPDATE documents_textdocument SET title = title;")
+
+
+def drop_title_content_vector(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(DROP_TITLE_CONTENT_INDEX_SQL)
+    schema_editor.execute(PREVIOUS_SEARCH_TRIGGER_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0031_backgroundjob_pdf_render'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textdocument',
+            name='title_content_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True, verbose_name='Title and Content Vector'),
+        ),
+        migrations.RunPython(create_title_content_vector, drop_title_content_vector),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.10 on 2026-10-17 02:09
+
+from django.db import migrations, models
+
+
+def copy_artifacts(apps, schema_editor):
+    """Move the artifact name of existing render jobs out of their parameters."""
+    BackgroundJob = apps.get_model('documents', 'BackgroundJob')
+    for job in BackgroundJob.objects.filter(job_type='pdf_render').only('id', 'parameters'):
+        job.artifact = job.parameters.pop('artifact', '')
+        job.save(update_fields=['artifact', 'parameters'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0032_textdocument_title_content_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='artifact',
+            field=models.CharField(blank=True, db_index=True, max_length=255, verbose_name='Artifact'),
+        ),
+        migrations.RunPython(copy_artifacts, migrations.RunPython.noop),
+    ]
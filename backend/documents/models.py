@@ -1,13 +1,33 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth import get_user_model
-from django.utils.text import slugify
+from django.contrib.postgres.search import SearchVectorField
+from django.core.serializers.json import DjangoJSONEncoder
 import uuid
 from datetime import timedelta
 from django.utils import timezone
 
+from .content import FORMAT_CHOICES as CONTENT_FORMAT_CHOICES, render_content
+
 User = get_user_model()
 
+# Characters of plain text kept as a preview for document listings
+EXCERPT_LENGTH = 280
+
+# Columns that decide which category document counts a document is part of
+CATEGORY_COUNT_FIELDS = ('category_id', 'status', 'is_latest')
+
+
+def make_excerpt(text, length=EXCERPT_LENGTH):
+    """Cut a text to a preview of at most `length` characters, ending on a whole word."""
+    text = text or ''
+    if len(text) <= length:
+        return text
+    cut = text[:length - 1]
+    if ' ' in cut:
+        cut = cut[:cut.rindex(' ')]
+    return cut.rstrip() + '…'
+
 class AIModelSettings(models.Model):
     """Settings for AI model parameters"""
     model_name = models.CharField(_("Model Name"), max_length=50, unique=True, 
@@ -23,6 +43,14 @@ class AIModelSettings(models.Model):
         _("Analysis Temperature"),
         default=0.7,
         help_text=_("Controls randomness for style analysis: 0.0 is deterministic, 1.0+ is very creative"))
+    context_window = models.IntegerField(
+        _("Context Window"),
+        default=16385,
+        help_text=_("Total tokens the model accepts (prompt and completion together)"))
+    reference_token_budget = models.IntegerField(
+        _("Reference Token Budget"),
+        default=3000,
+        help_text=_("Maximum tokens of reference documents included in a prompt"))
     is_active = models.BooleanField(_("Is Active"), default=True)
     is_default = models.BooleanField(_("Is Default"), default=False,
                                     help_text=_("If checked, this model will be used as the default"))
@@ -82,7 +110,39 @@ class TextDocument(models.Model):
     """
     title = models.CharField(_("Title"), max_length=255)
     content = models.TextField(_("Content"), default="", help_text=_("Markdown content"))
+    
+    # Detected and rendered from content on save (see documents.content)
+    content_format = models.CharField(
+        _("Content Format"),
+        max_length=20,
+        choices=CONTENT_FORMAT_CHOICES,
+        blank=True,
+        editable=False,
+        help_text=_("Format the content was detected as; empty until the renditions are stored")
+    )
+    content_html = models.TextField(_("Content HTML"), blank=True, editable=False, help_text=_("HTML rendition of the content"))
     plain_text = models.TextField(_("Plain Text"), blank=True, help_text=_("Plain text version for search"))
+    # Maintained by a database trigger on PostgreSQL (see documents.search); unused elsewhere
+    search_vector = SearchVectorField(_("Search Vector"), null=True, blank=True, editable=False)
+    title_content_vector = SearchVectorField(_("Title and Content Vector"), null=True, blank=True, editable=False)
+    
+    # Derived from plain_text on save (see documents.tokens) so prompts can be packed without tokenizing
+    token_count = models.PositiveIntegerField(_("Token Count"), default=0, editable=False)
+    word_count = models.PositiveIntegerField(_("Word Count"), default=0, editable=False)
+    excerpt = models.CharField(
+        _("Excerpt"),
+        max_length=EXCERPT_LENGTH,
+        blank=True,
+        editable=False,
+        help_text=_("Start of the plain text, shown in document listings")
+    )
+    sentence_offsets = models.JSONField(
+        _("Sentence Offsets"),
+        default=list,
+        blank=True,
+        editable=False,
+        help_text=_("Flat [end, tokens, ...] list: where each sentence of the plain text ends and the tokens up to there")
+    )
     
     # Metadata
     created_by = models.ForeignKey(
@@ -119,6 +179,18 @@ class TextDocument(models.Model):
         help_text=_("Previous version of this document")
     )
     is_latest = models.BooleanField(_("Is Latest Version"), default=True)
+    lineage = models.UUIDField(
+        _("Lineage"),
+        default=uuid.uuid4,
+        editable=False,
+        help_text=_("Shared by all versions of a document")
+    )
+    content_delta = models.BinaryField(
+        _("Content Delta"),
+        null=True,
+        blank=True,
+        help_text=_("Older versions only: compressed delta that rebuilds the content from the next version")
+    )
     
     # Timestamps
     created_at = models.DateTimeField(_("Created At"), auto_now_add=True)
@@ -145,127 +217,153 @@ class TextDocument(models.Model):
             models.Index(fields=['category']),
             models.Index(fields=['created_by']),
             models.Index(fields=['updated_at']),
+            models.Index(fields=['lineage', 'version']),
+            # Keyset pagination of an organization's documents (see documents.pagination)
+            models.Index(fields=['organization', '-updated_at', '-id'], name='documents_org_updated_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['lineage'],
+                condition=models.Q(is_latest=True),
+                name='unique_latest_version_per_lineage'
+            ),
+            # Versions share their document's slug; the allocator in documents.slugs relies on this
+            models.UniqueConstraint(
+                fields=['organization', 'slug'],
+                condition=models.Q(is_latest=True),
+                name='unique_latest_slug_per_organization'
+            ),
         ]
     
     def __str__(self):
         return self.title
     
-    def save(self, *args, **kwargs):
-        # Generate slug if not provided
-        if not self.slug:
-            self.slug = slugify(self.title)
-            
-            # Check for duplicates and make slug unique if needed
-            original_slug = self.slug
-            counter = 1
-            while TextDocument.objects.filter(
-                organization=self.organization, 
-                slug=self.slug
-            ).exclude(pk=self.pk).exists():
-                # Add a random suffix to make the slug unique
-                import random
-                import string
-                random_suffix = ''.join(random.choices(string.ascii_lowercase + string.digits, k=4))
-                self.slug = f"{original_slug}-{random_suffix}"
-                counter += 1
-                if counter > 10:  # Safety check to prevent infinite loops
-                    break
-        
-        # Extract plain text from content for search
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored content so save() only recomputes text statistics on change
+        if 'content' in field_names:
+            instance._loaded_content = values[field_names.index('content')]
+        # Likewise tags and status, which decide the tag links and tag counts
+        if 'tags' in field_names and 'status' in field_names:
+            instance._loaded_tags = values[field_names.index('tags')]
+            instance._loaded_status = values[field_names.index('status')]
+        # And the fields that decide which category counts the document is part of
+        if all(name in field_names for name in CATEGORY_COUNT_FIELDS):
+            instance._loaded_category_counts = tuple(values[field_names.index(name)] for name in CATEGORY_COUNT_FIELDS)
+        return instance
+    
+    def _category_counts_key(self):
+        return tuple(getattr(self, name) for name in CATEGORY_COUNT_FIELDS)
+    
+    def _category_counts_changed(self, update_fields=None):
+        """Check whether a save changes the category counts, i.e. category, status or is_latest."""
+        if update_fields is not None and not {'category', *CATEGORY_COUNT_FIELDS} & set(update_fields):
+            return False
+        if set(CATEGORY_COUNT_FIELDS) & self.get_deferred_fields():
+            return False
+        if not hasattr(self, '_loaded_category_counts'):
+            return True
+        return self._category_counts_key() != self._loaded_category_counts
+    
+    def _tags_changed(self):
+        """Check whether tags or status differ from the stored row."""
+        if {'tags', 'status'} & self.get_deferred_fields():
+            return False
+        if not hasattr(self, '_loaded_tags'):
+            return True
+        return self.tags != self._loaded_tags or self.status != self._loaded_status
+    
+    def _content_changed(self):
+        """Check whether content differs from the stored row (or stats were never computed)."""
+        if 'content' in self.get_deferred_fields():
+            return False
+        if self._state.adding or not hasattr(self, '_loaded_content'):
+            return True
+        if 'content_format' not in self.get_deferred_fields() and not self.content_format:
+            return True
+        return self.content != self._loaded_content or bool(self.plain_text and not self.token_count)
+    
+    def update_renditions(self):
+        """Parse the content once and store its format, HTML and plain text."""
+        renditions = render_content(self.content)
+        self.content_format = renditions.content_format
+        self.content_html = renditions.html
         if self.content:
-            self.plain_text = self._extract_plain_text(self.content)
-        
-        super().save(*args, **kwargs)
+            self.plain_text = renditions.plain_text
     
-    def _extract_plain_text(self, content):
-        """
-        Extract plain text from content.
-        Handles Markdown, HTML, and Slate.js JSON formats.
-        """
-        if not content:
-            return ""
-        
-        # Check if content looks like HTML (starts with an HTML tag)
-        import re
-        if re.search(r'^\s*<[a-zA-Z]+[^>]*>', content):
-            # Process HTML content
-            # Remove all HTML tags but keep their content
-            plain_text = re.sub(r'<[^>]*>', ' ', content)
-            # Replace multiple spaces with a single space
-            plain_text = re.sub(r'\s+', ' ', plain_text)
-            return plain_text.strip()
-            
-        # Try to handle the case where content might still be in Slate.js JSON format
-        # during the transition period
-        if isinstance(content, (dict, list)) or (isinstance(content, str) and content.startswith('[')):
-            try:
-                # If it's a string that looks like JSON, try to parse it
-                if isinstance(content, str) and (content.startswith('[') or content.startswith('{')):
-                    import json
-                    parsed_content = json.loads(content)
-                else:
-                    parsed_content = content
-                
-                # Use the old method for Slate.js content
-                text = []
-                
-                def extract_text_from_node(node):
-                    if isinstance(node, dict):
-                        # If it's a leaf node with text
-                        if 'text' in node:
-                            return node['text']
-                        
-                        # If it's an element with children
-                        if 'children' in node:
-                            return ' '.join(extract_text_from_node(child) for child in node['children'])
-                        
-                        return ''
-                    
-                    # If it's a list of nodes
-                    elif isinstance(node, list):
-                        return ' '.join(extract_text_from_node(child) for child in node)
-                    
-                    return ''
-                
-                # Handle both array and object formats
-                if isinstance(parsed_content, list):
-                    for node in parsed_content:
-                        text.append(extract_text_from_node(node))
-                elif isinstance(parsed_content, dict):
-                    text.append(extract_text_from_node(parsed_content))
-                
-                return ' '.join(text).strip()
-            except:
-                # If parsing fails, treat as Markdown
-                pass
-        
-        # Process Markdown content
-        # Remove common Markdown syntax
-        plain_text = content
-        
-        # Remove headers (# Header)
-        plain_text = re.sub(r'^#+\s+', '', plain_text, flags=re.MULTILINE)
-        
-        # Remove bold and italic markers
-        plain_text = plain_text.replace('**', '').replace('__', '').replace('*', '').replace('_', '')
-        
-        # Remove link syntax but keep the text
-        plain_text = re.sub(r'\[([^\]]+)\]\([^)]+\)', r'\1', plain_text)
+    @property
+    def rendered_html(self):
+        """HTML rendition of the content (rendered here for rows stored before renditions were)."""
+        if not self.content_format:
+            return render_content(self.content).html
+        return self.content_html
+    
+    def update_text_stats(self):
+        """Compute token count, word count, sentence offsets and the excerpt from plain_text."""
+        from .tokens import text_stats
+        self.token_count, self.word_count, self.sentence_offsets = text_stats(self.plain_text)
+        self.excerpt = make_excerpt(self.plain_text)
+    
+    def restore_content(self):
+        """Rebuild the content of an older version stored as a delta (see documents.versioning)."""
+        if self.content_delta is None or getattr(self, '_content_restored', False):
+            return
+        from .versioning import rebuild_content
+        self.content = rebuild_content(self)
+        self.update_renditions()
+        self.excerpt = self.excerpt or make_excerpt(self.plain_text)
+        self._loaded_content = self.content
+        self._content_restored = True
+    
+    def save(self, *args, **kwargs):
+        # An older version stored as a delta needs its old content to keep the chain intact
+        stored_as_delta = self.content_delta is not None and not self._state.adding
+        if stored_as_delta and not getattr(self, '_content_restored', False) and self._content_changed():
+            content = self.content
+            self.restore_content()
+            self.content = content
+        previous_content = getattr(self, '_loaded_content', None)
+        inserting = self._state.adding or self.pk is None
+        tags_changed = inserting or self._tags_changed()
+        # Read by the category tree signal (see categories.signals)
+        self.category_counts_changed = inserting or self._category_counts_changed(kwargs.get('update_fields'))
         
-        # Remove code blocks but keep the content
-        plain_text = re.sub(r'```[a-z]*\n([\s\S]*?)\n```', r'\1', plain_text)
+        # Slugs are allocated while saving (see documents.slugs)
+        allocate_slug = not self.slug
         
-        # Remove inline code but keep the content
-        plain_text = re.sub(r'`([^`]+)`', r'\1', plain_text)
+        # Derive the renditions and text statistics only when the content changed
+        update_fields = kwargs.get('update_fields')
+        if (update_fields is None or 'content' in update_fields) and self._content_changed():
+            self.update_renditions()
+            self.update_text_stats()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {
+                    'content_format', 'content_html', 'plain_text',
+                    'token_count', 'word_count', 'sentence_offsets', 'excerpt'
+                }
         
-        # Remove blockquotes
-        plain_text = re.sub(r'^>\s+', '', plain_text, flags=re.MULTILINE)
+        if allocate_slug:
+            from .slugs import save_with_slug
+            save_with_slug(self, self.title, super().save, *args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
         
-        # Remove list markers
-        plain_text = re.sub(r'^[\*\-+]\s+', '', plain_text, flags=re.MULTILINE)
-        plain_text = re.sub(r'^\d+\.\s+', '', plain_text, flags=re.MULTILINE)
+        # Keep older versions stored as deltas against the content just saved
+        if (stored_as_delta and getattr(self, '_content_restored', False)) or \
+                (self.parent_id and previous_content is not None and previous_content != self.content):
+            from .versioning import content_saved
+            content_saved(self, previous_content)
+        self._loaded_content = self.content
+        if not self.get_deferred_fields() & set(CATEGORY_COUNT_FIELDS):
+            self._loaded_category_counts = self._category_counts_key()
         
-        return plain_text.strip()
+        # Mirror the tags list into indexed tag links and keep the tag counts current
+        if tags_changed:
+            from .tags import sync_document_tags
+            sync_document_tags(self, getattr(self, '_loaded_tags', None), inserted=inserting)
+            self._loaded_tags = self.tags
+            self._loaded_status = self.status
     
     def create_new_version(self):
         """
@@ -273,20 +371,54 @@ class TextDocument(models.Model):
         """
         # Set all previous versions to not be the latest
         if self.is_latest:
-            # Create a new version
-            old_pk = self.pk
-            self.pk = None
-            self.version += 1
-            self.parent_id = old_pk
-            self.save()
-            
-            # Update the old version
-            TextDocument.objects.filter(pk=old_pk).update(is_latest=False)
+            from .versioning import compact_version
+            with transaction.atomic():
+                # Update the old version first (only one latest per lineage),
+                # keeping only a delta against the new one
+                old_pk = self.pk
+                compact_version(old_pk, self.content, self.content, is_latest=False)
+                
+                # Create a new version in the same lineage
+                self.pk = None
+                self.version += 1
+                self.parent_id = old_pk
+                self.save()
             
             return self
         return None
 
 
+class DocumentTag(models.Model):
+    """
+    One row per tag on a document, mirroring TextDocument.tags (see
+    documents.tags) so tag filters and counts can use an index.
+    """
+    document = models.ForeignKey(
+        TextDocument,
+        on_delete=models.CASCADE,
+        related_name='tag_links',
+        verbose_name=_("Document")
+    )
+    organization = models.ForeignKey(
+        'accounts.Organization',
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name=_("Organization")
+    )
+    name = models.CharField(_("Name"), max_length=255)
+    
+    class Meta:
+        verbose_name = _("Document Tag")
+        verbose_name_plural = _("Document Tags")
+        unique_together = [['document', 'name']]
+        indexes = [
+            models.Index(fields=['organization', 'name']),
+        ]
+    
+    def __str__(self):
+        return f"{self.name} on {self.document_id}"
+
+
 class Comment(models.Model):
     """
     Model for document comments.
@@ -357,6 +489,13 @@ class DocumentPDFExport(models.Model):
     expiration_type = models.CharField(_("Expiration Type"), max_length=10, choices=EXPIRATION_CHOICES, default='1w')
     pin_protected = models.BooleanField(_("PIN Protected"), default=False)
     pin_code = models.CharField(_("PIN Code"), max_length=4, blank=True, null=True)
+    snapshot = models.BinaryField(
+        _("Snapshot"),
+        null=True,
+        blank=True,
+        editable=False,
+        help_text=_("Compressed payload frozen when the share was created; served instead of the live document")
+    )
     
     class Meta:
         verbose_name = _("Document PDF Export")
@@ -436,6 +575,9 @@ class StyleConstraint(models.Model):
     )
     is_active = models.BooleanField(_("Is Active"), default=True)
     
+    # Hash of the reference text, prompt templates and model settings the analysis was made from
+    analysis_key = models.CharField(_("Analysis Key"), max_length=64, blank=True, db_index=True, editable=False)
+    
     class Meta:
         verbose_name = _("Style Constraint")
         verbose_name_plural = _("Style Constraints")
@@ -501,30 +643,123 @@ class AIPromptTemplate(models.Model):
         """
         Get the appropriate template for the given type and organization.
         First tries to find an organization-specific template, then falls back to a global one.
+        Templates are cached per process and invalidated on save/delete (see documents.ai_config).
         """
+        from .ai_config import get_prompt_template
         try:
-            # First try to find an organization-specific template
-            if organization:
-                template = cls.objects.filter(
-                    template_type=template_type,
-                    organization=organization,
-                    is_active=True
-                ).first()
-                
-                if template:
-                    return template.content
-            
-            # Fall back to a global template
-            template = cls.objects.filter(
-                template_type=template_type,
-                organization__isnull=True,
-                is_active=True
-            ).first()
-            
-            if template:
-                return template.content
-                
-            return None
+            return get_prompt_template(template_type, organization)
         except Exception as e:
             print(f"Error retrieving AI template: {str(e)}")
             return None
+
+
+class BackgroundJob(models.Model):
+    """
+    Model for tracking long-running work handed off to Celery.
+    Clients poll the job by UUID until it is done or failed.
+    """
+    # Job types
+    TYPE_CHOICES = [
+        ('ai_generation', _('AI Document Generation')),
+        ('tag_rename', _('Tag Rename')),
+        ('tag_merge', _('Tag Merge')),
+        ('pdf_render', _('PDF Render')),
+    ]
+    
+    # Job statuses
+    STATUS_CHOICES = [
+        ('queued', _('Queued')),
+        ('running', _('Running')),
+        ('done', _('Done')),
+        ('failed', _('Failed')),
+    ]
+    
+    uuid = models.UUIDField(_("UUID"), default=uuid.uuid4, editable=False, unique=True)
+    job_type = models.CharField(_("Job Type"), max_length=30, choices=TYPE_CHOICES)
+    status = models.CharField(_("Status"), max_length=20, choices=STATUS_CHOICES, default='queued')
+    
+    organization = models.ForeignKey(
+        'accounts.Organization',
+        on_delete=models.CASCADE,
+        related_name='background_jobs',
+        verbose_name=_("Organization")
+    )
+    created_by = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='background_jobs',
+        verbose_name=_("Created By")
+    )
+    
+    # Input parameters and outcome
+    parameters = models.JSONField(_("Parameters"), default=dict, blank=True, encoder=DjangoJSONEncoder)
+    result = models.JSONField(_("Result"), null=True, blank=True, encoder=DjangoJSONEncoder)
+    error = models.TextField(_("Error"), blank=True)
+    
+    # Storage name of the PDF a pdf_render job produces; indexed so a request joins a pending render
+    artifact = models.CharField(_("Artifact"), max_length=255, blank=True, db_index=True)
+    
+    # Progress of jobs that work through many items (e.g. documents retagged)
+    total = models.PositiveIntegerField(_("Total"), default=0)
+    processed = models.PositiveIntegerField(_("Processed"), default=0)
+    
+    document = models.ForeignKey(
+        TextDocument,
+        on_delete=models.SET_NULL,
+        related_name='background_jobs',
+        verbose_name=_("Document"),
+        null=True,
+        blank=True,
+        help_text=_("Document created by the job, if any")
+    )
+    
+    # Timestamps
+    created_at = models.DateTimeField(_("Created At"), auto_now_add=True)
+    started_at = models.DateTimeField(_("Started At"), null=True, blank=True)
+    finished_at = models.DateTimeField(_("Finished At"), null=True, blank=True)
+    
+    class Meta:
+        verbose_name = _("Background Job")
+        verbose_name_plural = _("Background Jobs")
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['organization', 'status']),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_job_type_display()} {self.uuid} ({self.status})"
+    
+    @classmethod
+    def claim(cls, job_uuid, *related):
+        """
+        Mark a queued job as picked up by a worker and return it (with `related`
+        loaded), or None if it is gone or another delivery already claimed it.
+        The claim is one conditional UPDATE, so duplicate deliveries cannot both run.
+        """
+        claimed = cls.objects.filter(uuid=job_uuid, status='queued').update(
+            status='running', started_at=timezone.now()
+        )
+        if not claimed:
+            return None
+        return cls.objects.select_related(*related).get(uuid=job_uuid)
+    
+    def mark_progress(self, processed):
+        """Record how many items the job has worked through."""
+        self.processed = processed
+        self.save(update_fields=['processed'])
+    
+    def mark_done(self, result=None, document=None):
+        """Mark the job as finished successfully."""
+        self.status = 'done'
+        self.result = result
+        self.document = document
+        self.finished_at = timezone.now()
+        self.save(update_fields=['status', 'result', 'document', 'finished_at'])
+    
+    def mark_failed(self, error, result=None):
+        """Mark the job as failed with an error message."""
+        self.status = 'failed'
+        self.error = error
+        self.result = result
+        self.finished_at = timezone.now()
+        self.save(update_fields=['status', 'error', 'result', 'finished_at'])
@@ -0,0 +1,75 @@
+"""
+Pagination for document listings.
+
+Documents are paged with a keyset cursor on (updated_at, id): every page is
+an index range scan, so deep pages cost the same as the first one and no
+COUNT(*) is run. Clients that send ?page= keep the page-number responses
+(with count) they already rely on.
+"""
+
+from rest_framework.pagination import BasePagination, CursorPagination, PageNumberPagination
+
+DOCUMENT_PAGE_SIZE = 100
+MAX_DOCUMENT_PAGE_SIZE = 500
+
+
+class DocumentCursorPagination(CursorPagination):
+    page_size = DOCUMENT_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = MAX_DOCUMENT_PAGE_SIZE
+    ordering = ('-updated_at', '-id')
+
+
+class DocumentPageNumberPagination(PageNumberPagination):
+    page_size = DOCUMENT_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = MAX_DOCUMENT_PAGE_SIZE
+
+
+class DocumentPagination(BasePagination):
+    """
+    Cursor pagination, or page numbers when the request has a ?page= parameter.
+    Full-text search results are ordered by rank, which a cursor can't follow,
+    so they are always paged by number.
+    """
+
+    def __init__(self, ordering=None):
+        self.cursor_paginator = DocumentCursorPagination()
+        if ordering:
+            self.cursor_paginator.ordering = ordering
+        self.page_paginator = DocumentPageNumberPagination()
+        self.paginator = self.cursor_paginator
+
+    def uses_page_numbers(self, queryset, request):
+        if self.page_paginator.page_query_param in request.query_params:
+            return True
+        query = getattr(queryset, 'query', None)
+        return query is not None and 'search_rank' in query.annotations
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.uses_page_numbers(queryset, request):
+            self.paginator = self.page_paginator
+        else:
+            self.paginator = self.cursor_paginator
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        return self.cursor_paginator.get_paginated_response_schema(schema)
+
+
+def paginate_documents(request, documents, serializer_class, ordering=None, context=None):
+    """
+    Page a document queryset for an extra action (which can't use the
+    viewset's own paginator) and return the paginated Response. Ordering
+    comes from the cursor, not from the viewset's ordering filter.
+    """
+    paginator = DocumentPagination(ordering=ordering)
+    documents = documents.order_by(*paginator.cursor_paginator.ordering)
+    if hasattr(serializer_class, 'setup_eager_loading'):
+        documents = serializer_class.setup_eager_loading(documents)
+    page = paginator.paginate_queryset(documents, request)
+    serializer = serializer_class(page, many=True, context=context or {'request': request})
+    return paginator.get_paginated_response(serializer.data)
@@ -0,0 +1,210 @@
+"""
+Server-side PDF rendering.
+
+PDFs are rendered from a document's stored HTML rendition by a Celery task
+on its own queue (see CELERY_TASK_ROUTES), so a separately sized worker
+bounds how many renders run at once. Each PDF is stored once in the
+default storage, named after the document id, version, last save and
+render options; a download whose artifact exists is served from storage
+without rendering again. Snapshot shares get their own artifacts, rendered
+from the snapshot.
+"""
+
+import html
+from datetime import timedelta
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.http import FileResponse
+from django.utils import timezone
+
+from .models import BackgroundJob, DocumentPDFExport, TextDocument
+
+PDF_RENDER_DIR = 'pdf-renders'
+
+PAGE_SIZES = ('A4', 'Letter', 'Legal')
+ORIENTATIONS = ('portrait', 'landscape')
+
+DEFAULT_RENDER_OPTIONS = {'page_size': 'A4', 'orientation': 'portrait'}
+
+# Seconds a share client should wait before asking again for a PDF being rendered
+PDF_RETRY_AFTER = 5
+
+# Seconds a render job may wait for a worker before it is assumed lost and queued again
+PDF_QUEUE_TIMEOUT = 30 * 60
+
+PDF_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+@page {{ size: {page_size} {orientation}; margin: 2cm; }}
+body {{ font-family: serif; font-size: 11pt; line-height: 1.5; }}
+h1.document-title {{ font-size: 20pt; margin: 0 0 1em; }}
+img {{ max-width: 100%; }}
+pre {{ white-space: pre-wrap; }}
+</style>
+</head>
+<body>
+<h1 class="document-title">{title}</h1>
+{content}
+</body>
+</html>
+"""
+
+
+def clean_render_options(data):
+    """Render options from request parameters; unknown values fall back to the defaults."""
+    options = dict(DEFAULT_RENDER_OPTIONS)
+    page_size = data.get('page_size')
+    if page_size in PAGE_SIZES:
+        options['page_size'] = page_size
+    orientation = data.get('orientation')
+    if orientation in ORIENTATIONS:
+        options['orientation'] = orientation
+    return options
+
+
+def artifact_name(document, options, pdf_export=None):
+    """Storage name of a document's PDF for the given options, or of a snapshot share's PDF."""
+    suffix = f"{options['page_size']}-{options['orientation']}".lower()
+    if pdf_export is not None and pdf_export.snapshot:
+        return f"{PDF_RENDER_DIR}/{pdf_export.document_id}/share-{pdf_export.uuid.hex}-{suffix}.pdf"
+    # Documents are edited in place without a new version, so the last save is part of the name
+    return f"{PDF_RENDER_DIR}/{document.id}/{document.version}-{document.updated_at:%Y%m%d%H%M%S%f}-{suffix}.pdf"
+
+
+def pdf_url_fetcher(url, timeout=10, ssl_context=None):
+    """
+    Load only inline data: URLs into PDFs. Document HTML is written by users,
+    so any other URL (file://, or http(s) to the internal network) is refused
+    rather than read by the worker into a PDF that may be shared publicly.
+    """
+    if urlsplit(url).scheme.lower() != 'data':
+        raise ValueError(f"PDFs do not load external resources: {url[:100]}")
+    with urlopen(url) as response:
+        return {'string': response.read(), 'mime_type': response.headers.get_content_type()}
+
+
+def html_to_pdf(html_document):
+    """Render an HTML page to PDF bytes."""
+    try:
+        from weasyprint import HTML
+    except ImportError:
+        raise RuntimeError("Server-side PDF rendering needs WeasyPrint, which is not installed.")
+    # WeasyPrint leaves out resources whose fetch fails
+    return HTML(string=html_document, url_fetcher=pdf_url_fetcher).write_pdf()
+
+
+def render_artifact(job):
+    """Render and store the PDF a render job was queued for; returns its storage name."""
+    name = job.artifact
+    # Duplicate deliveries, or a job queued while another was rendering the same PDF
+    if default_storage.exists(name):
+        return name
+
+    parameters = job.parameters
+    options = parameters['options']
+    if parameters.get('share'):
+        from .sharing import read_snapshot
+
+        snapshot = read_snapshot(DocumentPDFExport.objects.get(uuid=parameters['share']).snapshot)
+        title, content = snapshot['document_title'], snapshot['payload']['html_content']
+        document = None
+    else:
+        document = TextDocument.objects.get(pk=parameters['document_id'])
+        document.restore_content()
+        title, content = document.title, document.rendered_html
+        # Saved again since the job was queued: store it under the name of what is rendered
+        name = artifact_name(document, options)
+
+    pdf = html_to_pdf(PDF_TEMPLATE.format(
+        title=html.escape(title),
+        content=content,
+        page_size=options['page_size'],
+        orientation=options['orientation'],
+    ))
+    saved = default_storage.save(name, ContentFile(pdf))
+    # Another worker stored the same PDF first; storage kept both under different names
+    if saved != name:
+        default_storage.delete(saved)
+    if document is not None:
+        prune_artifacts(document.id, keep=name)
+    return name
+
+
+def prune_artifacts(document_id, keep):
+    """Delete a document's PDFs of earlier saves; snapshot share PDFs are kept."""
+    directory = f"{PDF_RENDER_DIR}/{document_id}"
+    current = keep.rsplit('/', 1)[-1].rsplit('-', 2)[0]
+    try:
+        _, files = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for filename in files:
+        if not filename.startswith(('share-', f"{current}-")):
+            default_storage.delete(f"{directory}/{filename}")
+
+
+def delete_artifacts(document_id):
+    """Delete every PDF rendered for a document."""
+    directory = f"{PDF_RENDER_DIR}/{document_id}"
+    try:
+        _, files = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for filename in files:
+        default_storage.delete(f"{directory}/{filename}")
+
+
+def start_pdf_render(document, options, organization_id, user_id, pdf_export=None):
+    """
+    Queue a render of the PDF named by artifact_name(), unless one is already
+    queued or running. Returns the BackgroundJob.
+    """
+    from .tasks import PDF_RENDER_SOFT_TIME_LIMIT, run_pdf_render_job
+
+    name = artifact_name(document, options, pdf_export)
+    job = BackgroundJob.objects.filter(
+        artifact=name, job_type='pdf_render', status__in=['queued', 'running']
+    ).first()
+    if job is not None:
+        # A running job past the hard time limit lost its worker; a queued one
+        # waiting much longer than a busy queue would take is never picked up
+        if job.status == 'running':
+            stale = timezone.now() - job.started_at > timedelta(seconds=PDF_RENDER_SOFT_TIME_LIMIT + 30)
+        else:
+            stale = timezone.now() - job.created_at > timedelta(seconds=PDF_QUEUE_TIMEOUT)
+        if not stale:
+            return job
+        job.mark_failed("PDF rendering did not finish in time.")
+
+    share = pdf_export if pdf_export is not None and pdf_export.snapshot else None
+    job = BackgroundJob.objects.create(
+        job_type='pdf_render',
+        organization_id=organization_id,
+        created_by_id=user_id,
+        artifact=name,
+        parameters={
+            'document_id': document.id,
+            'share': str(share.uuid) if share else None,
+            'options': options,
+        }
+    )
+
+    try:
+        run_pdf_render_job.delay(str(job.uuid))
+    except Exception as e:
+        print(f"Error queueing PDF render job {job.uuid}: {str(e)}")
+        job.mark_failed(f"Could not queue PDF render job: {str(e)}")
+    return job
+
+
+def pdf_response(name, filename):
+    """Serve a stored PDF as a download."""
+    return FileResponse(
+        default_storage.open(name, 'rb'), as_attachment=True, filename=filename, content_type='application/pdf'
+    )
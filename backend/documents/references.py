@@ -0,0 +1,164 @@
+"""
+Packing of reference documents into a prompt token budget.
+
+The budget is shared fairly: documents that need less than an equal share are
+included whole and the rest is split between the longer ones, which are cut
+at sentence boundaries. Documents carry precomputed sentence offsets and token
+counts (see TextDocument.update_text_stats); for those that don't, only the
+part that can fit is tokenized, so packing stays cheap either way.
+
+Reference documents are selected in the database and loaded with only the
+fields a prompt needs, so generation doesn't load whole organizations.
+"""
+
+import math
+from bisect import bisect_right
+
+from .tags import filter_by_tags
+from .tokens import CHARS_PER_TOKEN, count_tokens, offset_pairs, sentence_token_offsets, truncate_to_tokens
+
+DOCUMENT_SEPARATOR = "\n---\n"
+
+# Upper bound on the number of documents considered for a prompt
+MAX_CANDIDATE_DOCUMENTS = 50
+
+# Below this a reference says little about style, so fewer documents get more room
+MIN_TOKENS_PER_DOCUMENT = 150
+
+# Tokens kept free for the prompt template, formatting instructions and style guide
+PROMPT_RESERVE_TOKENS = 2000
+
+# Characters tokenized per token of share; generous so a share is never under-filled
+WINDOW_CHARS_PER_TOKEN = 8
+
+# Fields loaded for reference documents; content and version data stay in the database
+REFERENCE_FIELDS = (
+    'id', 'organization_id', 'title', 'plain_text', 'category_id', 'status',
+    'updated_at', 'token_count', 'sentence_offsets',
+)
+
+
+def select_reference_documents(queryset, category_id=None, status=None, tags=None):
+    """
+    Narrow a document queryset to the generation filters and defer everything
+    a prompt doesn't use. Nothing is fetched until the result is evaluated.
+    """
+    if category_id:
+        queryset = queryset.filter(category_id=category_id)
+    if status:
+        queryset = queryset.filter(status=status)
+    if tags:
+        queryset = filter_by_tags(queryset, tags)
+    return queryset.only(*REFERENCE_FIELDS)
+
+
+def reference_token_budget(model_settings):
+    """
+    Token budget for reference content: the configured reference budget, capped
+    so prompt and completion always fit in the model's context window.
+    """
+    available = model_settings['context_window'] - model_settings['max_tokens'] - PROMPT_RESERVE_TOKENS
+    return max(0, min(model_settings['reference_token_budget'], available))
+
+
+def fair_shares(costs, budget):
+    """Split a budget so no one gets more than they need and the rest is shared equally."""
+    shares = [0] * len(costs)
+    remaining = budget
+    order = sorted(range(len(costs)), key=costs.__getitem__)
+    for position, index in enumerate(order):
+        share = min(costs[index], remaining // (len(order) - position))
+        shares[index] = share
+        remaining -= share
+    return shares
+
+
+class _Reference:
+    """A candidate document being packed."""
+
+    def __init__(self, document, model):
+        self.text = document.plain_text or ''
+        self.header = f"Title: {document.title}\n\nContent: "
+        self.header_tokens = count_tokens(self.header + "\n\n", model)
+        self.offsets = []
+        self.window = 0
+        # Documents saved with text statistics need no tokenizing of their body
+        if getattr(document, 'token_count', 0) and getattr(document, 'sentence_offsets', None):
+            self.estimated_tokens = self.header_tokens + document.token_count
+            self.offsets = offset_pairs(document.sentence_offsets)
+            self.window = len(self.text)
+        else:
+            self.estimated_tokens = self.header_tokens + math.ceil(len(self.text) / CHARS_PER_TOKEN)
+        self.end = 0  # End offset of the last whole sentence taken
+        self.used = 0  # Tokens this reference takes from the budget
+
+    @property
+    def complete(self):
+        return self.end == len(self.text)
+
+    def fill(self, share, model):
+        """Take as many whole sentences as fit in the share (header included)."""
+        # Tokenize only as far as the share could possibly reach
+        window = min(len(self.text), share * WINDOW_CHARS_PER_TOKEN)
+        if window > self.window:
+            self.window = window
+            self.offsets = sentence_token_offsets(self.text[:window], model)
+            # The last piece may be a sentence cut by the window; only whole text counts
+            if window < len(self.text) and len(self.offsets) > 1:
+                self.offsets.pop()
+
+        body_budget = share - self.header_tokens
+        taken = bisect_right([tokens for end, tokens in self.offsets], body_budget)
+        if taken:
+            self.end, body_tokens = self.offsets[taken - 1]
+            self.used = self.header_tokens + body_tokens
+        elif self.text and body_budget > 0:
+            # Not even one sentence fits: the first sentence will be cut to the share
+            self.used = share
+
+    def snippet(self, model):
+        if self.end:
+            body = self.text[:self.end].rstrip()
+        elif self.used:
+            body = truncate_to_tokens(self.text, self.used - self.header_tokens, model)
+        else:
+            return ''
+        return f"{self.header}{body}\n\n"
+
+
+def pack_references(documents, budget, model):
+    """
+    Combine reference documents into prompt text of at most `budget` tokens.
+    Documents are taken in the given order (most relevant first).
+    """
+    documents = list(documents)[:MAX_CANDIDATE_DOCUMENTS]
+    if budget <= 0 or not documents:
+        return ''
+
+    documents = documents[:max(1, budget // MIN_TOKENS_PER_DOCUMENT)]
+    separator_tokens = count_tokens(DOCUMENT_SEPARATOR, model)
+    content_budget = budget - separator_tokens * (len(documents) - 1)
+
+    references = [_Reference(document, model) for document in documents]
+    shares = fair_shares([reference.estimated_tokens for reference in references], content_budget)
+    for reference, share in zip(references, shares):
+        reference.fill(share, model)
+
+    # Sentence cuts and estimate errors leave tokens unused; hand them out in order
+    leftover = content_budget - sum(reference.used for reference in references)
+    for reference in references:
+        if leftover <= 0:
+            break
+        if reference.complete:
+            continue
+        before = reference.used
+        reference.fill(max(before, reference.header_tokens) + leftover, model)
+        leftover -= reference.used - before
+
+    snippets = [reference.snippet(model) for reference in references]
+    combined_content = DOCUMENT_SEPARATOR.join(snippet for snippet in snippets if snippet)
+
+    # Per-sentence counts can be off by a token at each boundary; never overflow
+    if count_tokens(combined_content, model) > budget:
+        combined_content = truncate_to_tokens(combined_content, budget, model)
+    return combined_content
@@ -0,0 +1,120 @@
+"""
+Full-text search for documents.
+
+On PostgreSQL every TextDocument row carries a ``search_vector`` built from its
+title, tags and plain text, and a ``title_content_vector`` built from the title
+and plain text only (for searches that leave tags out). A database trigger
+keeps both current on insert and on updates that touch those columns, and a
+GIN index on each makes lookups cheap.
+Other backends (SQLite in development) fall back to ``icontains`` matching.
+"""
+
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import F, Q, TextField
+from django.db.models.functions import Cast
+
+# 'simple' does no stemming or stop-word removal, which keeps search usable
+# for the mix of languages our users write in
+SEARCH_CONFIG = 'simple'
+
+SEARCH_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION documents_textdocument_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.title_content_vector :=
+        setweight(to_tsvector('{config}', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('{config}', coalesce(NEW.plain_text, '')), 'B');
+    NEW.search_vector :=
+        NEW.title_content_vector ||
+        setweight(to_tsvector('{config}', coalesce(NEW.tags::text, '')), 'A');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS documents_textdocument_search_vector_trigger ON documents_textdocument;
+CREATE TRIGGER documents_textdocument_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, tags, plain_text ON documents_textdocument
+    FOR EACH ROW EXECUTE PROCEDURE documents_textdocument_search_vector_update();
+""".format(config=SEARCH_CONFIG)
+
+DROP_SEARCH_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS documents_textdocument_search_vector_trigger ON documents_textdocument;
+DROP FUNCTION IF EXISTS documents_textdocument_search_vector_update();
+"""
+
+SEARCH_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS documents_textdocument_search_vector_gin "
+    "ON documents_textdocument USING gin (search_vector);"
+)
+
+DROP_SEARCH_INDEX_SQL = "DROP INDEX IF EXISTS documents_textdocument_search_vector_gin;"
+
+TITLE_CONTENT_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS documents_textdocument_title_content_vector_gin "
+    "ON documents_textdocument USING gin (title_content_vector);"
+)
+
+DROP_TITLE_CONTENT_INDEX_SQL = "DROP INDEX IF EXISTS documents_textdocument_title_content_vector_gin;"
+
+
+def supports_full_text_search():
+    """Return True if the database can use the maintained search vector."""
+    return connection.vendor == 'postgresql'
+
+
+def title_content_search_vector():
+    """
+    Return an expression that computes a document's search vector without its tags.
+    Must stay in step with SEARCH_TRIGGER_SQL; used to rebuild the index.
+    """
+    return (
+        SearchVector('title', weight='A', config=SEARCH_CONFIG)
+        + SearchVector('plain_text', weight='B', config=SEARCH_CONFIG)
+    )
+
+
+def document_search_vector():
+    """
+    Return an expression that computes a document's search vector.
+    Must stay in step with SEARCH_TRIGGER_SQL; used to rebuild the index.
+    """
+    return title_content_search_vector() + SearchVector(Cast('tags', TextField()), weight='A', config=SEARCH_CONFIG)
+
+
+def _search_terms(term):
+    """Split a search string into word tokens."""
+    return re.findall(r'\w+', term or '')
+
+
+def search_documents(queryset, term, include_tags=True):
+    """
+    Filter a TextDocument queryset by a search term.
+
+    On PostgreSQL every word must match (the last one as a prefix, so
+    search-as-you-type keeps working) and results are annotated with
+    ``search_rank``. Elsewhere each word must appear in the title, plain
+    text or (optionally) tags.
+
+    A search without tags matches the stored title and plain text vector
+    instead of the full search vector.
+    """
+    terms = _search_terms(term)
+    if not terms:
+        return queryset
+
+    if supports_full_text_search():
+        raw_query = ' & '.join(f"{word}:*" for word in terms)
+        query = SearchQuery(raw_query, search_type='raw', config=SEARCH_CONFIG)
+        vector = 'search_vector' if include_tags else 'title_content_vector'
+        return queryset.filter(**{vector: query}).annotate(
+            search_rank=SearchRank(F(vector), query)
+        )
+
+    for word in terms:
+        condition = Q(title__icontains=word) | Q(plain_text__icontains=word)
+        if include_tags:
+            condition |= Q(tags__icontains=word)
+        queryset = queryset.filter(condition)
+    return queryset
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import TextDocument, Comment, DocumentPDFExport, StyleConstraint
+from django.db.models import Count, Prefetch
+from .models import TextDocument, Comment, DocumentPDFExport, StyleConstraint, BackgroundJob
 import os
 
 User = get_user_model()
@@ -23,8 +24,33 @@ class CommentSerializer(serializers.ModelSerializer):
         return f"{obj.user.first_name} {obj.user.last_name}".strip() or obj.user.username
 
 
+# Large columns no document listing returns
+LIST_DEFERRED_FIELDS = (
+    'content', 'content_html', 'sentence_offsets', 'content_delta', 'search_vector', 'title_content_vector',
+)
+
+
+def requested_list_fields(request):
+    """
+    Return the field names a document listing should include: those named in
+    ?fields=, or everything but the full plain text with ?view=lean.
+    None means all fields.
+    """
+    if request is None:
+        return None
+    fields = request.query_params.get('fields')
+    if fields:
+        return {name.strip() for name in fields.split(',') if name.strip()}
+    if request.query_params.get('view') == 'lean':
+        return set(TextDocumentListSerializer.Meta.fields) - {'plain_text'}
+    return None
+
+
 class TextDocumentListSerializer(serializers.ModelSerializer):
-    """Serializer for listing TextDocument instances."""
+    """
+    Serializer for listing TextDocument instances. Listings can be trimmed
+    with ?fields= or ?view=lean (excerpt instead of the full plain text).
+    """
     
     created_by_name = serializers.SerializerMethodField()
     category_name = serializers.SerializerMethodField()
@@ -34,16 +60,24 @@ class TextDocumentListSerializer(serializers.ModelSerializer):
     class Meta:
         model = TextDocument
         fields = [
-            'id', 'title', 'plain_text', 'slug', 'created_by', 'created_by_name',
+            'id', 'title', 'plain_text', 'excerpt', 'slug', 'created_by', 'created_by_name',
             'organization', 'category', 'category_name', 'category_color', 'tags',
             'version', 'is_latest', 'status', 'created_at', 'updated_at',
-            'comment_count'
+            'comment_count', 'token_count', 'word_count'
         ]
         read_only_fields = [
-            'id', 'slug', 'plain_text', 'version', 'is_latest', 'created_at', 'updated_at',
+            'id', 'slug', 'plain_text', 'excerpt', 'version', 'is_latest', 'created_at', 'updated_at',
+            'token_count', 'word_count',
             'created_by_name', 'category_name', 'category_color', 'comment_count'
         ]
     
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_list_fields(self.context.get('request'))
+        if fields is not None:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+    
     def get_created_by_name(self, obj):
         """Get the name of the document creator."""
         return f"{obj.created_by.first_name} {obj.created_by.last_name}".strip() or obj.created_by.username
@@ -56,8 +90,15 @@ class TextDocumentListSerializer(serializers.ModelSerializer):
         """Get the color of the document category."""
         return obj.category.color if obj.category else None
     
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Load authors and categories with the documents and count comments in the same query."""
+        return queryset.select_related('created_by', 'category').annotate(comments_count=Count('comments'))
+    
     def get_comment_count(self, obj):
-        """Get the number of comments on the document."""
+        """Get the number of comments on the document (annotated by setup_eager_loading)."""
+        if hasattr(obj, 'comments_count'):
+            return obj.comments_count
         return obj.comments.count()
 
 
@@ -75,13 +116,21 @@ class TextDocumentDetailSerializer(serializers.ModelSerializer):
             'id', 'title', 'content', 'slug', 'created_by', 'created_by_name',
             'organization', 'category', 'category_name', 'category_color', 'tags',
             'version', 'parent', 'is_latest', 'status', 'created_at', 'updated_at',
-            'comments'
+            'comments', 'token_count', 'word_count', 'content_format'
         ]
         read_only_fields = [
             'id', 'slug', 'version', 'is_latest', 'created_at', 'updated_at',
+            'token_count', 'word_count', 'content_format',
             'created_by_name', 'category_name', 'category_color', 'comments'
         ]
     
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Load the author, category and comments (with their authors) in a fixed number of queries."""
+        return queryset.select_related('created_by', 'category').prefetch_related(
+            Prefetch('comments', queryset=Comment.objects.select_related('user'))
+        )
+    
     def get_created_by_name(self, obj):
         """Get the name of the document creator."""
         return f"{obj.created_by.first_name} {obj.created_by.last_name}".strip() or obj.created_by.username
@@ -146,17 +195,18 @@ class DocumentPDFExportSerializer(serializers.ModelSerializer):
     created_by_name = serializers.SerializerMethodField()
     share_url = serializers.SerializerMethodField()
     expiration_display = serializers.SerializerMethodField()
+    is_snapshot = serializers.SerializerMethodField()
     
     class Meta:
         model = DocumentPDFExport
         fields = [
             'id', 'document', 'document_title', 'created_by', 'created_by_name',
             'uuid', 'created_at', 'expires_at', 'expiration_type', 'expiration_display',
-            'pin_protected', 'pin_code', 'share_url'
+            'pin_protected', 'pin_code', 'share_url', 'is_snapshot'
         ]
         read_only_fields = [
             'id', 'uuid', 'created_at', 'created_by_name', 'document_title', 
-            'share_url', 'pin_code', 'expiration_display'
+            'share_url', 'pin_code', 'expiration_display', 'is_snapshot'
         ]
     
     def get_document_title(self, obj):
@@ -167,6 +217,13 @@ class DocumentPDFExportSerializer(serializers.ModelSerializer):
         """Get the name of the export creator."""
         return f"{obj.created_by.first_name} {obj.created_by.last_name}".strip() or obj.created_by.username
     
+    def get_is_snapshot(self, obj):
+        """Whether the share serves a snapshot instead of the live document."""
+        # List views annotate this so the snapshot blob is not loaded
+        if hasattr(obj, 'is_snapshot'):
+            return obj.is_snapshot
+        return obj.snapshot is not None
+    
     def get_share_url(self, obj):
         """Get the shareable URL for the document (PDF or HTML)."""
         request = self.context.get('request')
@@ -222,6 +279,13 @@ class StyleConstraintSerializer(serializers.ModelSerializer):
             'organization_name', 'reference_document_titles'
         ]
     
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Load the creator, organization and reference document titles with the constraints."""
+        return queryset.select_related('created_by', 'organization').prefetch_related(
+            Prefetch('reference_documents', queryset=TextDocument.objects.only('id', 'title'))
+        )
+    
     def get_created_by_name(self, obj):
         """Get the name of the style constraint creator."""
         if obj.created_by:
@@ -252,3 +316,21 @@ class StyleConstraintSerializer(serializers.ModelSerializer):
             style_constraint.reference_documents.set(reference_documents)
         
         return style_constraint
+
+
+class BackgroundJobSerializer(serializers.ModelSerializer):
+    """Serializer for reporting BackgroundJob status."""
+    
+    document_slug = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = BackgroundJob
+        fields = [
+            'uuid', 'job_type', 'status', 'result', 'error', 'document', 'document_slug',
+            'total', 'processed', 'created_at', 'started_at', 'finished_at'
+        ]
+        read_only_fields = fields
+    
+    def get_document_slug(self, obj):
+        """Get the slug of the document created by the job."""
+        return obj.document.slug if obj.document else None
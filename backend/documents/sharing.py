@@ -0,0 +1,97 @@
+"""
+Payloads for shared document links.
+
+Share links are public and can be opened thousands of times, so the
+serialized document and its HTML are cached per document. An entry is only
+used for the version and save time it was built from (and the save time
+of the document's category, whose name and colour it shows), and is dropped when
+the document or its comments change (see documents.signals) or a bulk
+action updates the document without saving it.
+
+A share can instead be created as a snapshot: the payload is frozen into a
+compressed blob on the DocumentPDFExport row, served without touching the
+document, and never changes under the reader.
+"""
+
+import json
+import zlib
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .conditional import document_validators, from_timestamp
+from .models import TextDocument
+
+SHARE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Document columns a share view needs before it knows whether the cached payload is current
+SHARE_DEFERRED_FIELDS = (
+    'content', 'content_html', 'plain_text', 'content_delta', 'sentence_offsets', 'search_vector',
+    'title_content_vector',
+)
+
+
+def share_cache_key(document_id):
+    return f"documents:share:{document_id}"
+
+
+def share_stamp(document):
+    """The version and save time a cached payload must match, and those of its category (name and colour)."""
+    category = document.category
+    return [document.version, document.updated_at.timestamp(), category.updated_at.timestamp() if category else None]
+
+
+def invalidate_shared_documents(document_ids):
+    """Drop the cached share payloads of documents changed without save()."""
+    cache.delete_many([share_cache_key(document_id) for document_id in document_ids])
+
+
+def shared_document_payload(document):
+    """
+    Return the serialized document and its HTML for a share view, with the
+    payload's ETag and Last-Modified time, from the cache when it matches
+    the document's version and last save.
+    """
+    from .serializers import TextDocumentDetailSerializer
+
+    key = share_cache_key(document.id)
+    cached = cache.get(key)
+    if cached is not None and cached['stamp'] == share_stamp(document):
+        return cached['payload'], cached['etag'], from_timestamp(cached['last_modified'])
+
+    # The share view loads the document without its body
+    document = TextDocumentDetailSerializer.setup_eager_loading(
+        TextDocument.objects.filter(pk=document.pk)
+    ).get()
+    document.restore_content()
+    payload = {
+        'document': TextDocumentDetailSerializer(document).data,
+        'html_content': document.rendered_html,
+    }
+    etag, last_modified = document_validators(document)
+    cache.set(key, {
+        'stamp': share_stamp(document),
+        'payload': payload,
+        'etag': etag,
+        'last_modified': last_modified.timestamp(),
+    }, SHARE_CACHE_TIMEOUT)
+    return payload, etag, last_modified
+
+
+def creator_name(user):
+    return f"{user.first_name} {user.last_name}".strip() or user.username
+
+
+def build_snapshot(document, created_by):
+    """Freeze a document's share payload and the share page's metadata into a compressed blob."""
+    payload, etag, last_modified = shared_document_payload(document)
+    snapshot = {
+        'payload': payload,
+        'document_title': document.title,
+        'created_by_name': creator_name(created_by),
+    }
+    return zlib.compress(json.dumps(snapshot, cls=DjangoJSONEncoder).encode())
+
+
+def read_snapshot(blob):
+    return json.loads(zlib.decompress(blob))
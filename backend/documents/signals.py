@@ -0,0 +1,69 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+from . import pdf, similarity, versioning
+from .tags import refresh_tag_counts, tag_names
+from .ai_config import invalidate_ai_config
+from .sharing import invalidate_shared_documents
+from .models import AIPromptTemplate, AIModelSettings, Comment, DocumentLengthSettings, StyleConstraint, TextDocument
+
+
+@receiver([post_save, post_delete], sender=AIPromptTemplate)
+@receiver([post_save, post_delete], sender=AIModelSettings)
+@receiver([post_save, post_delete], sender=DocumentLengthSettings)
+def invalidate_ai_config_cache(sender, **kwargs):
+    """
+    Drop cached AI configuration in every worker when a config row changes.
+    Wait for the commit so other workers cannot reload the old rows under the new version.
+    """
+    transaction.on_commit(invalidate_ai_config)
+
+
+@receiver([post_save, post_delete], sender=StyleConstraint)
+def invalidate_style_analysis_cache(sender, instance, created=False, **kwargs):
+    """Drop the cached analysis for a style constraint that was edited or removed."""
+    if instance.analysis_key and not created:
+        cache.delete(f"documents:style_analysis:{instance.analysis_key}")
+
+
+@receiver(post_save, sender=TextDocument)
+def update_similarity_index(sender, instance, **kwargs):
+    """Keep this process's similarity index in step with saved documents."""
+    transaction.on_commit(lambda: similarity.document_saved(instance))
+
+
+@receiver(post_delete, sender=TextDocument)
+def remove_from_similarity_index(sender, instance, **kwargs):
+    """Drop deleted documents from this process's similarity index."""
+    # The instance loses its id once deleted, so capture it now
+    organization_id, document_id = instance.organization_id, instance.id
+    transaction.on_commit(lambda: similarity.document_deleted(organization_id, document_id))
+
+
+@receiver(pre_delete, sender=TextDocument)
+def restore_parent_version(sender, instance, **kwargs):
+    """A parent version stored as a delta against this one gets its full body back."""
+    versioning.version_deleted(instance)
+
+
+@receiver(post_delete, sender=TextDocument)
+def refresh_deleted_document_tag_counts(sender, instance, **kwargs):
+    """Recount the tags of a permanently deleted document (its tag links are already gone)."""
+    refresh_tag_counts(instance.organization_id, tag_names(instance.tags))
+
+
+@receiver([post_save, post_delete], sender=TextDocument)
+@receiver([post_save, post_delete], sender=Comment)
+def invalidate_share_cache(sender, instance, **kwargs):
+    """Drop the cached share payload of a document that was saved or had its comments changed."""
+    document_id = instance.id if sender is TextDocument else instance.document_id
+    transaction.on_commit(lambda: invalidate_shared_documents([document_id]))
+
+
+@receiver(post_delete, sender=TextDocument)
+def delete_pdf_artifacts(sender, instance, **kwargs):
+    """Remove the stored PDFs of a permanently deleted document."""
+    document_id = instance.id
+    transaction.on_commit(lambda: pdf.delete_artifacts(document_id))
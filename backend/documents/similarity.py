@@ -0,0 +1,483 @@
+"""
+Per-organization TF-IDF index over document plain text.
+
+Terms are hashed (HashingVectorizer), so there is no vocabulary to refit. A
+document can be added, replaced or removed by changing its row, and IDF
+weights are applied at query time. Each index has two segments:
+- a large base segment, stored column-major so a query only reads the
+  columns of its own terms;
+- a small delta segment for recent changes.
+
+Base segments are saved per organization under SIMILARITY_INDEX_DIR and
+memory-mapped on load, so every process shares one copy through the page
+cache. Readers switch to a new segment atomically through a CURRENT file.
+Each process keeps its own delta:
+- saves in the process update it directly (see documents.signals);
+- other processes' changes are picked up by a cheap updated_at check before
+  each search.
+Once a delta grows large, a Celery task folds it into a new base segment.
+The first index of an organization is built by the same task (or the
+build_similarity_index command), never in a request; until it exists,
+callers fall back to recent documents.
+"""
+
+import json
+import os
+import shutil
+import threading
+import uuid
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+
+N_FEATURES = 2 ** 18
+
+# Bump when the stored arrays or term weighting change, so old segments are rebuilt
+INDEX_FORMAT = 1
+SEGMENT_ARRAYS = ('data', 'indices', 'indptr', 'ids', 'df', 'norms')
+
+# Fold the delta into the base once it holds this many rows, or this share of the base
+MERGE_MIN_DELTA = 200
+MERGE_DELTA_RATIO = 0.05
+MERGE_LOCK_TIMEOUT = 60 * 10
+
+# Re-check documents saved this long before the last sync, in case their transaction committed late
+SYNC_OVERLAP = timedelta(minutes=1)
+
+# Documents read per query while building an index
+BUILD_BATCH_SIZE = 1000
+
+# Long query texts (whole documents) are cut down to their most distinctive terms
+MAX_QUERY_TERMS = 64
+
+# Number of documents picked as references for a concept
+RELEVANT_DOCUMENTS = 10
+
+# Search this many times the wanted number, since the caller's filters may drop some
+CANDIDATE_FACTOR = 5
+
+_vectorizer = HashingVectorizer(n_features=N_FEATURES, alternate_sign=False, norm=None, dtype=np.float32)
+
+
+def term_weights(texts):
+    """Sublinear term frequencies (1 + log tf) of texts, one CSR row per text."""
+    matrix = _vectorizer.transform(texts).tocsr()
+    matrix.data = 1 + np.log(matrix.data)
+    return matrix
+
+
+def is_indexed(document_values):
+    """Only the latest, non-deleted version of a document with text is searchable."""
+    return document_values['is_latest'] and document_values['status'] != 'deleted' and bool(document_values['plain_text'])
+
+
+def index_dir(organization_id):
+    return os.path.join(settings.SIMILARITY_INDEX_DIR, f"org_{organization_id}")
+
+
+def current_generation(organization_id):
+    """Return the name of the organization's current saved segment, or None."""
+    try:
+        with open(os.path.join(index_dir(organization_id), 'CURRENT')) as current_file:
+            return current_file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class SimilarityIndex:
+    """TF-IDF index of one organization's documents."""
+
+    def __init__(self, organization_id):
+        self.organization_id = organization_id
+        self.lock = threading.RLock()
+        self.generation = None
+
+        # Base segment: rows are documents sorted by id, columns are hashed terms
+        self.base = sparse.csc_matrix((0, N_FEATURES), dtype=np.float32)
+        self.base_ids = np.zeros(0, dtype=np.int64)
+        self.base_alive = np.zeros(0, dtype=bool)
+        self.base_df = np.zeros(N_FEATURES, dtype=np.int32)
+        self.base_norms = np.zeros(0, dtype=np.float32)
+
+        # Delta segment: document id -> 1 x N_FEATURES CSR row
+        self.delta = {}
+        self._delta_matrix = None
+        self._delta_ids = None
+        self._delta_df = None
+
+        # document id -> updated_at last seen since the base was built
+        self.versions = {}
+        self.synced_at = None
+
+    @property
+    def size(self):
+        return int(self.base_alive.sum()) + len(self.delta)
+
+    # Updates
+
+    def remove(self, document_id):
+        with self.lock:
+            if self.delta.pop(document_id, None) is not None:
+                self._delta_matrix = None
+            row = np.searchsorted(self.base_ids, document_id)
+            if row < len(self.base_ids) and self.base_ids[row] == document_id:
+                # Base document frequencies stay as they are until the next merge
+                self.base_alive[row] = False
+
+    def update(self, document_values):
+        """Add, replace or remove a document from a dict of its id, plain_text, is_latest, status and updated_at."""
+        document_id = document_values['id']
+        with self.lock:
+            self.versions[document_id] = document_values['updated_at']
+            self.remove(document_id)
+            if is_indexed(document_values):
+                self.delta[document_id] = term_weights([document_values['plain_text']])
+                self._delta_matrix = None
+        if self.needs_merge():
+            request_merge(self.organization_id)
+
+    def needs_merge(self):
+        return len(self.delta) > max(MERGE_MIN_DELTA, MERGE_DELTA_RATIO * len(self.base_ids))
+
+    def merge(self):
+        """Fold the delta segment into the base and drop removed rows."""
+        with self.lock:
+            live_rows = np.flatnonzero(self.base_alive)
+            delta_ids = list(self.delta)
+            matrices = [self.base.tocsr()[live_rows]]
+            if delta_ids:
+                matrices.append(sparse.vstack([self.delta[document_id] for document_id in delta_ids], format='csr'))
+            ids = np.concatenate([self.base_ids[live_rows], np.array(delta_ids, dtype=np.int64)])
+            order = np.argsort(ids, kind='stable')
+            self.delta = {}
+            self._delta_matrix = None
+            self._set_base(sparse.vstack(matrices, format='csr')[order], ids[order])
+
+    def _set_base(self, matrix, ids):
+        matrix = matrix.tocsc()
+        matrix.sort_indices()
+        self.base = matrix
+        self.base_ids = ids
+        self.base_alive = np.ones(len(ids), dtype=bool)
+        # Column lengths of a CSC matrix are the document frequencies
+        self.base_df = np.diff(matrix.indptr).astype(np.int32)
+        self.base_norms = self._norms(matrix, self.idf())
+
+    # Persistence
+
+    def save(self):
+        """Write the base segment to disk and make it the organization's current one."""
+        with self.lock:
+            directory = index_dir(self.organization_id)
+            generation = uuid.uuid4().hex
+            path = os.path.join(directory, generation)
+            os.makedirs(path)
+
+            arrays = {
+                'data': self.base.data,
+                'indices': self.base.indices,
+                'indptr': self.base.indptr,
+                'ids': self.base_ids,
+                'df': self.base_df,
+                'norms': self.base_norms,
+            }
+            for name, array in arrays.items():
+                np.save(os.path.join(path, f"{name}.npy"), array)
+            with open(os.path.join(path, 'meta.json'), 'w') as meta_file:
+                json.dump({
+                    'format': INDEX_FORMAT,
+                    'n_features': N_FEATURES,
+                    'rows': len(self.base_ids),
+                    'synced_at': self.synced_at.isoformat(),
+                }, meta_file)
+
+            # Switch readers over atomically, then drop older segments; processes
+            # that still have them mapped keep reading until they reload
+            current_tmp = os.path.join(directory, f"CURRENT.{generation}")
+            with open(current_tmp, 'w') as current_file:
+                current_file.write(generation)
+            os.replace(current_tmp, os.path.join(directory, 'CURRENT'))
+            self.generation = generation
+
+            for name in os.listdir(directory):
+                if name != generation and not name.startswith('CURRENT'):
+                    shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    @classmethod
+    def load(cls, organization_id, generation):
+        """Memory-map a saved base segment; returns None if it is missing or outdated."""
+        path = os.path.join(index_dir(organization_id), generation)
+        try:
+            with open(os.path.join(path, 'meta.json')) as meta_file:
+                meta = json.load(meta_file)
+            if meta['format'] != INDEX_FORMAT or meta['n_features'] != N_FEATURES:
+                return None
+            arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in SEGMENT_ARRAYS}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load similarity index for organization {organization_id}: {str(e)}")
+            return None
+
+        index = cls(organization_id)
+        index.generation = generation
+        index.base = sparse.csc_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(meta['rows'], N_FEATURES),
+            copy=False
+        )
+        index.base_ids = arrays['ids']
+        index.base_alive = np.ones(meta['rows'], dtype=bool)
+        index.base_df = arrays['df']
+        index.base_norms = arrays['norms']
+        index.synced_at = parse_datetime(meta['synced_at'])
+        return index
+
+    # Database
+
+    def build(self):
+        """Index all of the organization's documents from the database."""
+        from .models import TextDocument
+
+        with self.lock:
+            started_at = timezone.now()
+            documents = TextDocument.objects.filter(
+                organization_id=self.organization_id
+            ).values('id', 'plain_text', 'is_latest', 'status', 'updated_at')
+
+            matrices = []
+            ids = []
+            last_id = 0
+            while True:
+                batch = list(documents.filter(id__gt=last_id).order_by('id')[:BUILD_BATCH_SIZE])
+                if not batch:
+                    break
+                last_id = batch[-1]['id']
+                batch = [values for values in batch if is_indexed(values)]
+                if batch:
+                    matrices.append(term_weights([values['plain_text'] for values in batch]))
+                    ids.extend(values['id'] for values in batch)
+
+            matrix = sparse.vstack(matrices, format='csr') if matrices else sparse.csr_matrix((0, N_FEATURES), dtype=np.float32)
+            self.delta = {}
+            self._delta_matrix = None
+            self._set_base(matrix, np.array(ids, dtype=np.int64))
+            self.versions = {}
+            self.synced_at = started_at
+
+    def sync(self):
+        """Pick up documents changed by other processes since the last sync."""
+        from .models import TextDocument
+
+        with self.lock:
+            started_at = timezone.now()
+            documents = TextDocument.objects.filter(organization_id=self.organization_id)
+            changed = documents.filter(updated_at__gte=self.synced_at - SYNC_OVERLAP).values_list('id', 'updated_at')
+            stale_ids = [document_id for document_id, updated_at in changed if self.versions.get(document_id) != updated_at]
+            if stale_ids:
+                for values in documents.filter(id__in=stale_ids).values('id', 'plain_text', 'is_latest', 'status', 'updated_at'):
+                    self.update(values)
+            self.synced_at = started_at
+
+    # Search
+
+    def idf(self):
+        document_count = self.size
+        df = self.base_df + self._delta()[2] if self.delta else self.base_df
+        return (np.log((1 + document_count) / (1 + df)) + 1).astype(np.float32)
+
+    @staticmethod
+    def _norms(matrix, idf):
+        return np.sqrt(matrix.multiply(matrix) @ (idf ** 2)).astype(np.float32)
+
+    def _delta(self):
+        if self._delta_matrix is None:
+            ids = list(self.delta)
+            matrix = sparse.vstack([self.delta[document_id] for document_id in ids], format='csr')
+            self._delta_matrix = matrix
+            self._delta_ids = np.array(ids, dtype=np.int64)
+            self._delta_df = np.bincount(matrix.indices, minlength=N_FEATURES).astype(np.int32)
+        return self._delta_matrix, self._delta_ids, self._delta_df
+
+    def search(self, text, limit, exclude_id=None):
+        """Return up to `limit` (document id, cosine similarity) pairs for a text, best first."""
+        query = term_weights([text])
+        if not query.nnz:
+            return []
+
+        with self.lock:
+            idf = self.idf()
+            terms = query.indices
+            # Query TF-IDF weights, times IDF again for the document side of the dot product
+            query_weights = query.data * idf[terms]
+            if len(terms) > MAX_QUERY_TERMS:
+                strongest = np.sort(np.argpartition(-query_weights, MAX_QUERY_TERMS - 1)[:MAX_QUERY_TERMS])
+                terms = terms[strongest]
+                query_weights = query_weights[strongest]
+            term_factors = query_weights * idf[terms]
+            query_norm = np.linalg.norm(query_weights)
+
+            ids = [self.base_ids]
+            scores = [self._scores(self.base, self.base_norms, terms, term_factors) * self.base_alive]
+            if self.delta:
+                delta_matrix, delta_ids, _ = self._delta()
+                ids.append(delta_ids)
+                scores.append(self._scores(delta_matrix, self._norms(delta_matrix, idf), terms, term_factors))
+
+        ids = np.concatenate(ids)
+        scores = np.concatenate(scores) / query_norm
+        if exclude_id is not None:
+            scores[ids == exclude_id] = 0
+
+        count = min(limit, int(np.count_nonzero(scores > 0)))
+        if not count:
+            return []
+        best = np.argpartition(-scores, count - 1)[:count]
+        best = best[np.argsort(-scores[best])]
+        return [(int(ids[row]), float(scores[row])) for row in best]
+
+    @staticmethod
+    def _scores(matrix, norms, terms, term_factors):
+        if not matrix.shape[0]:
+            return np.zeros(0, dtype=np.float32)
+        dots = np.asarray(matrix[:, terms] @ term_factors).ravel()
+        return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def load_or_build_index(organization_id):
+    """Load the organization's saved segment, or build and save one."""
+    generation = current_generation(organization_id)
+    index = SimilarityIndex.load(organization_id, generation) if generation else None
+    if index is None:
+        index = SimilarityIndex(organization_id)
+        index.build()
+        index.save()
+    return index
+
+
+def get_index(organization_id):
+    """
+    Return the organization's index, switched to the newest saved segment and
+    synced with the database. Returns None (and queues a build) while the
+    organization has no saved segment.
+    """
+    with _indexes_lock:
+        index = _indexes.get(organization_id)
+        generation = current_generation(organization_id)
+        if generation and (index is None or index.generation != generation):
+            index = SimilarityIndex.load(organization_id, generation) or index
+            if index is not None:
+                _indexes[organization_id] = index
+    # Missing or unreadable (an older format): rebuilt in a Celery worker
+    if index is None or index.generation != generation:
+        request_merge(organization_id)
+    if index is None:
+        return None
+    index.sync()
+    return index
+
+
+def merge_index(organization_id):
+    """Fold recent changes into a new saved base segment (run by a Celery task)."""
+    try:
+        index = load_or_build_index(organization_id)
+        index.sync()
+        if index.delta or index.size != len(index.base_ids):
+            index.merge()
+            index.save()
+        with _indexes_lock:
+            _indexes[organization_id] = index
+    finally:
+        cache.delete(merge_lock_key(organization_id))
+
+
+def merge_lock_key(organization_id):
+    return f"documents:similarity:merge:{organization_id}"
+
+
+def request_merge(organization_id):
+    """Queue a merge for the organization unless one is already queued."""
+    from .tasks import merge_similarity_index
+
+    if not cache.add(merge_lock_key(organization_id), True, MERGE_LOCK_TIMEOUT):
+        return
+    try:
+        merge_similarity_index.delay(organization_id)
+    except Exception as e:
+        print(f"Could not queue similarity index merge, merging in process: {str(e)}")
+        cache.delete(merge_lock_key(organization_id))
+        # Building a missing index is too slow for a request; build_similarity_index does it
+        index = _indexes.get(organization_id)
+        if index is not None:
+            index.merge()
+            index.save()
+
+
+def document_saved(document):
+    """Apply a saved document to its organization's index, if this process has one."""
+    index = _indexes.get(document.organization_id)
+    if index is not None:
+        index.update({
+            'id': document.id,
+            'plain_text': document.plain_text,
+            'is_latest': document.is_latest,
+            'status': document.status,
+            'updated_at': document.updated_at,
+        })
+
+
+def document_deleted(organization_id, document_id):
+    """Drop a deleted document from its organization's index, if this process has one."""
+    index = _indexes.get(organization_id)
+    if index is not None:
+        index.remove(document_id)
+
+
+def select_relevant_documents(documents, organization_id, text, limit=RELEVANT_DOCUMENTS):
+    """
+    Return the documents from a queryset or list that are most similar to a
+    text, best first. Returns an empty list when nothing matches or the
+    organization's index is not built yet.
+    """
+    try:
+        index = get_index(organization_id)
+        if index is None:
+            return []
+        ranked = index.search(text, limit * CANDIDATE_FACTOR)
+    except Exception as e:
+        print(f"Error searching similar documents: {str(e)}")
+        return []
+
+    ranked_ids = [document_id for document_id, score in ranked]
+    if hasattr(documents, 'filter'):
+        by_id = documents.in_bulk(ranked_ids)
+    else:
+        wanted_ids = set(ranked_ids)
+        by_id = {document.id: document for document in documents if document.id in wanted_ids}
+    return [by_id[document_id] for document_id in ranked_ids if document_id in by_id][:limit]
+
+
+def similar_documents(document, documents, limit):
+    """
+    Return (document, similarity) pairs from a queryset for the documents most
+    similar to a given document, best first. Until the organization's index
+    is built, the most recently updated documents are returned without a
+    similarity.
+    """
+    index = get_index(document.organization_id)
+    if index is None:
+        recent = documents.exclude(id=document.id).order_by('-updated_at')[:limit]
+        return [(other, None) for other in recent]
+    ranked = index.search(
+        document.plain_text or document.title, limit * CANDIDATE_FACTOR, exclude_id=document.id
+    )
+    by_id = documents.in_bulk([document_id for document_id, score in ranked])
+    return [(by_id[document_id], score) for document_id, score in ranked if document_id in by_id][:limit]
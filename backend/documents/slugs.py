@@ -0,0 +1,58 @@
+"""
+Slug allocation without duplicate checks.
+
+Documents, categories and tags have slugs that are unique per organization,
+enforced by a database constraint. A new slug is simply tried: the row is
+saved inside a savepoint and, if the constraint rejects the slug, saved
+again with a random suffix. A save costs no SELECT, and two concurrent
+saves can never end up with the same slug.
+"""
+
+import random
+import string
+from functools import partial
+
+from django.db import IntegrityError, transaction
+from django.utils.text import slugify
+
+# Saves tried before a slug conflict is reported
+SLUG_ATTEMPTS = 8
+
+SLUG_SUFFIX_LENGTH = 4
+SLUG_SUFFIX_CHARS = string.ascii_lowercase + string.digits
+
+
+def slug_candidates(text, max_length, fallback):
+    """Yield the slug of `text`, then that slug with random suffixes."""
+    base = slugify(text)[:max_length].strip('-') or fallback
+    yield base
+    stem = base[:max_length - SLUG_SUFFIX_LENGTH - 1].strip('-') or fallback
+    while True:
+        suffix = ''.join(random.choices(SLUG_SUFFIX_CHARS, k=SLUG_SUFFIX_LENGTH))
+        yield f"{stem}-{suffix}"
+
+
+def is_slug_conflict(error):
+    """Tell whether an IntegrityError came from a slug constraint (named or listed by column)."""
+    return 'slug' in str(error).lower()
+
+
+def save_with_slug(instance, text, save, *args, **kwargs):
+    """
+    Give `instance` a slug made from `text` and save it with `save(*args,
+    **kwargs)` (the model's base save), retrying with a new suffix whenever
+    the slug is already taken.
+    """
+    max_length = instance._meta.get_field('slug').max_length
+    candidates = slug_candidates(text, max_length, instance._meta.model_name)
+    save = partial(save, *args, **kwargs)
+    for attempt in range(SLUG_ATTEMPTS):
+        instance.slug = next(candidates)
+        try:
+            # A savepoint, so a rejected insert doesn't break the caller's transaction
+            with transaction.atomic():
+                save()
+            return
+        except IntegrityError as e:
+            if not is_slug_conflict(e) or attempt == SLUG_ATTEMPTS - 1:
+                raise
@@ -0,0 +1,282 @@
+"""
+Indexed tag storage.
+
+TextDocument.tags stays the source of truth, but every tag is mirrored as a
+DocumentTag row when a document is saved, so tag filters are index lookups
+instead of JSON scans. Each categories.Tag stores how many latest,
+non-deleted documents carry it; the counts are refreshed with a single
+UPDATE whenever the documents behind them change.
+
+Bulk tagging rewrites the tags lists of all selected documents in a single
+UPDATE (jsonb operators on PostgreSQL, JSON1 functions on SQLite) and
+adjusts their links with one insert and one delete. Renaming or merging
+tags rewrites every affected document (all versions) the same way, in
+chunks found through the tag link index.
+"""
+
+import json
+
+from django.db import connections, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce, Now
+
+# Longest tag name kept as a link (the column length of DocumentTag.name)
+TAG_NAME_MAX_LENGTH = 255
+
+# Documents rewritten per transaction when a tag is renamed or merged
+TAG_REWRITE_CHUNK_SIZE = 1000
+
+# Renames and merges touching more documents than this run in a Celery worker
+TAG_REWRITE_INLINE_LIMIT = 2000
+
+# Tags lists rewritten in the database; the new or removed tags are passed as a JSON array
+ADD_TAGS_SQL = {
+    'postgresql': (
+        "tags || COALESCE((SELECT jsonb_agg(added.tag) FROM jsonb_array_elements(%s::jsonb) AS added(tag) "
+        "WHERE NOT tags @> jsonb_build_array(added.tag)), '[]'::jsonb)"
+    ),
+    'sqlite': (
+        "(SELECT json_group_array(value) FROM ("
+        "SELECT value FROM json_each(tags) UNION ALL "
+        "SELECT value FROM json_each(%s) WHERE value NOT IN (SELECT value FROM json_each(tags))))"
+    ),
+}
+
+REMOVE_TAGS_SQL = {
+    'postgresql': (
+        "COALESCE((SELECT jsonb_agg(kept.tag ORDER BY kept.position) "
+        "FROM jsonb_array_elements(tags) WITH ORDINALITY AS kept(tag, position) "
+        "WHERE NOT %s::jsonb @> jsonb_build_array(kept.tag)), '[]'::jsonb)"
+    ),
+    'sqlite': (
+        "(SELECT json_group_array(value) FROM ("
+        "SELECT value FROM json_each(tags) "
+        "WHERE value NOT IN (SELECT value FROM json_each(%s)) ORDER BY key))"
+    ),
+}
+
+
+# Replaces each tag in a JSON array of names with a target name, keeping the first of any duplicates
+RETAG_SQL = {
+    'postgresql': (
+        "COALESCE((SELECT jsonb_agg(renamed.tag ORDER BY renamed.position) FROM ("
+        "SELECT DISTINCT ON (mapped.tag) mapped.tag, mapped.position FROM ("
+        "SELECT CASE WHEN %s::jsonb @> jsonb_build_array(old.tag) THEN to_jsonb(%s::text) ELSE old.tag END AS tag, "
+        "old.position FROM jsonb_array_elements(tags) WITH ORDINALITY AS old(tag, position)"
+        ") AS mapped ORDER BY mapped.tag, mapped.position) AS renamed), '[]'::jsonb)"
+    ),
+    'sqlite': (
+        "(SELECT json_group_array(tag) FROM ("
+        "SELECT tag, MIN(position) AS position FROM ("
+        "SELECT CASE WHEN value IN (SELECT value FROM json_each(%s)) THEN %s ELSE value END AS tag, "
+        "key AS position FROM json_each(tags)"
+        ") GROUP BY tag ORDER BY position))"
+    ),
+}
+
+
+def tag_names(tags):
+    """Return the distinct usable tag names of a tags list."""
+    return {
+        tag for tag in (tags or [])
+        if isinstance(tag, str) and tag and len(tag) <= TAG_NAME_MAX_LENGTH
+    }
+
+
+def filter_by_tags(queryset, tags):
+    """Keep the documents that carry all of the given tags."""
+    for tag in tags:
+        if tag:
+            # One join per tag, so a document must match every one of them
+            queryset = queryset.filter(tag_links__name=tag)
+    return queryset
+
+
+def counted_tag_links(organization_id):
+    """Tag links of an organization's latest, non-deleted documents."""
+    from .models import DocumentTag
+    return DocumentTag.objects.filter(
+        organization_id=organization_id,
+        document__is_latest=True
+    ).exclude(document__status='deleted')
+
+
+def refresh_tag_counts(organization_id, names=None):
+    """Recount the documents of an organization's tags (all of them, or only `names`) in one UPDATE."""
+    from categories.models import Tag
+    tags = Tag.objects.filter(organization_id=organization_id)
+    if names is not None:
+        if not names:
+            return
+        tags = tags.filter(name__in=list(names))
+
+    document_count = counted_tag_links(organization_id).filter(
+        name=OuterRef('name')
+    ).order_by().values('name').annotate(total=Count('id')).values('total')
+    tags.update(document_count=Coalesce(Subquery(document_count), 0))
+
+
+def sync_document_tags(document, previous_tags=None, inserted=False):
+    """
+    Bring a document's tag links in line with its tags list and refresh the
+    affected counts. `previous_tags` are the tags it was loaded with, which a
+    new version leaves behind on the row it was copied from. A just
+    `inserted` document has no links to look up.
+    """
+    from .models import DocumentTag
+    names = tag_names(document.tags)
+    linked = set() if inserted else set(DocumentTag.objects.filter(document=document).values_list('name', flat=True))
+
+    if linked - names:
+        DocumentTag.objects.filter(document=document, name__in=linked - names).delete()
+    if names - linked:
+        DocumentTag.objects.bulk_create([
+            DocumentTag(document=document, organization_id=document.organization_id, name=name)
+            for name in names - linked
+        ], ignore_conflicts=True)
+
+    refresh_tag_counts(document.organization_id, names | linked | tag_names(previous_tags))
+
+
+def clean_tag_list(tags):
+    """
+    Return the tags of a request as an ordered list without duplicates, or
+    None unless it is a list of usable tag names.
+    """
+    if not isinstance(tags, list):
+        return None
+    names = tag_names(tags)
+    if not all(isinstance(tag, str) and tag in names for tag in tags):
+        return None
+    return list(dict.fromkeys(tags))
+
+
+def _lock_documents(documents, organization_id):
+    """Lock the selected documents and return their ids and a queryset of exactly those rows."""
+    from .models import TextDocument
+    document_ids = list(documents.select_for_update().values_list('id', flat=True))
+    return document_ids, TextDocument.objects.filter(id__in=document_ids, organization_id=organization_id)
+
+
+def _link_tags(document_ids, organization_id, tags):
+    from .models import DocumentTag
+    DocumentTag.objects.bulk_create([
+        DocumentTag(document_id=document_id, organization_id=organization_id, name=name)
+        for document_id in document_ids
+        for name in tags
+    ], ignore_conflicts=True)
+
+
+def add_tags(documents, organization_id, tags):
+    """Add tags to every selected document in one UPDATE; returns the number of documents."""
+    with transaction.atomic():
+        document_ids, selected = _lock_documents(documents, organization_id)
+        vendor = connections[selected.db].vendor
+        updated = selected.update(
+            tags=RawSQL(ADD_TAGS_SQL.get(vendor, ADD_TAGS_SQL['sqlite']), [json.dumps(tags)]),
+            updated_at=Now()
+        )
+        _link_tags(document_ids, organization_id, tags)
+        refresh_tag_counts(organization_id, tags)
+    return updated
+
+
+def remove_tags(documents, organization_id, tags):
+    """Remove tags from every selected document in one UPDATE; returns the number of documents."""
+    from .models import DocumentTag
+    with transaction.atomic():
+        document_ids, selected = _lock_documents(documents, organization_id)
+        vendor = connections[selected.db].vendor
+        updated = selected.update(
+            tags=RawSQL(REMOVE_TAGS_SQL.get(vendor, REMOVE_TAGS_SQL['sqlite']), [json.dumps(tags)]),
+            updated_at=Now()
+        )
+        DocumentTag.objects.filter(document_id__in=document_ids, name__in=tags).delete()
+        refresh_tag_counts(organization_id, tags)
+    return updated
+
+
+def replace_tags(documents, organization_id, tags):
+    """Set the tags of every selected document in one UPDATE; returns the number of documents."""
+    from .models import DocumentTag
+    with transaction.atomic():
+        document_ids, selected = _lock_documents(documents, organization_id)
+        updated = selected.update(tags=tags, updated_at=Now())
+        DocumentTag.objects.filter(document_id__in=document_ids).exclude(name__in=tags).delete()
+        _link_tags(document_ids, organization_id, tags)
+        # The removed tags aren't known without reading them, so every count is refreshed
+        refresh_tag_counts(organization_id)
+    return updated
+
+
+def rewrite_tag_names(organization_id, sources, target, progress=None, chunk_size=TAG_REWRITE_CHUNK_SIZE):
+    """
+    Replace the `sources` tags with `target` on every document of an
+    organization, one chunk of documents per transaction. Calls
+    progress(documents_done) after each chunk and returns the total.
+    """
+    from .models import DocumentTag, TextDocument
+    from .sharing import invalidate_shared_documents
+    sources = list(sources)
+    done = 0
+    last_id = 0
+    while True:
+        # The links index finds the documents; versions are rewritten too, so history keeps one name
+        document_ids = list(
+            DocumentTag.objects.filter(
+                organization_id=organization_id, name__in=sources, document_id__gt=last_id
+            ).order_by('document_id').values_list('document_id', flat=True).distinct()[:chunk_size]
+        )
+        if not document_ids:
+            break
+
+        with transaction.atomic():
+            documents = TextDocument.objects.filter(id__in=document_ids, organization_id=organization_id)
+            vendor = connections[documents.db].vendor
+            documents.update(
+                tags=RawSQL(RETAG_SQL.get(vendor, RETAG_SQL['sqlite']), [json.dumps(sources), target]),
+                updated_at=Now()
+            )
+            DocumentTag.objects.filter(document_id__in=document_ids, name__in=sources).delete()
+            _link_tags(document_ids, organization_id, [target])
+            refresh_tag_counts(organization_id, sources + [target])
+        invalidate_shared_documents(document_ids)
+
+        done += len(document_ids)
+        last_id = document_ids[-1]
+        if progress:
+            progress(done)
+    return done
+
+
+def start_tag_rewrite(organization, user, job_type, sources, target):
+    """
+    Record a rename or merge as a BackgroundJob and rewrite the documents:
+    inline when few carry the tags, otherwise in a Celery worker. Returns the job.
+    """
+    from .models import BackgroundJob, DocumentTag
+    from .tasks import run_tag_rewrite_job
+
+    total = DocumentTag.objects.filter(
+        organization_id=organization.id, name__in=sources
+    ).values('document_id').distinct().count()
+    job = BackgroundJob.objects.create(
+        job_type=job_type,
+        organization=organization,
+        created_by=user,
+        parameters={'sources': list(sources), 'target': target},
+        total=total
+    )
+
+    if total <= TAG_REWRITE_INLINE_LIMIT:
+        run_tag_rewrite_job(str(job.uuid))
+        job.refresh_from_db()
+        return job
+
+    try:
+        run_tag_rewrite_job.delay(str(job.uuid))
+    except Exception as e:
+        print(f"Error queueing tag job {job.uuid}: {str(e)}")
+        job.mark_failed(f"Could not queue tag job: {str(e)}")
+    return job
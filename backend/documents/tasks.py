@@ -0,0 +1,109 @@
+"""
+Celery tasks for the documents app.
+"""
+
+from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+
+from .models import BackgroundJob
+
+# Generation makes up to four sequential LLM calls (style analysis,
+# condensation, the main completion and a title), so allow a generous limit
+GENERATION_SOFT_TIME_LIMIT = 300
+
+# Long documents take a while to lay out, but a render should never hold a PDF worker for long
+PDF_RENDER_SOFT_TIME_LIMIT = 120
+
+
+@shared_task(soft_time_limit=GENERATION_SOFT_TIME_LIMIT, time_limit=GENERATION_SOFT_TIME_LIMIT + 30)
+def run_ai_generation_job(job_uuid):
+    """Run the AI generation pipeline for a queued BackgroundJob."""
+    # Imported here to keep worker start-up from loading the OpenAI client eagerly
+    from .ai_views import run_document_generation
+
+    # Guard against duplicate deliveries running the pipeline (and charging) twice
+    job = BackgroundJob.claim(job_uuid, 'created_by__organization')
+    if job is None:
+        print(f"Generation job {job_uuid} no longer exists or was already picked up, skipping")
+        return
+
+    try:
+        response = run_document_generation(job.created_by, job.parameters)
+    except SoftTimeLimitExceeded:
+        job.mark_failed("Generation took too long and was cancelled.")
+        return
+    except Exception as e:
+        print(f"Generation job {job_uuid} failed: {str(e)}")
+        job.mark_failed(str(e))
+        return
+
+    # The pipeline reports problems as error responses rather than exceptions
+    if response.status_code >= 400:
+        data = response.data or {}
+        error = data.get('detail') or data.get('error') or f"Generation failed with status {response.status_code}"
+        job.mark_failed(str(error), result=data)
+        return
+
+    document_id = response.data.get('id')
+    document = job.organization.documents.filter(id=document_id).first() if document_id else None
+    job.mark_done(result=response.data, document=document)
+
+
+@shared_task
+def merge_similarity_index(organization_id):
+    """Fold an organization's recent document changes into its saved similarity index."""
+    from .similarity import merge_index
+
+    merge_index(organization_id)
+
+
+@shared_task
+def run_tag_rewrite_job(job_uuid):
+    """Rewrite document tags for a queued tag rename or merge BackgroundJob."""
+    from categories.models import Tag
+    from .tags import rewrite_tag_names
+
+    job = BackgroundJob.claim(job_uuid)
+    if job is None:
+        print(f"Tag job {job_uuid} no longer exists or was already picked up, skipping")
+        return
+
+    try:
+        documents = rewrite_tag_names(
+            job.organization_id,
+            job.parameters['sources'],
+            job.parameters['target'],
+            progress=job.mark_progress
+        )
+    except Exception as e:
+        print(f"Tag job {job_uuid} failed: {str(e)}")
+        job.mark_failed(str(e))
+        return
+
+    # Merged tags stay until no document carries them, so a failed merge can be retried
+    if job.job_type == 'tag_merge':
+        Tag.objects.filter(organization_id=job.organization_id, name__in=job.parameters['sources']).delete()
+    job.mark_done(result={'documents': documents})
+
+
+@shared_task(soft_time_limit=PDF_RENDER_SOFT_TIME_LIMIT, time_limit=PDF_RENDER_SOFT_TIME_LIMIT + 30)
+def run_pdf_render_job(job_uuid):
+    """Render and store the PDF for a queued pdf_render BackgroundJob."""
+    from .pdf import render_artifact
+
+    job = BackgroundJob.claim(job_uuid)
+    if job is None:
+        print(f"PDF render job {job_uuid} no longer exists or was already picked up, skipping")
+        return
+
+    try:
+        artifact = render_artifact(job)
+    except SoftTimeLimitExceeded:
+        job.mark_failed("PDF rendering took too long and was cancelled.")
+        return
+    except Exception as e:
+        print(f"PDF render job {job_uuid} failed: {str(e)}")
+        job.mark_failed(str(e))
+        return
+
+    job.mark_done(result={'artifact': artifact})
@@ -0,0 +1,1135 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from io import StringIO
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.contrib.auth import get_user_model
+from rest_framework.test import APIClient
+from rest_framework import status
+from accounts.models import Organization
+from categories.models import Category, Tag
+from .models import TextDocument, DocumentTag, DocumentPDFExport, BackgroundJob, AIPromptTemplate, AIModelSettings, DocumentLengthSettings, Comment, StyleConstraint
+from .ai_config import invalidate_ai_config, get_length_setting
+from .search import search_documents
+from .references import pack_references, fair_shares, select_reference_documents
+from .tokens import count_tokens, offset_pairs
+from . import ai_config, pdf, similarity
+from .versioning import apply_delta, make_delta
+from .ai_views import get_default_model_settings, analyze_document_style, prepare_reference_content
+from .tasks import run_ai_generation_job, run_pdf_render_job
+
+User = get_user_model()
+
+
+class DocumentTestMixin:
+    """Shared fixtures for document tests."""
+
+    def setUp(self):
+        # Cached values are keyed by ids that the next test's rows can reuse
+        cache.clear()
+        self.client = APIClient()
+        self.organization = Organization.objects.create(
+            name='Test Organization',
+            subscription_plan='basic'
+        )
+        self.user = User.objects.create_user(
+            username='writer',
+            email='writer@example.com',
+            password='writerpass123',
+            organization=self.organization,
+            role='admin'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def create_document(self, title, content='', **kwargs):
+        """Create a document in the test organization."""
+        return TextDocument.objects.create(
+            title=title,
+            content=content,
+            created_by=self.user,
+            organization=self.organization,
+            **kwargs
+        )
+
+
+class DocumentSearchTests(DocumentTestMixin, TestCase):
+    """Test document search."""
+
+    def test_search_matches_title_and_content(self):
+        """Test that every search word must match the title, content or tags."""
+        self.create_document('Quarterly report', '<p>Revenue grew in the north region.</p>')
+        self.create_document('Meeting notes', '<p>Discussed the quarterly revenue.</p>', tags=['finance'])
+        self.create_document('Holiday plans', '<p>Nothing about money.</p>')
+
+        response = self.client.get('/api/v1/documents', {'search': 'quarterly revenue'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        titles = {doc['title'] for doc in response.data['results']}
+        self.assertEqual(titles, {'Quarterly report', 'Meeting notes'})
+
+    def test_title_content_search_ignores_tags(self):
+        """Test that title_content_search does not match tags."""
+        self.create_document('Budget', '<p>Numbers.</p>', tags=['finance'])
+
+        response = self.client.get('/api/v1/documents', {'title_content_search': 'finance'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+
+    def test_full_text_search_without_tags_skips_the_stored_vector(self):
+        """Test that on PostgreSQL a search without tags matches the stored title and plain text vector."""
+        with mock.patch('documents.search.supports_full_text_search', return_value=True):
+            without_tags = str(search_documents(TextDocument.objects.all(), 'finance', include_tags=False).query)
+            with_tags = str(search_documents(TextDocument.objects.all(), 'finance').query)
+        self.assertIn('"title_content_vector" @@', without_tags.split(' WHERE ')[1])
+        self.assertIn('"search_vector" @@', with_tags.split(' WHERE ')[1])
+
+
+class GenerationJobTests(DocumentTestMixin, TestCase):
+    """Test background AI generation jobs."""
+
+    def test_submit_returns_queued_job(self):
+        """Test that submitting queues a job and returns its id immediately."""
+        with mock.patch('documents.ai_views.run_ai_generation_job.delay') as delay:
+            response = self.client.post('/api/v1/documents/generate-with-ai/jobs', {'concept': 'Test'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'queued')
+        delay.assert_called_once_with(str(response.data['uuid']))
+
+        response = self.client.get(f"/api/v1/jobs/{response.data['uuid']}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'queued')
+
+    @override_settings(OPENAI_API_KEY=None)
+    def test_failed_job_does_not_charge_credits(self):
+        """Test that a job whose pipeline fails is marked failed without using a credit."""
+        job = BackgroundJob.objects.create(
+            job_type='ai_generation',
+            organization=self.organization,
+            created_by=self.user,
+            parameters={'generation_type': 'existing', 'document_type': 'summary'}
+        )
+
+        run_ai_generation_job(str(job.uuid))
+
+        job.refresh_from_db()
+        self.organization.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('API key', job.error)
+        self.assertEqual(self.organization.ai_generations_used, 0)
+
+    def test_duplicate_delivery_runs_once(self):
+        """Test that a job already claimed by one delivery is skipped by the next."""
+        job = BackgroundJob.objects.create(
+            job_type='ai_generation',
+            organization=self.organization,
+            created_by=self.user,
+            parameters={'generation_type': 'existing', 'document_type': 'summary'}
+        )
+        self.assertEqual(BackgroundJob.claim(job.uuid).status, 'running')
+
+        with mock.patch('documents.ai_views.run_document_generation') as run:
+            run_ai_generation_job(str(job.uuid))
+        run.assert_not_called()
+        self.assertIsNone(BackgroundJob.claim(job.uuid))
+
+
+class FakeCompletionStream:
+    """Stands in for an OpenAI streaming response."""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.closed = False
+
+    def __iter__(self):
+        for piece in self.pieces:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+
+    def close(self):
+        self.closed = True
+
+
+@override_settings(OPENAI_API_KEY='test-key')
+class GenerationStreamTests(DocumentTestMixin, TestCase):
+    """Test streaming AI generation."""
+
+    def stream_events(self, response):
+        """Parse a server-sent event response into (event, data) pairs."""
+        body = b''.join(response.streaming_content).decode()
+        events = []
+        for block in body.strip().split('\n\n'):
+            event, data = block.split('\n', 1)
+            events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        return events
+
+    def test_stream_sends_tokens_then_saves_document(self):
+        """Test that tokens are streamed and the document is saved and charged at the end."""
+        self.create_document('Reference', '<p>Some reference text.</p>')
+        stream = FakeCompletionStream(['<h1>Streamed title</h1>', '<p>Body</p>'])
+        with mock.patch('documents.ai_views.OpenAI') as client_class, \
+                mock.patch('documents.ai_views.count_tokens', return_value=10):
+            client_class.return_value.chat.completions.create.return_value = stream
+            response = self.client.post(
+                '/api/v1/documents/generate-with-ai/stream',
+                {'generation_type': 'existing', 'document_type': 'summary'},
+                format='json'
+            )
+            events = self.stream_events(response)
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(events[0], ('status', {'stage': 'preparing'}))
+        self.assertEqual([data['text'] for event, data in events if event == 'token'],
+                         ['<h1>Streamed title</h1>', '<p>Body</p>'])
+        self.assertEqual(events[-1][0], 'done')
+        self.assertEqual(events[-1][1]['title'], 'Streamed title')
+        self.assertTrue(stream.closed)
+
+        self.organization.refresh_from_db()
+        self.assertEqual(self.organization.ai_generations_used, 1)
+        self.assertTrue(TextDocument.objects.filter(title='Streamed title').exists())
+
+
+class AIConfigCacheTests(DocumentTestMixin, TestCase):
+    """Test the process-wide AI configuration cache."""
+
+    def setUp(self):
+        super().setUp()
+        AIPromptTemplate.objects.create(name='Global', template_type='formatting', content='global formatting')
+        AIPromptTemplate.objects.create(name='Org', template_type='formatting', content='org formatting',
+                                        organization=self.organization)
+        AIModelSettings.objects.create(model_name='test-model', max_tokens=1000, is_default=True)
+        DocumentLengthSettings.objects.create(length_name='test_length', description='test length', target_tokens=500)
+        invalidate_ai_config()
+
+    def tearDown(self):
+        # Snapshots outlive the test transaction, so drop them with it
+        invalidate_ai_config()
+        super().tearDown()
+
+    def test_warm_cache_needs_no_queries(self):
+        """Test that configuration lookups hit the database only once per organization."""
+        self.assertEqual(AIPromptTemplate.get_template('formatting', self.organization), 'org formatting')
+        get_default_model_settings()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(AIPromptTemplate.get_template('formatting', self.organization), 'org formatting')
+            self.assertIsNone(AIPromptTemplate.get_template('summary', self.organization))
+            self.assertEqual(get_default_model_settings()['model'], 'test-model')
+            self.assertEqual(get_length_setting('test_length', self.organization)['target_tokens'], 500)
+
+        self.assertEqual(AIPromptTemplate.get_template('formatting'), 'global formatting')
+
+    def test_save_and_delete_invalidate_cache(self):
+        """Test that changing a configuration row is visible on the next lookup."""
+        template = AIPromptTemplate.objects.get(organization=self.organization)
+        self.assertEqual(AIPromptTemplate.get_template('formatting', self.organization), 'org formatting')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            template.content = 'updated formatting'
+            template.save()
+        self.assertEqual(AIPromptTemplate.get_template('formatting', self.organization), 'updated formatting')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            template.delete()
+        self.assertEqual(AIPromptTemplate.get_template('formatting', self.organization), 'global formatting')
+
+    def test_snapshot_expires_without_invalidation(self):
+        """Test that a snapshot is reloaded after SNAPSHOT_TTL even if no invalidation arrives."""
+        self.assertEqual(AIPromptTemplate.get_template('formatting', self.organization), 'org formatting')
+        # Changed behind the cache's back, as if the invalidation were lost
+        AIPromptTemplate.objects.filter(organization=self.organization).update(content='changed formatting')
+
+        self.assertEqual(AIPromptTemplate.get_template('formatting', self.organization), 'org formatting')
+        later = time.monotonic() + ai_config.SNAPSHOT_TTL
+        with mock.patch('documents.ai_config.time.monotonic', return_value=later):
+            self.assertEqual(AIPromptTemplate.get_template('formatting', self.organization), 'changed formatting')
+
+
+@override_settings(OPENAI_API_KEY='test-key')
+class StyleAnalysisCacheTests(DocumentTestMixin, TestCase):
+    """Test content-addressed caching of style analyses."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
+
+    def analyze(self, document):
+        """Run a style analysis of one document with a mocked OpenAI client."""
+        with mock.patch('documents.ai_views.OpenAI') as client_class, \
+                mock.patch('documents.ai_views.count_tokens', return_value=10):
+            client_class.return_value.chat.completions.create.return_value = SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content='Write plainly.'))]
+            )
+            result = analyze_document_style(prepare_reference_content([document]), user=self.user)
+            return result, client_class.return_value.chat.completions.create.call_count
+
+    def test_same_text_is_analyzed_once(self):
+        """Test that identical reference text under another document id is served from cache."""
+        first = self.create_document('Notes', '<p>Same words.</p>')
+        second = self.create_document('Notes', '<p>Same words.</p>')
+
+        result, calls = self.analyze(first)
+        self.assertEqual(calls, 2)
+        cached_result, calls = self.analyze(second)
+        self.assertEqual(calls, 0)
+        self.assertEqual(cached_result['analysis_key'], result['analysis_key'])
+        self.assertEqual(cached_result['condensed_style'], 'Write plainly.')
+
+    def test_edited_document_is_analyzed_again(self):
+        """Test that editing a reference document changes the analysis key."""
+        document = self.create_document('Notes', '<p>Original words.</p>')
+        result, calls = self.analyze(document)
+
+        document.content = '<p>Edited words.</p>'
+        document.save()
+        edited_result, calls = self.analyze(document)
+        self.assertEqual(calls, 2)
+        self.assertNotEqual(edited_result['analysis_key'], result['analysis_key'])
+
+
+class ReferencePackingTests(TestCase):
+    """Test packing reference documents into a token budget."""
+
+    model = 'gpt-3.5-turbo-0125'
+
+    def document(self, title, sentence, count):
+        return SimpleNamespace(title=title, plain_text=' '.join([sentence] * count))
+
+    def test_fair_shares(self):
+        """Test that small needs are met in full and the rest is split equally."""
+        self.assertEqual(fair_shares([10, 500, 500], 310), [10, 150, 150])
+        self.assertEqual(fair_shares([10, 20], 1000), [10, 20])
+
+    def test_budget_is_shared_and_cut_at_sentences(self):
+        """Test that every document gets room, long ones end on a sentence, and the budget holds."""
+        short = self.document('Short', 'A brief note.', 1)
+        long_documents = [
+            self.document(f'Long {i}', 'This sentence is repeated to make a long document.', 300)
+            for i in range(3)
+        ]
+
+        combined = pack_references([short] + long_documents, 1000, self.model)
+
+        self.assertLessEqual(count_tokens(combined, self.model), 1000)
+        self.assertIn('Content: A brief note.\n\n', combined)
+        for snippet in combined.split('\n---\n')[1:]:
+            self.assertTrue(snippet.startswith('Title: Long'))
+            self.assertTrue(snippet.endswith('document.\n\n'))
+        self.assertEqual(combined.count('Title: Long'), 3)
+        # The unused part of the short document's share goes to the long ones
+        self.assertGreater(count_tokens(combined, self.model), 900)
+
+
+@override_settings(OPENAI_API_KEY='test-key')
+class ReferenceSelectionTests(DocumentTestMixin, TestCase):
+    """Test selecting reference documents in the database."""
+
+    def setUp(self):
+        super().setUp()
+        self.create_document('Both', '<p>Tagged twice.</p>', tags=['news', 'sport'], status='published')
+        self.create_document('News', '<p>Tagged once.</p>', tags=['news'], status='published')
+        self.create_document('Draft', '<p>Not published.</p>', tags=['news', 'sport'], status='draft')
+        self.create_document('Untagged', '<p>No tags.</p>', status='published')
+
+    def test_filters_and_deferred_content(self):
+        """Test that documents need every tag and only prompt fields are loaded."""
+        queryset = TextDocument.objects.filter(organization=self.organization)
+        selected = select_reference_documents(queryset, tags=['news', 'sport'])
+        self.assertEqual(sorted(doc.title for doc in selected), ['Both', 'Draft'])
+
+        selected = list(select_reference_documents(queryset, status='draft', tags=['sport']))
+        self.assertEqual([doc.title for doc in selected], ['Draft'])
+        self.assertIn('content', selected[0].get_deferred_fields())
+        self.assertNotIn('plain_text', selected[0].get_deferred_fields())
+
+    def test_generation_uses_tag_filter(self):
+        """Test that generation picks its references by tag without loading whole documents."""
+        response = self.client.post(
+            '/api/v1/documents/generate-with-ai',
+            {'generation_type': 'existing', 'document_type': 'summary', 'tags': ['news'],
+             'status': 'published', 'debug_mode': True},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['document_count'], 2)
+        self.assertEqual(sorted(response.data['document_titles']), ['Both', 'News'])
+        self.assertIn('Tagged twice.', response.data['prompt'])
+        self.assertNotIn('No tags.', response.data['prompt'])
+
+
+class DocumentTextStatsTests(DocumentTestMixin, TestCase):
+    """Test the text statistics stored on documents."""
+
+    def test_stats_follow_content(self):
+        """Test that statistics are computed on create and recomputed when content changes."""
+        document = self.create_document('Stats', '<p>One sentence here. Another one!</p>')
+        self.assertEqual(document.word_count, 5)
+        self.assertGreater(document.token_count, 0)
+        ends = [end for end, tokens in offset_pairs(document.sentence_offsets)]
+        self.assertEqual(document.plain_text[:ends[0]].strip(), 'One sentence here.')
+        self.assertEqual(ends[-1], len(document.plain_text))
+
+        document = TextDocument.objects.get(pk=document.pk)
+        document.content = '<p>Just three words.</p>'
+        document.save(update_fields=['content'])
+        document.refresh_from_db()
+        self.assertEqual(document.word_count, 3)
+        self.assertEqual(document.plain_text, 'Just three words.')
+
+    def test_backfill_command(self):
+        """Test that the backfill command fills in missing statistics."""
+        document = self.create_document('Old', '<p>Written before statistics existed.</p>')
+        TextDocument.objects.filter(pk=document.pk).update(token_count=0, word_count=0, sentence_offsets=[])
+
+        call_command('compute_document_stats', stdout=StringIO())
+
+        document.refresh_from_db()
+        self.assertEqual(document.word_count, 4)
+        self.assertGreater(document.token_count, 0)
+
+
+class DocumentVersionStorageTests(DocumentTestMixin, TestCase):
+    """Test storing older document versions as deltas."""
+
+    def edit(self, document, content, new_version=True):
+        response = self.client.patch(
+            f'/api/v1/documents/{document.slug}',
+            {'content': content, 'create_new_version': new_version},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_delta_round_trip(self):
+        """Test that a delta rebuilds the older text exactly."""
+        newer = '<p>The quick brown fox jumps over the lazy dog.</p>\n<p>Second paragraph.</p>'
+        older = '<p>The quick red fox jumped over the dog.</p>\n<p>Second  paragraph!</p>'
+        self.assertEqual(apply_delta(make_delta(newer, older), newer), older)
+        self.assertEqual(apply_delta(make_delta(newer, ''), newer), '')
+
+    def test_only_latest_version_is_stored_in_full(self):
+        """Test that older versions keep a delta and are rebuilt for version lookups."""
+        document = self.create_document('History', '<p>First draft of the text.</p>')
+        self.edit(document, '<p>Second draft of the text.</p>')
+        self.edit(document, '<p>Third and final draft of the text.</p>')
+        # Editing the latest version in place must not change what older versions rebuild to
+        self.edit(document, '<p>Third and final draft of the whole text.</p>', new_version=False)
+
+        stored = list(TextDocument.objects.filter(slug=document.slug).order_by('version'))
+        self.assertEqual([bool(version.content) for version in stored], [False, False, True])
+        self.assertIsNone(stored[-1].content_delta)
+
+        cache.clear()
+        response = self.client.get(
+            f'/api/v1/documents/{document.slug}', {'latest_only': 'false', 'version': 1}
+        )
+        self.assertEqual(response.data['content'], '<p>First draft of the text.</p>')
+
+        response = self.client.get(f'/api/v1/documents/{document.slug}/versions')
+        self.assertEqual([version['plain_text'] for version in response.data['results']], [
+            'First draft of the text.',
+            'Second draft of the text.',
+            'Third and final draft of the whole text.',
+        ])
+
+    def test_versions_share_one_lineage_with_one_latest(self):
+        """Test that new versions join the lineage and only one of them can be latest."""
+        document = self.create_document('Lineage', '<p>First.</p>')
+        self.edit(document, '<p>Second.</p>')
+        self.edit(document, '<p>Third.</p>')
+
+        versions = TextDocument.objects.filter(lineage=document.lineage).order_by('version')
+        self.assertEqual([version.version for version in versions], [1, 2, 3])
+        self.assertEqual([version.is_latest for version in versions], [False, False, True])
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            TextDocument.objects.filter(pk=document.pk).update(is_latest=True)
+
+    def test_deleting_a_version_restores_its_parent(self):
+        """Test that a parent stored as a delta gets its full body back when its child goes."""
+        document = self.create_document('Short history', '<p>Original.</p>')
+        self.edit(document, '<p>Replacement.</p>')
+
+        TextDocument.objects.get(slug=document.slug, is_latest=True).delete()
+
+        original = TextDocument.objects.get(pk=document.pk)
+        self.assertIsNone(original.content_delta)
+        self.assertEqual(original.content, '<p>Original.</p>')
+        self.assertEqual(original.rendered_html, '<p>Original.</p>')
+        self.assertEqual((original.excerpt, original.word_count), ('Original.', 1))
+
+
+class DocumentPaginationTests(DocumentTestMixin, TestCase):
+    """Test cursor and page-number pagination of document listings."""
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='Reports', organization=self.organization)
+        for number in range(5):
+            self.create_document(f'Report {number}', f'<p>Report number {number}.</p>', category=self.category)
+
+    def collect(self, url, params):
+        """Follow next links from a first page and return every title seen."""
+        titles = []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            titles += [document['title'] for document in response.data['results']]
+            if not response.data['next']:
+                return titles
+            response = self.client.get(response.data['next'])
+
+    def test_cursor_pages_cover_every_document_once(self):
+        """Test that following cursors returns each document once, newest first."""
+        titles = self.collect('/api/v1/documents', {'page_size': 2})
+        self.assertEqual(titles, [f'Report {number}' for number in reversed(range(5))])
+
+    def test_page_numbers_stay_available(self):
+        """Test that ?page= still returns page-number responses with a count."""
+        response = self.client.get('/api/v1/documents', {'page': 2, 'page_size': 2})
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual([document['title'] for document in response.data['results']], ['Report 2', 'Report 1'])
+
+    def test_lean_listing_and_field_selection(self):
+        """Test that lean listings send an excerpt instead of the plain text, and ?fields= trims them."""
+        self.create_document('Long', '<p>' + 'word ' * 400 + '</p>')
+
+        response = self.client.get('/api/v1/documents', {'view': 'lean'})
+        document = response.data['results'][0]
+        self.assertNotIn('plain_text', document)
+        self.assertEqual(document['title'], 'Long')
+        self.assertLessEqual(len(document['excerpt']), 280)
+        self.assertTrue(document['excerpt'].endswith('word…'))
+
+        response = self.client.get('/api/v1/documents', {'fields': 'id,title'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'title'})
+
+        response = self.client.get('/api/v1/documents')
+        self.assertIn('plain_text', response.data['results'][0])
+
+    def test_category_documents_are_paginated(self):
+        """Test that the category documents listing no longer returns everything at once."""
+        titles = self.collect(f'/api/v1/categories/{self.category.slug}/documents', {'page_size': 3})
+        self.assertEqual(sorted(titles), [f'Report {number}' for number in range(5)])
+
+
+class QueryBudgetTests(DocumentTestMixin, TestCase):
+    """
+    Test that endpoints stay within a fixed number of queries. The fixtures
+    hold enough rows that a per-row lookup exceeds the budget; raise a budget
+    only for a new fixed cost, never for one that grows with the rows.
+    """
+
+    QUERY_BUDGETS = {
+        'document list': 1,
+        'document detail': 3,
+        'document versions': 4,
+        'category documents': 3,
+        'category tree': 1,
+        'style constraints': 3,
+    }
+
+    def setUp(self):
+        super().setUp()
+        other_user = User.objects.create_user(
+            username='editor', email='editor@example.com', password='editorpass123',
+            organization=self.organization
+        )
+        parent = Category.objects.create(name='Parent', organization=self.organization)
+        self.category = Category.objects.create(name='Child', organization=self.organization, parent=parent)
+        for number in range(3):
+            Category.objects.create(name=f'Grandchild {number}', organization=self.organization, parent=self.category)
+
+        documents = []
+        for number in range(10):
+            document = self.create_document(f'Budget {number}', f'<p>Text {number}.</p>', category=self.category)
+            Comment.objects.create(document=document, user=other_user, text='Nice.')
+            Comment.objects.create(document=document, user=self.user, text='Thanks.')
+            documents.append(document)
+        self.document = documents[0]
+        for number in range(3):
+            self.document = self.document.create_new_version()
+
+        for number in range(5):
+            constraint = StyleConstraint.objects.create(
+                name=f'Style {number}', organization=self.organization, created_by=self.user
+            )
+            constraint.reference_documents.set(documents[:3])
+
+    def assertWithinBudget(self, name, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertLessEqual(
+            len(queries), self.QUERY_BUDGETS[name],
+            f"{name} ran {len(queries)} queries:\n" + '\n'.join(query['sql'] for query in queries)
+        )
+        return response
+
+    def test_document_endpoints(self):
+        """Test the document list, detail and version endpoints."""
+        self.assertWithinBudget('document list', '/api/v1/documents')
+        self.assertWithinBudget('document detail', f'/api/v1/documents/{self.document.slug}')
+        self.assertWithinBudget('document versions', f'/api/v1/documents/{self.document.slug}/versions')
+
+    def test_category_endpoints(self):
+        """Test the category tree and category documents endpoints."""
+        response = self.assertWithinBudget('category tree', '/api/v1/categories/tree')
+        [root] = response.data
+        self.assertEqual((root['document_count'], root['all_documents_count']), (0, 10))
+        self.assertEqual(len(root['children'][0]['children']), 3)
+        self.assertWithinBudget('category documents', f'/api/v1/categories/{self.category.slug}/documents')
+
+    def test_style_constraint_endpoints(self):
+        """Test the style constraint list."""
+        self.assertWithinBudget('style constraints', '/api/v1/style-constraints')
+
+
+class SimilarityIndexTests(DocumentTestMixin, TestCase):
+    """Test the per-organization similarity index."""
+
+    def setUp(self):
+        super().setUp()
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        settings_override = override_settings(SIMILARITY_INDEX_DIR=index_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        similarity._indexes.clear()
+        # What the merge task does for an organization without an index
+        similarity.merge_index(self.organization.id)
+
+    def tearDown(self):
+        similarity._indexes.clear()
+        super().tearDown()
+
+    def relevant_titles(self, text):
+        documents = TextDocument.objects.filter(organization=self.organization, is_latest=True)
+        return [doc.title for doc in similarity.select_relevant_documents(documents, self.organization.id, text)]
+
+    def test_documents_ranked_by_similarity(self):
+        """Test that the closest documents come first and unrelated ones are left out."""
+        self.create_document('Garden', '<p>Tomato plants need rich soil and plenty of sun in the garden.</p>')
+        self.create_document('Kitchen', '<p>Slice the tomato and serve it with fresh bread.</p>')
+        self.create_document('Finance', '<p>Quarterly revenue grew by ten percent.</p>')
+
+        self.assertEqual(self.relevant_titles('growing tomato plants in garden soil'), ['Garden', 'Kitchen'])
+
+    def test_index_follows_document_changes(self):
+        """Test that saves, deletes and changes from other processes reach the index."""
+        document = self.create_document('Notes', '<p>Nothing in particular.</p>')
+        self.assertEqual(self.relevant_titles('sailing boats'), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            document.content = '<p>Sailing boats on the fjord.</p>'
+            document.save()
+        self.assertEqual(self.relevant_titles('sailing boats'), ['Notes'])
+
+        # A change made elsewhere is picked up by the updated_at sync
+        other = self.create_document('Other', '<p>Mountains.</p>')
+        TextDocument.objects.filter(pk=other.pk).update(plain_text='Boats and sailing every summer.', updated_at=timezone.now())
+        self.assertEqual(set(self.relevant_titles('sailing boats')), {'Notes', 'Other'})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            document.delete()
+        self.assertEqual(self.relevant_titles('sailing boats'), ['Other'])
+
+    def test_saved_index_is_memory_mapped(self):
+        """Test that a new process loads the saved index from disk and catches up with later changes."""
+        self.create_document('Garden', '<p>Tomato plants need rich soil.</p>')
+        self.assertEqual(self.relevant_titles('tomato soil'), ['Garden'])
+
+        # Simulate another process: nothing in memory, a document added since the index was saved
+        similarity._indexes.clear()
+        self.create_document('Greenhouse', '<p>Tomato seedlings in the greenhouse.</p>')
+        index = similarity.get_index(self.organization.id)
+        self.assertIsInstance(index.base_ids, np.memmap)
+        self.assertEqual(set(self.relevant_titles('tomato')), {'Garden', 'Greenhouse'})
+
+    def test_missing_index_is_built_in_the_background(self):
+        """Test that without a saved index requests fall back to recent documents and queue a build."""
+        similarity._indexes.clear()
+        shutil.rmtree(similarity.index_dir(self.organization.id))
+        document = self.create_document('Boats', '<p>Sailing boats on the fjord in summer.</p>')
+        self.create_document('Taxes', '<p>File tax returns before April.</p>')
+
+        with mock.patch('documents.tasks.merge_similarity_index.delay') as delay:
+            response = self.client.get(f'/api/v1/documents/{document.slug}/similar')
+            self.assertEqual(self.relevant_titles('sailing boats'), [])
+        delay.assert_called_once_with(self.organization.id)
+        self.assertEqual([(item['title'], item['similarity']) for item in response.data], [('Taxes', None)])
+        self.assertIsNone(similarity.current_generation(self.organization.id))
+
+        similarity.merge_index(self.organization.id)
+        self.assertEqual(self.relevant_titles('sailing boats'), ['Boats'])
+
+    def test_similar_endpoint(self):
+        """Test that the similar action returns other documents ranked by content."""
+        document = self.create_document('Boats', '<p>Sailing boats on the fjord in summer.</p>')
+        self.create_document('Sailing', '<p>Summer sailing on the fjord.</p>')
+        self.create_document('Taxes', '<p>File tax returns before April.</p>')
+
+        response = self.client.get(f'/api/v1/documents/{document.slug}/similar')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['title'] for item in response.data], ['Sailing'])
+        self.assertGreater(response.data[0]['similarity'], 0)
+
+
+class BulkTagTests(DocumentTestMixin, TestCase):
+    """Test set-based bulk tagging."""
+
+    def setUp(self):
+        super().setUp()
+        self.news = Tag.objects.create(name='news', organization=self.organization)
+        self.documents = [
+            self.create_document(f'Tagged {number}', tags=['old', 'news'] if number else ['old'])
+            for number in range(4)
+        ]
+        self.document_ids = [document.id for document in self.documents]
+
+    def post(self, operation, tags):
+        return self.client.post(
+            f'/api/v1/documents/bulk/{operation}',
+            {'document_ids': self.document_ids, 'tags': tags},
+            format='json'
+        )
+
+    def stored_tags(self):
+        return [document.tags for document in TextDocument.objects.filter(id__in=self.document_ids).order_by('id')]
+
+    def test_add_and_remove_tags(self):
+        """Test that tags are added and removed in place, keeping order and links in step."""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post('add-tags', ['news', 'extra'])
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(self.stored_tags(), [['old', 'news', 'extra']] * 4)
+
+        # The statements run don't grow with the number of documents
+        self.document_ids.extend(self.create_document(f'More {number}').id for number in range(4))
+        with CaptureQueriesContext(connection) as more_queries:
+            self.post('add-tags', ['news', 'extra'])
+        self.assertEqual(len(more_queries), len(queries))
+        self.news.refresh_from_db()
+        self.assertEqual(self.news.document_count, 8)
+
+        response = self.post('remove-tags', ['old', 'news'])
+        self.assertEqual(response.data['count'], 8)
+        self.assertEqual(self.stored_tags(), [['extra']] * 8)
+        self.news.refresh_from_db()
+        self.assertEqual(self.news.document_count, 0)
+        self.assertEqual(
+            set(DocumentTag.objects.filter(document_id__in=self.document_ids).values_list('name', flat=True)),
+            {'extra'}
+        )
+
+    def test_replace_tags(self):
+        """Test that replacing sets the same tags on every document and an empty list clears them."""
+        response = self.post('replace-tags', ['news'])
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(self.stored_tags(), [['news']] * 4)
+        self.news.refresh_from_db()
+        self.assertEqual(self.news.document_count, 4)
+
+        self.post('replace-tags', [])
+        self.assertEqual(self.stored_tags(), [[]] * 4)
+        self.assertFalse(DocumentTag.objects.filter(document_id__in=self.document_ids).exists())
+
+    def test_invalid_tags_are_rejected(self):
+        """Test that tags must be a non-empty list of names."""
+        self.assertEqual(self.post('add-tags', []).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post('add-tags', 'news').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post('remove-tags', [1]).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SlugAllocationTests(DocumentTestMixin, TestCase):
+    """Test slug allocation through the per-organization unique constraint."""
+
+    def test_duplicate_titles_get_distinct_slugs_without_lookups(self):
+        """Test that a taken slug is retried with a suffix instead of being looked up first."""
+        with CaptureQueriesContext(connection) as queries:
+            first = self.create_document('Weekly Update')
+        self.assertEqual(first.slug, 'weekly-update')
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT')])
+
+        second = self.create_document('Weekly Update')
+        self.assertRegex(second.slug, r'^weekly-update-[a-z0-9]{4}$')
+
+        # Versions keep their document's slug
+        newer = first.create_new_version()
+        self.assertEqual(newer.slug, 'weekly-update')
+
+    def test_conflict_inside_a_transaction_is_recovered(self):
+        """Test that a rejected slug doesn't break the surrounding transaction."""
+        self.create_document('Plan')
+        with transaction.atomic():
+            document = self.create_document('Plan')
+            self.create_document('!!!')
+        self.assertNotEqual(document.slug, 'plan')
+        self.assertTrue(TextDocument.objects.filter(slug='textdocument').exists())
+
+
+class ContentRenditionTests(DocumentTestMixin, TestCase):
+    """Test format detection and the stored content renditions."""
+
+    def test_formats_are_detected_and_rendered(self):
+        """Test that HTML, Slate JSON and Markdown content get the same kind of renditions."""
+        slate = json.dumps([{'type': 'heading-one', 'children': [{'text': 'Plan'}]},
+                            {'type': 'paragraph', 'children': [{'text': 'Ship', 'bold': True}, {'text': ' it & go.'}]}])
+        cases = [
+            ('<h1>Plan</h1><p><strong>Ship</strong> it &amp; go.</p>', 'html'),
+            (slate, 'slate'),
+            ('# Plan\n\n**Ship** it & go.', 'markdown'),
+        ]
+        for content, content_format in cases:
+            document = self.create_document('Formats', content)
+            self.assertEqual(document.content_format, content_format)
+            self.assertEqual(document.plain_text, 'Plan Ship it & go.')
+            self.assertIn('<strong>Ship</strong> it &amp; go.', document.content_html)
+            self.assertEqual(document.excerpt, 'Plan Ship it & go.')
+
+    def test_renditions_are_only_derived_when_content_changes(self):
+        """Test that saves which leave the content alone don't parse it again."""
+        document = self.create_document('Stable', '<p>Unchanged text.</p>')
+        document = TextDocument.objects.get(pk=document.pk)
+        with mock.patch('documents.models.render_content') as render:
+            document.status = 'published'
+            document.save(update_fields=['status'])
+            document.title = 'Renamed'
+            document.save()
+        render.assert_not_called()
+
+        document.content = '<p>New text.</p>'
+        document.save(update_fields=['content'])
+        document.refresh_from_db()
+        self.assertEqual((document.plain_text, document.content_html), ('New text.', '<p>New text.</p>'))
+
+    def test_export_serves_the_stored_html(self):
+        """Test that the PDF export data uses the stored HTML rendition."""
+        document = self.create_document('Export', '- one\n- two')
+        response = self.client.get(f'/api/v1/documents/{document.slug}/export_pdf')
+        self.assertEqual(response.data['html_content'], document.content_html)
+        self.assertIn('<li>one</li>', response.data['html_content'])
+
+
+class SharedDocumentCacheTests(DocumentTestMixin, TestCase):
+    """Test the cached payloads of shared document links."""
+
+    def setUp(self):
+        super().setUp()
+        self.document = self.create_document('Shared', '# Shared\n\nSome *markdown*.')
+        self.export = DocumentPDFExport.objects.create(document=self.document, created_by=self.user)
+        self.anonymous = APIClient()
+
+    def get_share(self, kind='html'):
+        response = self.anonymous.get(f'/api/v1/shared-{kind}/{self.export.uuid}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_repeat_views_are_served_from_the_cache(self):
+        """Test that a second view only loads the share and the document's stamps and reuses the payload."""
+        first = self.get_share()
+        with self.assertNumQueries(2):
+            second = self.get_share('pdf')
+        self.assertEqual(second.data['html_content'], first.data['html_content'])
+        self.assertEqual(second.data['document'], first.data['document'])
+
+    def test_changes_reach_the_share(self):
+        """Test that saving the document or commenting on it refreshes the payload."""
+        self.get_share()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.document.content = 'Rewritten.'
+            self.document.save()
+        self.assertEqual(self.get_share().data['html_content'], '<p>Rewritten.</p>')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(document=self.document, user=self.user, text='Looks good.')
+        self.assertEqual(len(self.get_share().data['document']['comments']), 1)
+
+        self.client.post('/api/v1/documents/bulk/update-status', {
+            'document_ids': [self.document.id], 'status': 'archived'
+        }, format='json')
+        self.assertEqual(self.get_share().data['document']['status'], 'archived')
+
+    def test_category_changes_reach_the_share(self):
+        """Test that renaming the document's category refreshes the payload."""
+        category = Category.objects.create(name='Reports', organization=self.organization)
+        self.document.category = category
+        with self.captureOnCommitCallbacks(execute=True):
+            self.document.save()
+        self.assertEqual(self.get_share().data['document']['category_name'], 'Reports')
+
+        category.name = 'Annual reports'
+        category.save()
+        self.assertEqual(self.get_share().data['document']['category_name'], 'Annual reports')
+
+
+class ShareSnapshotTests(DocumentTestMixin, TestCase):
+    """Test shares frozen at creation time."""
+
+    def setUp(self):
+        super().setUp()
+        self.document = self.create_document('Frozen', '<p>First draft.</p>')
+        self.anonymous = APIClient()
+
+    def create_share(self, **data):
+        response = self.client.post(
+            f'/api/v1/documents/{self.document.slug}/create_pdf_share', {'snapshot': True, **data}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data['is_snapshot'])
+        return DocumentPDFExport.objects.get(uuid=response.data['uuid'])
+
+    def test_snapshot_is_served_as_created(self):
+        """Test that a snapshot share keeps its content after the document changes, from one query."""
+        export = self.create_share()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.document.title = 'Renamed'
+            self.document.content = '<p>Second draft.</p>'
+            self.document.save()
+
+        url = f'/api/v1/shared-html/{export.uuid}/'
+        with self.assertNumQueries(1):
+            response = self.anonymous.get(url)
+        self.assertEqual(response.data['html_content'], '<p>First draft.</p>')
+        self.assertEqual(response.data['document']['title'], 'Frozen')
+        self.assertEqual(response['ETag'], f'"{export.uuid.hex}"')
+        # Deleting the share must take effect as soon as for a live share
+        self.assertEqual(response['Cache-Control'], 'public, max-age=300')
+        with mock.patch('documents.views.read_snapshot') as read_snapshot:
+            response = self.anonymous.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        read_snapshot.assert_not_called()
+
+        live = DocumentPDFExport.objects.create(document=self.document, created_by=self.user)
+        response = self.anonymous.get(f'/api/v1/shared-pdf/{live.uuid}/')
+        self.assertEqual(response.data['html_content'], '<p>Second draft.</p>')
+
+        listed = {item['uuid']: item['is_snapshot'] for item in self.client.get('/api/v1/pdf-exports').data['results']}
+        self.assertEqual(listed, {str(export.uuid): True, str(live.uuid): False})
+
+    def test_pin_protected_snapshot(self):
+        """Test that a PIN snapshot describes itself from the snapshot and still needs the PIN."""
+        export = self.create_share(pin_protected=True)
+        url = f'/api/v1/shared-pdf/{export.uuid}/'
+        with self.assertNumQueries(1):
+            response = self.anonymous.get(url)
+        self.assertEqual(response.data['document_title'], 'Frozen')
+        self.assertNotIn('html_content', response.data)
+
+        wrong_pin = '0000' if export.pin_code != '0000' else '1111'
+        with mock.patch('documents.views.read_snapshot') as read_snapshot:
+            response = self.anonymous.post(url, {'pin_code': wrong_pin}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        read_snapshot.assert_not_called()
+        response = self.anonymous.post(url, {'pin_code': export.pin_code}, format='json')
+        self.assertEqual(response.data['html_content'], '<p>First draft.</p>')
+        self.assertEqual(response['Cache-Control'], 'private, no-store')
+
+        # An expired share is refused without decompressing its snapshot
+        DocumentPDFExport.objects.filter(pk=export.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        with mock.patch('documents.views.read_snapshot') as read_snapshot:
+            response = self.anonymous.post(url, {'pin_code': export.pin_code}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        read_snapshot.assert_not_called()
+
+
+class PDFRenderTests(DocumentTestMixin, TestCase):
+    """Test server-side PDF rendering and its stored artifacts."""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.document = self.create_document('Printable', '<p>First draft.</p>')
+        self.anonymous = APIClient()
+
+    def request_pdf(self, client, url, **data):
+        """Ask for a PDF (posting the PIN when there is one) without a Celery worker."""
+        with mock.patch('documents.tasks.run_pdf_render_job.delay') as delay:
+            if 'pin_code' in data:
+                response = client.post(url, data, format='json')
+            else:
+                response = client.get(url, data)
+        return response, delay
+
+    def render_queued(self):
+        """Run the queued render jobs with a stand-in renderer; returns the HTML it was given."""
+        pages = []
+        with mock.patch('documents.pdf.html_to_pdf', side_effect=lambda page: pages.append(page) or b'%PDF-1.7'):
+            for job in BackgroundJob.objects.filter(job_type='pdf_render', status='queued'):
+                run_pdf_render_job(str(job.uuid))
+        return pages
+
+    def test_pdf_is_rendered_once_per_version_and_options(self):
+        """Test that a PDF is queued once, then served from storage until the document changes."""
+        url = f'/api/v1/documents/{self.document.slug}/pdf'
+        response, delay = self.request_pdf(self.client, url)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        delay.assert_called_once_with(str(response.data['uuid']))
+        # A second request while the first render is queued joins it
+        again, delay = self.request_pdf(self.client, url)
+        self.assertEqual(again.data['uuid'], response.data['uuid'])
+        delay.assert_not_called()
+
+        # A job queued behind a busy worker is still joined
+        BackgroundJob.objects.filter(uuid=response.data['uuid']).update(created_at=timezone.now() - timedelta(minutes=10))
+        again, delay = self.request_pdf(self.client, url)
+        self.assertEqual(again.data['uuid'], response.data['uuid'])
+        delay.assert_not_called()
+
+        # A job running past the task's time limit is replaced
+        BackgroundJob.objects.filter(uuid=response.data['uuid']).update(
+            status='running', started_at=timezone.now() - timedelta(minutes=10)
+        )
+        replaced, delay = self.request_pdf(self.client, url)
+        self.assertNotEqual(replaced.data['uuid'], response.data['uuid'])
+        delay.assert_called_once_with(str(replaced.data['uuid']))
+        self.assertEqual(BackgroundJob.objects.get(uuid=response.data['uuid']).status, 'failed')
+
+        # So is a job no worker picked up
+        BackgroundJob.objects.filter(uuid=replaced.data['uuid']).update(created_at=timezone.now() - timedelta(hours=1))
+        requeued, delay = self.request_pdf(self.client, url)
+        self.assertNotEqual(requeued.data['uuid'], replaced.data['uuid'])
+        delay.assert_called_once_with(str(requeued.data['uuid']))
+
+        pages = self.render_queued()
+        self.assertEqual(len(pages), 1)
+        self.assertIn('<p>First draft.</p>', pages[0])
+        self.assertIn('size: A4 portrait', pages[0])
+
+        with mock.patch('documents.pdf.html_to_pdf') as renderer:
+            response = self.client.get(url)
+        renderer.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(b''.join(response.streaming_content), b'%PDF-1.7')
+
+        # Other options are another artifact
+        response, delay = self.request_pdf(self.client, url, page_size='Letter', orientation='landscape')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn('size: Letter landscape', self.render_queued()[0])
+
+        self.document.content = '<p>Second draft.</p>'
+        self.document.save()
+        response, delay = self.request_pdf(self.client, url)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn('<p>Second draft.</p>', self.render_queued()[0])
+        # Only the current save's PDF is kept
+        self.assertEqual(len(os.listdir(os.path.join(settings.MEDIA_ROOT, 'pdf-renders', str(self.document.id)))), 1)
+
+    def test_renderer_only_loads_inline_resources(self):
+        """Test that local files and network URLs in document HTML are refused by the renderer."""
+        for url in ('file:///etc/passwd', 'http://169.254.169.254/latest/meta-data/', 'HTTPS://intranet.local/a.css'):
+            with self.assertRaises(ValueError):
+                pdf.pdf_url_fetcher(url)
+        image = pdf.pdf_url_fetcher('data:image/png;base64,iVBORw0KGgo=')
+        self.assertEqual((image['string'], image['mime_type']), (b'\x89PNG\r\n\x1a\n', 'image/png'))
+
+        weasyprint = SimpleNamespace(HTML=mock.Mock())
+        with mock.patch.dict(sys.modules, {'weasyprint': weasyprint}):
+            pdf.html_to_pdf('<img src="file:///etc/passwd">')
+        self.assertIs(weasyprint.HTML.call_args.kwargs['url_fetcher'], pdf.pdf_url_fetcher)
+
+    def test_shared_pdf_file(self):
+        """Test that share links serve the PDF, snapshots render their frozen content and PINs are required."""
+        response = self.client.post(
+            f'/api/v1/documents/{self.document.slug}/create_pdf_share',
+            {'snapshot': True, 'pin_protected': True}, format='json'
+        )
+        export = DocumentPDFExport.objects.get(uuid=response.data['uuid'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.document.content = '<p>Second draft.</p>'
+            self.document.save()
+
+        url = f'/api/v1/shared-pdf/{export.uuid}/file/'
+        response, delay = self.request_pdf(self.anonymous, url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        delay.assert_not_called()
+
+        response, delay = self.request_pdf(self.anonymous, url, pin_code=export.pin_code)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertIn('<p>First draft.</p>', self.render_queued()[0])
+
+        response, delay = self.request_pdf(self.anonymous, url, pin_code=export.pin_code)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Cache-Control'], 'private, no-store')
+        delay.assert_not_called()
+
+
+class ConditionalRequestTests(DocumentTestMixin, TestCase):
+    """Test ETags, 304 responses and cache headers for documents and shares."""
+
+    def setUp(self):
+        super().setUp()
+        self.document = self.create_document('Cached', '<p>Large body.</p>')
+        self.url = f'/api/v1/documents/{self.document.slug}'
+
+    def test_detail_answers_not_modified(self):
+        """Test that a current ETag or date gets a 304 and a change gets the new body."""
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        Comment.objects.create(document=self.document, user=self.user, text='New remark.')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+        export_url = f'{self.url}/export_pdf'
+        etag = self.client.get(export_url)['ETag']
+        self.assertEqual(self.client.get(export_url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_bulk_changes_change_the_etag(self):
+        """Test that bulk updates, which skip save(), still move the validators."""
+        etag = self.client.get(self.url)['ETag']
+        self.client.post('/api/v1/documents/bulk/update-status', {
+            'document_ids': [self.document.id], 'status': 'published'
+        }, format='json')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_share_cache_headers(self):
+        """Test that public shares may be cached until they expire and PIN shares never are."""
+        anonymous = APIClient()
+        export = DocumentPDFExport.objects.create(document=self.document, created_by=self.user, expiration_type='1h')
+        url = f'/api/v1/shared-html/{export.uuid}/'
+        response = anonymous.get(url)
+        max_age = int(response['Cache-Control'].split('max-age=')[1])
+        self.assertTrue(response['Cache-Control'].startswith('public'))
+        self.assertLessEqual(max_age, 60 * 5)
+        self.assertEqual(anonymous.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        export.expires_at = timezone.now() + timedelta(seconds=30)
+        export.save()
+        self.assertLessEqual(int(anonymous.get(url)['Cache-Control'].split('max-age=')[1]), 30)
+
+        protected = DocumentPDFExport.objects.create(document=self.document, created_by=self.user, pin_protected=True)
+        response = anonymous.post(f'/api/v1/shared-pdf/{protected.uuid}/', {'pin_code': protected.pin_code}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Cache-Control'], 'private, no-store')
@@ -0,0 +1,138 @@
+"""
+Token counting and sentence splitting helpers.
+
+tiktoken encoders are expensive to build, so they are created once per model
+and process. When an encoder can't be loaded (unknown model, or the encoding
+file can't be downloaded) counts fall back to a characters-per-token estimate.
+"""
+
+import math
+import re
+from functools import lru_cache
+
+import tiktoken
+
+# Encoding used for models tiktoken doesn't know about
+FALLBACK_ENCODING = 'cl100k_base'
+
+# Rough average for English and Norwegian prose, used when no encoder is available
+CHARS_PER_TOKEN = 4
+
+# Model whose tokenizer is used for the counts stored on documents
+STATS_MODEL = 'gpt-3.5-turbo-0125'
+
+# Only the start of a document can end up in a prompt, so offsets stop here
+MAX_STORED_OFFSET_TOKENS = 20000
+
+# A sentence ends at ., ! or ? (optionally followed by closing quotes or brackets)
+# and whitespace, or at a blank line
+SENTENCE_END_RE = re.compile(r'[.!?…]+["\'»”’)\]]*\s+|\n\s*\n')
+
+
+@lru_cache(maxsize=None)
+def get_encoder(model):
+    """Return the tiktoken encoder for a model, or None if none can be loaded."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception as e:
+        print(f"Could not load tokenizer for {model}: {str(e)}")
+        return None
+
+    try:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception as e:
+        print(f"Could not load tokenizer {FALLBACK_ENCODING}: {str(e)}")
+        return None
+
+
+def count_tokens(text, model):
+    """Count the tokens of a text for a model."""
+    if not text:
+        return 0
+    encoder = get_encoder(model)
+    if encoder is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens, model):
+    """Cut a text to at most max_tokens tokens, regardless of sentence boundaries."""
+    if max_tokens <= 0:
+        return ''
+    encoder = get_encoder(model)
+    if encoder is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    tokens = encoder.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    # Decoding a cut multi-byte token can produce a replacement character; drop it
+    return encoder.decode(tokens[:max_tokens]).rstrip('�')
+
+
+def sentence_ends(text):
+    """Return the character offsets where the sentences of a text end."""
+    ends = [match.end() for match in SENTENCE_END_RE.finditer(text)]
+    if not ends or ends[-1] < len(text):
+        ends.append(len(text))
+    return ends
+
+
+def split_sentences(text):
+    """Split a text into sentences, keeping trailing whitespace with each sentence."""
+    sentences = []
+    start = 0
+    for end in sentence_ends(text):
+        if end > start:
+            sentences.append(text[start:end])
+        start = end
+    return sentences
+
+
+def sentence_token_offsets(text, model):
+    """
+    Return (end offset, cumulative token count) for each sentence of a text.
+    Sentences are counted one at a time, so the total can differ from
+    count_tokens(text) by a token or so per sentence boundary.
+    """
+    encoder = get_encoder(model)
+    offsets = []
+    total = 0
+    start = 0
+    for end in sentence_ends(text):
+        if end <= start:
+            continue
+        sentence = text[start:end]
+        if encoder is None:
+            total += math.ceil(len(sentence) / CHARS_PER_TOKEN)
+        else:
+            total += len(encoder.encode(sentence, disallowed_special=()))
+        offsets.append((end, total))
+        start = end
+    return offsets
+
+
+def text_stats(text, model=STATS_MODEL):
+    """
+    Return (token_count, word_count, sentence_offsets) for a text. Offsets are a
+    flat [end, tokens, end, tokens, ...] list covering the first
+    MAX_STORED_OFFSET_TOKENS tokens, as stored on TextDocument.
+    """
+    if not text:
+        return 0, 0, []
+
+    # Tokenize only a prefix that is sure to hold MAX_STORED_OFFSET_TOKENS tokens
+    prefix = text[:MAX_STORED_OFFSET_TOKENS * 8]
+    sentence_offsets = []
+    for end, tokens in sentence_token_offsets(prefix, model):
+        if tokens > MAX_STORED_OFFSET_TOKENS:
+            break
+        sentence_offsets.extend((end, tokens))
+
+    return count_tokens(text, model), len(text.split()), sentence_offsets
+
+
+def offset_pairs(sentence_offsets):
+    """Turn a flat stored offsets list back into (end, tokens) pairs."""
+    return list(zip(sentence_offsets[::2], sentence_offsets[1::2]))
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from django.views.decorators.csrf import csrf_exempt
-from .views import TextDocumentViewSet, CommentViewSet, format_document_with_ai, DocumentPDFExportViewSet, shared_pdf_view, shared_html_view, StyleConstraintViewSet
+from .views import TextDocumentViewSet, CommentViewSet, format_document_with_ai, DocumentPDFExportViewSet, shared_pdf_view, shared_pdf_file_view, shared_html_view, StyleConstraintViewSet, background_job_status, format_document_with_ai_stream
 from .ai_views import generate_document_with_ai
 
 # Create a router and register our viewsets with it
@@ -15,7 +15,10 @@ router.register(r'style-constraints', StyleConstraintViewSet, basename='style-co
 urlpatterns = [
     path('', include(router.urls)),
     path('format-with-ai/', format_document_with_ai, name='format-with-ai'),
+    path('format-with-ai/stream/', format_document_with_ai_stream, name='format-with-ai-stream'),
     path('shared-pdf/<uuid:uuid>/', shared_pdf_view, name='shared-pdf'),
+    path('shared-pdf/<uuid:uuid>/file/', shared_pdf_file_view, name='shared-pdf-file'),
     path('shared-html/<uuid:uuid>/', shared_html_view, name='shared-html'),
+    path('jobs/<uuid:job_uuid>/', background_job_status, name='background-job-status'),
     # AI document generation endpoint is now defined in the main urls.py file
 ]
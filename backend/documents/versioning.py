@@ -0,0 +1,181 @@
+"""
+Delta storage for document versions.
+
+Only the latest version of a document keeps its body in full. Every older
+version stores a compressed reverse delta that rebuilds its content from the
+next version's content, so a version chain costs roughly one full copy plus
+the edits. Rebuilding walks forward to the first full body and back again,
+and rebuilt contents are cached.
+
+Whenever a version's content changes, the delta of its parent is recomputed
+against the new content, so the parent still rebuilds to the same text.
+"""
+
+import json
+import re
+import zlib
+from difflib import SequenceMatcher
+
+from django.core.cache import cache
+
+# Rebuilt contents are immutable for a given (id, updated_at), so they can live long
+VERSION_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Deltas work on whitespace runs, HTML tags and words rather than characters:
+# much faster to diff, and edits rarely split a word
+TOKEN_RE = re.compile(r'\s+|<[^>]*>|[^\s<]+|<')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text or '')
+
+
+def make_delta(newer, content):
+    """
+    Return a compressed delta that rebuilds `content` from `newer`. The delta
+    is a list of [start, end] token ranges copied from `newer` and literal
+    strings. When it wouldn't be smaller, the content itself is stored.
+    """
+    newer_tokens = tokenize(newer)
+    content_tokens = tokenize(content)
+    operations = []
+    matcher = SequenceMatcher(None, newer_tokens, content_tokens)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            operations.append([i1, i2])
+        elif j2 > j1:
+            operations.append(''.join(content_tokens[j1:j2]))
+
+    delta = zlib.compress(json.dumps(operations).encode())
+    snapshot = zlib.compress(json.dumps([content or '']).encode())
+    return delta if len(delta) < len(snapshot) else snapshot
+
+
+def apply_delta(delta, newer):
+    """Rebuild content from the newer version's content and a stored delta."""
+    newer_tokens = tokenize(newer)
+    parts = []
+    for operation in json.loads(zlib.decompress(bytes(delta))):
+        if isinstance(operation, str):
+            parts.append(operation)
+        else:
+            start, end = operation
+            parts.append(''.join(newer_tokens[start:end]))
+    return ''.join(parts)
+
+
+def version_cache_key(document_id, updated_at):
+    return f"documents:version_content:{document_id}:{updated_at.timestamp()}"
+
+
+def compact_version(document_id, newer_content, content, **fields):
+    """
+    Replace a version's stored body with a delta against its child's content.
+    Goes through update(), so updated_at and the other columns are left alone.
+    """
+    from .models import TextDocument
+    TextDocument.objects.filter(pk=document_id).update(
+        content='',
+        content_html='',
+        plain_text='',
+        sentence_offsets=[],
+        content_delta=make_delta(newer_content, content),
+        **fields
+    )
+
+
+def _newer_versions(document):
+    """Return the versions after this one, oldest first, following child links."""
+    from .models import TextDocument
+    rows = TextDocument.objects.filter(
+        lineage=document.lineage,
+        version__gt=document.version
+    ).values('id', 'parent_id', 'content', 'content_delta', 'updated_at')
+    children = {row['parent_id']: row for row in rows}
+
+    chain = []
+    row = children.get(document.id)
+    while row is not None:
+        chain.append(row)
+        if row['content_delta'] is None:
+            break
+        row = children.get(row['id'])
+    return chain
+
+
+def rebuild_content(document):
+    """Return the full content of a version stored as a delta."""
+    if document.content_delta is None:
+        return document.content
+
+    key = version_cache_key(document.id, document.updated_at)
+    content = cache.get(key)
+    if content is not None:
+        return content
+
+    chain = _newer_versions(document)
+    if not chain or chain[-1]['content_delta'] is not None:
+        raise ValueError(f"Version chain of document {document.id} has no full body to rebuild from")
+
+    # Walk back from the first full body, caching every version rebuilt on the way
+    rows = [{'id': document.id, 'content_delta': document.content_delta, 'updated_at': document.updated_at}]
+    rows += chain[:-1]
+    content = chain[-1]['content']
+    rebuilt = {}
+    for row in reversed(rows):
+        content = apply_delta(row['content_delta'], content)
+        rebuilt[version_cache_key(row['id'], row['updated_at'])] = content
+    cache.set_many(rebuilt, VERSION_CACHE_TIMEOUT)
+    return content
+
+
+def content_saved(document, previous_content):
+    """
+    Keep the delta chain consistent after a version's content was saved:
+    store an older version as a delta again and recompute the parent's delta
+    against the new content, so the parent still rebuilds to the same text.
+    """
+    from .models import TextDocument
+    if document.content_delta is not None:
+        child = TextDocument.objects.filter(parent_id=document.id).first()
+        if child is not None:
+            child_content = rebuild_content(child)
+            compact_version(document.id, child_content, document.content)
+
+    if document.parent_id and previous_content != document.content:
+        parent_delta = TextDocument.objects.filter(
+            pk=document.parent_id
+        ).values_list('content_delta', flat=True).first()
+        if parent_delta is not None:
+            parent_content = apply_delta(parent_delta, previous_content)
+            TextDocument.objects.filter(pk=document.parent_id).update(
+                content_delta=make_delta(document.content, parent_content)
+            )
+
+
+def version_deleted(document):
+    """
+    Give the parent of a version about to be deleted its full body back, since
+    its delta was taken against the deleted version.
+    """
+    from .models import TextDocument
+    if not document.parent_id:
+        return
+    parent = TextDocument.objects.filter(pk=document.parent_id, content_delta__isnull=False).first()
+    if parent is None:
+        return
+
+    # Restoring derives the renditions again, which compact_version blanked
+    parent.restore_content()
+    parent.update_text_stats()
+    TextDocument.objects.filter(pk=parent.pk).update(
+        content=parent.content,
+        content_format=parent.content_format,
+        content_html=parent.content_html,
+        plain_text=parent.plain_text,
+        token_count=parent.token_count,
+        word_count=parent.word_count,
+        sentence_offsets=parent.sentence_offsets,
+        excerpt=parent.excerpt,
+        content_delta=None
+    )
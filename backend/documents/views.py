@@ -1,9 +1,11 @@
 from rest_framework import viewsets, permissions, status, filters
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
-from django.db.models import Q
+from django.db.models import BooleanField, ExpressionWrapper, Q
 from django.shortcuts import get_object_or_404
-from django.http import Http404, HttpResponse, JsonResponse
+from django.core.files.storage import default_storage
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.conf import settings
 from django.utils import timezone
 from django.template.loader import render_to_string
 import openai
@@ -11,7 +13,7 @@ import anthropic
 import json
 from datetime import timedelta
 
-from .models import TextDocument, Comment, DocumentPDFExport, StyleConstraint
+from .models import TextDocument, Comment, DocumentPDFExport, StyleConstraint, BackgroundJob
 from .serializers import (
     TextDocumentListSerializer,
     TextDocumentDetailSerializer,
@@ -20,17 +22,35 @@ from .serializers import (
     CommentSerializer,
     DocumentPDFExportSerializer,
     StyleConstraintSerializer,
+    BackgroundJobSerializer,
+    LIST_DEFERRED_FIELDS,
+    requested_list_fields,
 )
+from .conditional import (
+    PRIVATE_CACHE_CONTROL, document_validators, not_modified, set_validators, share_cache_control,
+)
+from .search import search_documents
+from .pagination import DocumentPagination, paginate_documents
+from .pdf import PDF_RETRY_AFTER, artifact_name, clean_render_options, pdf_response, start_pdf_render
+from .sharing import (
+    SHARE_DEFERRED_FIELDS, build_snapshot, creator_name, invalidate_shared_documents, read_snapshot,
+    shared_document_payload,
+)
+from .similarity import similar_documents
+from .tags import add_tags, clean_tag_list, filter_by_tags, refresh_tag_counts, remove_tags, replace_tags
+from .ai_views import get_default_model_settings, sse_event
 from accounts.permissions import IsSameOrganization
+from categories.tree import invalidate_category_tree
 
 class TextDocumentViewSet(viewsets.ModelViewSet):
     """ViewSet for viewing and editing TextDocument instances."""
     
     permission_classes = [permissions.IsAuthenticated, IsSameOrganization]
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['title', 'plain_text', 'tags']
+    # Searching is handled in get_queryset (see documents.search), not by SearchFilter
+    filter_backends = [filters.OrderingFilter]
     ordering_fields = ['title', 'created_at', 'updated_at']
-    ordering = ['-updated_at']
+    ordering = ['-updated_at', '-id']
+    pagination_class = DocumentPagination
     lookup_field = 'slug'
     
     def destroy(self, request, *args, **kwargs):
@@ -40,6 +60,16 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
         document.save()
         return Response({"detail": "Document moved to trash."}, status=status.HTTP_200_OK)
     
+    def retrieve(self, request, *args, **kwargs):
+        """Return a document, or 304 when the client's copy is still current (see documents.conditional)."""
+        document = self.get_object()
+        
+        etag, last_modified = document_validators(document)
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = Response(self.get_serializer(document).data)
+        return set_validators(response, etag, last_modified)
+    
     def get_object(self):
         """
         Override get_object to handle the case where multiple documents
@@ -80,6 +110,9 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
         
         # Check permissions
         self.check_object_permissions(self.request, obj)
+        
+        # Older versions are stored as deltas against the next one
+        obj.restore_content()
         return obj
     
     def get_queryset(self):
@@ -122,9 +155,8 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
         tags = self.request.query_params.get('tags', None)
         if tags:
             tag_list = tags.split(',')
-            # Use a more efficient approach with a single query
-            # This will find documents that contain ALL the specified tags
-            queryset = queryset.filter(tags__contains=tag_list)
+            # Find documents that carry ALL the specified tags through the indexed tag links
+            queryset = filter_by_tags(queryset, tag_list)
         
         # Filter by latest version only by default
         latest_only = self.request.query_params.get('latest_only', 'true').lower() == 'true'
@@ -135,59 +167,31 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
         search = self.request.query_params.get('search', None)
         title_content_search = self.request.query_params.get('title_content_search', None)
         
-        print(f"Search parameters - search: {search}, title_content_search: {title_content_search}")
-        
-        # Handle standard search parameter (may cause issues with tags on some DB backends)
         if search:
-            print(f"Using standard search parameter: {search}")
-            try:
-                queryset = queryset.filter(
-                    Q(title__icontains=search) | 
-                    Q(plain_text__icontains=search) |
-                    Q(tags__contains=[search])
-                )
-            except Exception as e:
-                print(f"Error with standard search: {e}")
-                # Fallback to title and content only if tags search fails
-                queryset = queryset.filter(
-                    Q(title__icontains=search) | 
-                    Q(plain_text__icontains=search)
-                )
-        
-        # Handle custom search parameter for title and content only (more compatible)
+            queryset = search_documents(queryset, search)
         elif title_content_search:
-            print(f"Using custom title_content_search parameter: {title_content_search}")
-            
-            # Check if plain_text field is populated in any documents
-            has_plain_text = TextDocument.objects.filter(plain_text__isnull=False).exists()
-            print(f"Database has documents with plain_text: {has_plain_text}")
-            
-            # Sample a document to check plain_text content
-            sample_doc = TextDocument.objects.first()
-            if sample_doc:
-                print(f"Sample document title: {sample_doc.title}")
-                print(f"Sample document plain_text: {sample_doc.plain_text[:100] if sample_doc.plain_text else 'None'}")
-            
-            # Apply the filter
-            queryset = queryset.filter(
-                Q(title__icontains=title_content_search) | 
-                Q(plain_text__icontains=title_content_search)
-            )
-            
-            # Check the results
-            result_count = queryset.count()
-            print(f"Query after title_content_search filter returned {result_count} results")
-            
-            # If no results, try just title search to see if that works
-            if result_count == 0:
-                title_only_count = TextDocument.objects.filter(
-                    organization=user.organization,
-                    title__icontains=title_content_search
-                ).count()
-                print(f"Title-only search returned {title_only_count} results")
+            # Title and content only (no tags)
+            queryset = search_documents(queryset, title_content_search, include_tags=False)
+        
+        # Listings never return content; the plain text only when it is asked for
+        if self.action == 'list':
+            deferred = list(LIST_DEFERRED_FIELDS)
+            fields = requested_list_fields(self.request)
+            if fields is not None and 'plain_text' not in fields:
+                deferred.append('plain_text')
+            queryset = TextDocumentListSerializer.setup_eager_loading(queryset.defer(*deferred))
+        elif self.action in ('retrieve', 'export_pdf'):
+            queryset = TextDocumentDetailSerializer.setup_eager_loading(queryset)
         
         return queryset
     
+    def filter_queryset(self, queryset):
+        """Order full-text search results by relevance unless an ordering was requested."""
+        queryset = super().filter_queryset(queryset)
+        if 'search_rank' in queryset.query.annotations and not self.request.query_params.get('ordering'):
+            queryset = queryset.order_by('-search_rank', '-updated_at')
+        return queryset
+    
     def get_serializer_class(self):
         """Return appropriate serializer class based on the action."""
         if self.action == 'list':
@@ -205,34 +209,53 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
         """Return all versions of a document."""
         document = self.get_object()
         
-        # Get the root document (version 1)
-        root = document
-        while root.parent:
-            root = root.parent
-        
-        # Get all versions by finding documents with the same root
-        # This approach works regardless of how many versions exist
-        all_versions = []
-        
-        # Add the root document
-        all_versions.append(root.id)
-        
-        # Find all documents that have this root as their ancestor
-        # by recursively traversing the version tree
-        def find_child_versions(parent_id):
-            children = TextDocument.objects.filter(parent_id=parent_id)
-            for child in children:
-                all_versions.append(child.id)
-                find_child_versions(child.id)
+        # All versions share the lineage of the first one, so one indexed query finds them
+        versions = TextDocument.objects.filter(
+            organization_id=document.organization_id,
+            lineage=document.lineage
+        ).order_by('version')
+        versions = TextDocumentListSerializer.setup_eager_loading(versions)
+        paginator = DocumentPagination(ordering=('version',))
+        page = paginator.paginate_queryset(versions, request)
+        for version in page:
+            version.restore_content()
+        
+        serializer = TextDocumentListSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+    
+    @action(detail=True, methods=['get'])
+    def similar(self, request, slug=None):
+        """Return the documents most similar in content to this one."""
+        document = self.get_object()
         
-        # Start the recursive search from the root
-        find_child_versions(root.id)
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 50)
+        except ValueError:
+            limit = 10
+        
+        candidates = TextDocumentListSerializer.setup_eager_loading(
+            TextDocument.objects.filter(
+                organization_id=document.organization_id,
+                is_latest=True
+            ).exclude(status='deleted').defer(*LIST_DEFERRED_FIELDS)
+        )
         
-        # Get all versions
-        versions = TextDocument.objects.filter(id__in=all_versions).order_by('version')
+        try:
+            results = similar_documents(document, candidates, limit)
+        except Exception as e:
+            print(f"Error finding similar documents: {str(e)}")
+            return Response(
+                {"detail": "Could not find similar documents."},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
         
-        serializer = TextDocumentListSerializer(versions, many=True)
-        return Response(serializer.data)
+        data = []
+        for similar_document, score in results:
+            item = TextDocumentListSerializer(similar_document).data
+            # No score while the organization's index is still being built
+            item['similarity'] = round(score, 4) if score is not None else None
+            data.append(item)
+        return Response(data)
     
     @action(detail=True, methods=['post'])
     def add_comment(self, request, slug=None):
@@ -283,11 +306,41 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
         """Return document data for PDF generation on the client side."""
         document = self.get_object()
         
+        etag, last_modified = document_validators(document)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return set_validators(response, etag, last_modified)
+        
         # Return document data for client-side PDF generation
-        return Response({
+        response = Response({
             'document': TextDocumentDetailSerializer(document, context={'request': request}).data,
-            'html_content': self._slate_to_html(document.content)
+            'html_content': document.rendered_html
         })
+        return set_validators(response, etag, last_modified)
+    
+    @action(detail=True, methods=['get'])
+    def pdf(self, request, slug=None):
+        """
+        Download the document as a PDF rendered on the server. A PDF already
+        rendered for this version and these options is served from storage;
+        otherwise a render is queued and its BackgroundJob returned (202).
+        """
+        document = self.get_object()
+        options = clean_render_options(request.query_params)
+        
+        name = artifact_name(document, options)
+        if default_storage.exists(name):
+            response = pdf_response(name, f"{document.slug}.pdf")
+            response['Cache-Control'] = PRIVATE_CACHE_CONTROL
+            return response
+        
+        job = start_pdf_render(document, options, document.organization_id, request.user.id)
+        if job.status == 'failed':
+            return Response(
+                {"detail": "PDF rendering is currently unavailable. Please try again later."},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        return Response(BackgroundJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
     
     @action(detail=True, methods=['post'])
     def create_pdf_share(self, request, slug=None):
@@ -302,162 +355,23 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
         # Check if PIN protection is requested
         pin_protected = request.data.get('pin_protected', False)
         
+        # A snapshot share keeps showing the document as it is now
+        snapshot = None
+        if request.data.get('snapshot', False):
+            snapshot = build_snapshot(document, request.user)
+        
         # Create PDF export record
         pdf_export = DocumentPDFExport.objects.create(
             document=document,
             created_by=request.user,
             expiration_type=expiration_type,
-            pin_protected=pin_protected
+            pin_protected=pin_protected,
+            snapshot=snapshot
         )
         
         # Return the export details
         serializer = DocumentPDFExportSerializer(pdf_export, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
-        
-    def _slate_to_html(self, content):
-        """Convert content to HTML."""
-        if not content:
-            return ""
-        
-        # Try to determine if content is Markdown or Slate.js JSON
-        # This helps with the transition period
-        if isinstance(content, (dict, list)) or (isinstance(content, str) and (content.startswith('[') or content.startswith('{'))):
-            try:
-                # If it's a string that looks like JSON, try to parse it
-                if isinstance(content, str) and (content.startswith('[') or content.startswith('{')):
-                    import json
-                    parsed_content = json.loads(content)
-                else:
-                    parsed_content = content
-                
-                # Use the old method for Slate.js content
-                html = []
-                
-                def process_node(node):
-                    if isinstance(node, dict):
-                        # If it's a leaf node with text
-                        if 'text' in node:
-                            text = node['text']
-                            # Apply text formatting
-                            if node.get('bold'):
-                                text = f"<strong>{text}</strong>"
-                            if node.get('italic'):
-                                text = f"<em>{text}</em>"
-                            if node.get('underline'):
-                                text = f"<u>{text}</u>"
-                            return text
-                        
-                        # If it's an element with children
-                        if 'children' in node:
-                            children_html = ''.join(process_node(child) for child in node['children'])
-                            node_type = node.get('type', 'paragraph')
-                            
-                            # Apply element formatting based on type
-                            if node_type == 'paragraph':
-                                return f"<p>{children_html}</p>"
-                            elif node_type == 'heading-one':
-                                return f"<h1>{children_html}</h1>"
-                            elif node_type == 'heading-two':
-                                return f"<h2>{children_html}</h2>"
-                            elif node_type == 'block-quote':
-                                return f"<blockquote>{children_html}</blockquote>"
-                            elif node_type == 'bulleted-list':
-                                return f"<ul>{children_html}</ul>"
-                            elif node_type == 'numbered-list':
-                                return f"<ol>{children_html}</ol>"
-                            elif node_type == 'list-item':
-                                return f"<li>{children_html}</li>"
-                            else:
-                                return children_html
-                        
-                        return ''
-                    
-                    # If it's a list of nodes
-                    elif isinstance(node, list):
-                        return ''.join(process_node(child) for child in node)
-                    
-                    return ''
-                
-                # Process the content
-                if isinstance(parsed_content, list):
-                    for node in parsed_content:
-                        html.append(process_node(node))
-                elif isinstance(parsed_content, dict):
-                    html.append(process_node(parsed_content))
-                
-                return ''.join(html)
-            except:
-                # If parsing fails, treat as Markdown
-                pass
-        
-        # For Markdown content, use a Markdown to HTML converter
-        try:
-            import markdown
-            # Use the Python-Markdown library to convert Markdown to HTML
-            # Enable common extensions for tables, code highlighting, etc.
-            html = markdown.markdown(
-                content,
-                extensions=[
-                    'tables',
-                    'fenced_code',
-                    'codehilite',
-                    'nl2br',  # Convert newlines to <br>
-                    'sane_lists',  # Better list handling
-                ]
-            )
-            return html
-        except ImportError:
-            # If markdown library is not available, use a simple regex-based approach
-            import re
-            
-            # Convert headers
-            html = re.sub(r'^# (.+)$', r'<h1>\1</h1>', content, flags=re.MULTILINE)
-            html = re.sub(r'^## (.+)$', r'<h2>\1</h2>', html, flags=re.MULTILINE)
-            html = re.sub(r'^### (.+)$', r'<h3>\1</h3>', html, flags=re.MULTILINE)
-            
-            # Convert bold and italic
-            html = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', html)
-            html = re.sub(r'__(.+?)__', r'<strong>\1</strong>', html)
-            html = re.sub(r'\*(.+?)\*', r'<em>\1</em>', html)
-            html = re.sub(r'_(.+?)_', r'<em>\1</em>', html)
-            
-            # Convert links
-            html = re.sub(r'\[(.+?)\]\((.+?)\)', r'<a href="\2">\1</a>', html)
-            
-            # Convert code blocks
-            html = re.sub(r'```(.+?)```', r'<pre><code>\1</code></pre>', html, flags=re.DOTALL)
-            
-            # Convert inline code
-            html = re.sub(r'`(.+?)`', r'<code>\1</code>', html)
-            
-            # Convert blockquotes
-            html = re.sub(r'^> (.+)$', r'<blockquote>\1</blockquote>', html, flags=re.MULTILINE)
-            
-            # Convert unordered lists
-            list_items = re.findall(r'^[\*\-+]\s+(.+)$', html, flags=re.MULTILINE)
-            if list_items:
-                ul_html = '<ul>'
-                for item in list_items:
-                    ul_html += f'<li>{item}</li>'
-                ul_html += '</ul>'
-                html = re.sub(r'^[\*\-+]\s+(.+)$', '', html, flags=re.MULTILINE)
-                html += ul_html
-            
-            # Convert ordered lists
-            list_items = re.findall(r'^\d+\.\s+(.+)$', html, flags=re.MULTILINE)
-            if list_items:
-                ol_html = '<ol>'
-                for item in list_items:
-                    ol_html += f'<li>{item}</li>'
-                ol_html += '</ol>'
-                html = re.sub(r'^\d+\.\s+(.+)$', '', html, flags=re.MULTILINE)
-                html += ol_html
-            
-            # Convert paragraphs (any remaining lines)
-            paragraphs = [p for p in html.split('\n\n') if p.strip()]
-            html = ''.join([f'<p>{p}</p>' for p in paragraphs])
-            
-            return html
     
     @action(detail=False, methods=['post'], url_path='bulk/update-category')
     def bulk_update_category(self, request):
@@ -478,25 +392,27 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
             is_latest=True
         )
         
-        # Update category for all documents
-        documents.update(category_id=category_id)
+        # Update category for all documents; update() returns the number of rows it changed
+        count = documents.update(category_id=category_id, updated_at=timezone.now())
+        # update() sends no signals, so the cached category tree and share payloads are dropped here
+        invalidate_category_tree(request.user.organization_id)
+        invalidate_shared_documents(document_ids)
         
-        return Response({"detail": f"Updated category for {documents.count()} documents."})
+        return Response({"detail": f"Updated category for {count} documents.", "count": count})
     
-    @action(detail=False, methods=['post'], url_path='bulk/add-tags')
-    def bulk_add_tags(self, request):
-        """Add tags to multiple documents."""
+    def _bulk_tag(self, request, operation, allow_empty=False):
+        """Run a set-based tag operation (see documents.tags) on the selected documents."""
         document_ids = request.data.get('document_ids', [])
-        tags = request.data.get('tags', [])
+        tags = clean_tag_list(request.data.get('tags', []))
         
         if not document_ids:
-            return Response(
+            return None, Response(
                 {"detail": "No document IDs provided."},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        if not tags:
-            return Response(
+        if tags is None or (not tags and not allow_empty):
+            return None, Response(
                 {"detail": "No tags provided."},
                 status=status.HTTP_400_BAD_REQUEST
             )
@@ -508,14 +424,31 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
             is_latest=True
         )
         
-        # Add tags to each document
-        for document in documents:
-            current_tags = document.tags or []
-            new_tags = list(set(current_tags + tags))  # Remove duplicates
-            document.tags = new_tags
-            document.save()
-        
-        return Response({"detail": f"Added tags to {documents.count()} documents."})
+        return operation(documents, request.user.organization_id, tags), None
+    
+    @action(detail=False, methods=['post'], url_path='bulk/add-tags')
+    def bulk_add_tags(self, request):
+        """Add tags to multiple documents."""
+        count, error = self._bulk_tag(request, add_tags)
+        if error:
+            return error
+        return Response({"detail": f"Added tags to {count} documents.", "count": count})
+    
+    @action(detail=False, methods=['post'], url_path='bulk/remove-tags')
+    def bulk_remove_tags(self, request):
+        """Remove tags from multiple documents."""
+        count, error = self._bulk_tag(request, remove_tags)
+        if error:
+            return error
+        return Response({"detail": f"Removed tags from {count} documents.", "count": count})
+    
+    @action(detail=False, methods=['post'], url_path='bulk/replace-tags')
+    def bulk_replace_tags(self, request):
+        """Replace the tags of multiple documents (an empty list clears them)."""
+        count, error = self._bulk_tag(request, replace_tags, allow_empty=True)
+        if error:
+            return error
+        return Response({"detail": f"Replaced tags on {count} documents.", "count": count})
     
     @action(detail=False, methods=['post'], url_path='bulk/update-status')
     def bulk_update_status(self, request):
@@ -543,9 +476,13 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
         )
         
         # Update status for all documents
-        documents.update(status=status_value)
+        count = documents.update(status=status_value, updated_at=timezone.now())
+        # update() sends no signals, so the stored counts are refreshed here
+        invalidate_category_tree(request.user.organization_id)
+        refresh_tag_counts(request.user.organization_id)
+        invalidate_shared_documents(document_ids)
         
-        return Response({"detail": f"Updated status for {documents.count()} documents."})
+        return Response({"detail": f"Updated status for {count} documents.", "count": count})
     
     @action(detail=False, methods=['post'], url_path='bulk/delete')
     def bulk_delete(self, request):
@@ -564,13 +501,13 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
             organization=request.user.organization
         )
         
-        # Count before update
-        count = documents.count()
-        
         # Soft delete documents by updating their status
-        documents.update(status='deleted')
+        count = documents.update(status='deleted', updated_at=timezone.now())
+        invalidate_category_tree(request.user.organization_id)
+        refresh_tag_counts(request.user.organization_id)
+        invalidate_shared_documents(document_ids)
         
-        return Response({"detail": f"Moved {count} documents to trash."})
+        return Response({"detail": f"Moved {count} documents to trash.", "count": count})
     
     @action(detail=False, methods=['post'], url_path='bulk/delete-permanently')
     def bulk_delete_permanently(self, request):
@@ -589,13 +526,11 @@ class TextDocumentViewSet(viewsets.ModelViewSet):
             organization=request.user.organization
         )
         
-        # Count before deletion
-        count = documents.count()
-        
-        # Permanently delete documents
-        documents.delete()
+        # Permanently delete documents, counting only the documents among the deleted rows
+        _, per_model = documents.delete()
+        count = per_model.get(TextDocument._meta.label, 0)
         
-        return Response({"detail": f"Permanently deleted {count} documents."})
+        return Response({"detail": f"Permanently deleted {count} documents.", "count": count})
 
 
 class DocumentPDFExportViewSet(viewsets.ModelViewSet):
@@ -607,8 +542,11 @@ class DocumentPDFExportViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         """Return PDF exports for the current user's organization."""
         user = self.request.user
+        # Snapshot blobs are only read by the share views
         return DocumentPDFExport.objects.filter(
             document__organization=user.organization
+        ).defer('snapshot').annotate(
+            is_snapshot=ExpressionWrapper(Q(snapshot__isnull=False), output_field=BooleanField())
         )
     
     def perform_create(self, serializer):
@@ -625,51 +563,77 @@ class DocumentPDFExportViewSet(viewsets.ModelViewSet):
             return Response({"detail": f"Failed to delete PDF export: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
 
 
+def _shared_document_response(request, uuid, expired_detail):
+    """Serve a shared document link: from its snapshot when it has one, otherwise from the live document."""
+    # Only the export row; the document and its creator are loaded when the share needs them
+    pdf_export = get_object_or_404(DocumentPDFExport, uuid=uuid)
+    
+    # Check if the export has expired
+    if pdf_export.is_expired:
+        return Response({"detail": expired_detail}, status=status.HTTP_410_GONE)
+    
+    # Handle PIN protection
+    if pdf_export.pin_protected:
+        # For GET requests, just return that PIN is required
+        if request.method == 'GET':
+            if pdf_export.snapshot:
+                snapshot = read_snapshot(pdf_export.snapshot)
+                document_title, created_by_name = snapshot['document_title'], snapshot['created_by_name']
+            else:
+                document_title = TextDocument.objects.values_list('title', flat=True).get(pk=pdf_export.document_id)
+                created_by_name = creator_name(pdf_export.created_by)
+            return Response({
+                'pin_protected': True,
+                'document_title': document_title,
+                'created_by_name': created_by_name,
+            })
+        
+        # For POST requests, verify the PIN
+        pin_code = request.data.get('pin_code')
+        if not pin_code or pin_code != pdf_export.pin_code:
+            return Response(
+                {"detail": "Invalid PIN code."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+    
+    if pdf_export.snapshot:
+        # A snapshot never changes, so the share itself identifies its content
+        payload = None
+        etag, last_modified = f'"{pdf_export.uuid.hex}"', pdf_export.created_at
+    else:
+        # Serialized document and HTML come from the share cache (see documents.sharing)
+        document = TextDocument.objects.select_related('category').defer(*SHARE_DEFERRED_FIELDS).get(
+            pk=pdf_export.document_id
+        )
+        payload, etag, last_modified = shared_document_payload(document)
+    cache_control = share_cache_control(pdf_export)
+    
+    # Unchanged since the client's copy
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return set_validators(response, etag, last_modified, cache_control)
+    
+    # Snapshots are decompressed only for a share that is served
+    if payload is None:
+        payload = read_snapshot(pdf_export.snapshot)['payload']
+    
+    # Return document data for client-side PDF or HTML generation
+    response = Response({
+        **payload,
+        'is_shared': True,
+        'pin_protected': pdf_export.pin_protected,
+        'expiration_type': pdf_export.expiration_type,
+        'expires_at': pdf_export.expires_at
+    })
+    return set_validators(response, etag, last_modified, cache_control)
+
+
 @api_view(['GET', 'POST'])
 @permission_classes([permissions.AllowAny])  # Allow unauthenticated access
 def shared_pdf_view(request, uuid):
     """View for accessing a shared PDF by UUID."""
     try:
-        # Get the PDF export by UUID
-        pdf_export = get_object_or_404(DocumentPDFExport, uuid=uuid)
-        
-        # Check if the export has expired
-        if pdf_export.is_expired:
-            return Response(
-                {"detail": "This shared PDF link has expired."},
-                status=status.HTTP_410_GONE
-            )
-        
-        # Handle PIN protection
-        if pdf_export.pin_protected:
-            # For GET requests, just return that PIN is required
-            if request.method == 'GET':
-                return Response({
-                    'pin_protected': True,
-                    'document_title': pdf_export.document.title,
-                    'created_by_name': f"{pdf_export.created_by.first_name} {pdf_export.created_by.last_name}".strip() or pdf_export.created_by.username,
-                })
-            
-            # For POST requests, verify the PIN
-            pin_code = request.data.get('pin_code')
-            if not pin_code or pin_code != pdf_export.pin_code:
-                return Response(
-                    {"detail": "Invalid PIN code."},
-                    status=status.HTTP_403_FORBIDDEN
-                )
-        
-        # Get the document
-        document = pdf_export.document
-        
-        # Return document data for client-side PDF generation
-        return Response({
-            'document': TextDocumentDetailSerializer(document, context={'request': request}).data,
-            'html_content': TextDocumentViewSet._slate_to_html(None, document.content),
-            'is_shared': True,
-            'pin_protected': pdf_export.pin_protected,
-            'expiration_type': pdf_export.expiration_type,
-            'expires_at': pdf_export.expires_at
-        })
+        return _shared_document_response(request, uuid, "This shared PDF link has expired.")
     except Exception as e:
         return Response(
             {"detail": f"Error accessing shared PDF: {str(e)}"},
@@ -681,27 +645,33 @@ def shared_pdf_view(request, uuid):
 def shared_html_view(request, uuid):
     """View for accessing a shared HTML document by UUID."""
     try:
-        # Get the PDF export by UUID (we're still using the same model for now)
+        # Shared HTML links use the same model as PDF links
+        return _shared_document_response(request, uuid, "This shared document link has expired.")
+    except Exception as e:
+        return Response(
+            {"detail": f"Error accessing shared document: {str(e)}"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([permissions.AllowAny])  # Allow unauthenticated access
+def shared_pdf_file_view(request, uuid):
+    """
+    Download a shared document as a PDF rendered on the server. PIN-protected
+    shares need the PIN posted. While the PDF is being rendered the response
+    is a 202 with a Retry-After header.
+    """
+    try:
         pdf_export = get_object_or_404(DocumentPDFExport, uuid=uuid)
         
-        # Check if the export has expired
         if pdf_export.is_expired:
             return Response(
-                {"detail": "This shared document link has expired."},
+                {"detail": "This shared PDF link has expired."},
                 status=status.HTTP_410_GONE
             )
         
-        # Handle PIN protection
         if pdf_export.pin_protected:
-            # For GET requests, just return that PIN is required
-            if request.method == 'GET':
-                return Response({
-                    'pin_protected': True,
-                    'document_title': pdf_export.document.title,
-                    'created_by_name': f"{pdf_export.created_by.first_name} {pdf_export.created_by.last_name}".strip() or pdf_export.created_by.username,
-                })
-            
-            # For POST requests, verify the PIN
             pin_code = request.data.get('pin_code')
             if not pin_code or pin_code != pdf_export.pin_code:
                 return Response(
@@ -709,60 +679,57 @@ def shared_html_view(request, uuid):
                     status=status.HTTP_403_FORBIDDEN
                 )
         
-        # Get the document
-        document = pdf_export.document
+        options = clean_render_options(request.query_params)
+        document = None
+        if not pdf_export.snapshot:
+            # Only what names the artifact; the renderer loads the body
+            document = TextDocument.objects.only('id', 'version', 'updated_at', 'organization_id').get(
+                pk=pdf_export.document_id
+            )
+        
+        name = artifact_name(document, options, pdf_export)
+        if default_storage.exists(name):
+            response = pdf_response(name, f"{pdf_export.uuid.hex}.pdf")
+            response['Cache-Control'] = share_cache_control(pdf_export)
+            return response
         
-        # Return document data for client-side HTML generation
-        return Response({
-            'document': TextDocumentDetailSerializer(document, context={'request': request}).data,
-            'html_content': TextDocumentViewSet._slate_to_html(None, document.content),
-            'is_shared': True,
-            'pin_protected': pdf_export.pin_protected,
-            'expiration_type': pdf_export.expiration_type,
-            'expires_at': pdf_export.expires_at
-        })
+        if document is None:
+            document = TextDocument.objects.only('id', 'organization_id').get(pk=pdf_export.document_id)
+        job = start_pdf_render(
+            document, options, document.organization_id, pdf_export.created_by_id, pdf_export=pdf_export
+        )
+        if job.status == 'failed':
+            return Response(
+                {"detail": "PDF rendering is currently unavailable. Please try again later."},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        response = Response(
+            {"detail": "The PDF is being rendered. Please try again shortly.", "status": job.status},
+            status=status.HTTP_202_ACCEPTED
+        )
+        response['Retry-After'] = str(PDF_RETRY_AFTER)
+        return response
     except Exception as e:
         return Response(
-            {"detail": f"Error accessing shared document: {str(e)}"},
+            {"detail": f"Error accessing shared PDF: {str(e)}"},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
 
-@api_view(['POST'])
+@api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
-def format_document_with_ai(request):
-    """Format document content using AI."""
-    content = request.data.get('content')
-    if not content:
-        return Response({'error': 'No content provided'}, status=status.HTTP_400_BAD_REQUEST)
-    
-    user = request.user
-    service = user.preferred_ai_service
-    
-    print(f"Using AI service: {service}")
-    print(f"User has OpenAI API key: {bool(user.openai_api_key)}")
-    print(f"User has Anthropic API key: {bool(user.anthropic_api_key)}")
-    
-    # Parse the content to understand the current structure
-    try:
-        # Handle the case where content might be a string representation of JSON
-        if isinstance(content, str):
-            try:
-                parsed_content = json.loads(content)
-                print(f"Successfully parsed content as JSON with {len(parsed_content)} nodes")
-            except json.JSONDecodeError:
-                print("Content is not valid JSON, treating as plain text")
-                parsed_content = None
-        else:
-            # If content is already a dict/list, use it directly
-            parsed_content = content
-            print(f"Content is already a Python object with type: {type(content)}")
-    except Exception as e:
-        print(f"Error parsing content: {str(e)}")
-        parsed_content = None
-    
-    # Create a detailed system prompt that explains Slate.js formatting
-    slate_system_prompt = """
+def background_job_status(request, job_uuid):
+    """Return the status (and result, once finished) of a background job."""
+    job = get_object_or_404(
+        BackgroundJob.objects.select_related('document'),
+        uuid=job_uuid,
+        organization=request.user.organization
+    )
+    return Response(BackgroundJobSerializer(job).data)
+
+
+# System prompt that explains Slate.js formatting to the model
+SLATE_FORMAT_SYSTEM_PROMPT = """
     You are a document formatting assistant for a rich text editor that uses Slate.js.
     
     Your task is to improve the formatting and structure of the document while preserving its content.
@@ -818,6 +785,111 @@ def format_document_with_ai(request):
       }
     ]
     """
+
+
+def clean_formatted_slate_json(formatted_content):
+    """
+    Validate AI formatting output as a Slate.js node array.
+    Unwraps code blocks if needed and falls back to an error paragraph.
+    """
+    # Try to parse the response to ensure it's valid JSON
+    try:
+        # First, try to parse as-is
+        parsed_json = json.loads(formatted_content)
+        print("Response is valid JSON")
+        
+        # Validate that it's an array (Slate.js document structure)
+        if not isinstance(parsed_json, list):
+            print("JSON is not an array, wrapping it")
+            parsed_json = [parsed_json]
+        
+        # Re-serialize to ensure clean JSON
+        formatted_content = json.dumps(parsed_json)
+    except json.JSONDecodeError as e:
+        print(f"Response is not valid JSON: {e}")
+        
+        # Try to extract JSON from code blocks
+        if "```json" in formatted_content:
+            print("Extracting JSON from code block")
+            try:
+                json_text = formatted_content.split("```json")[1].split("```")[0].strip()
+                parsed_json = json.loads(json_text)
+                if not isinstance(parsed_json, list):
+                    parsed_json = [parsed_json]
+                formatted_content = json.dumps(parsed_json)
+                print("Successfully extracted and validated JSON from code block")
+            except (json.JSONDecodeError, IndexError) as extract_error:
+                print(f"Failed to extract valid JSON from code block: {extract_error}")
+                # Fall back to a simple paragraph structure
+                formatted_content = json.dumps([
+                    {
+                        "type": "paragraph",
+                        "children": [{"text": "The AI formatting failed. Please try again or format manually."}]
+                    }
+                ])
+        elif "```" in formatted_content:
+            print("Extracting from generic code block")
+            try:
+                code_text = formatted_content.split("```")[1].split("```")[0].strip()
+                parsed_json = json.loads(code_text)
+                if not isinstance(parsed_json, list):
+                    parsed_json = [parsed_json]
+                formatted_content = json.dumps(parsed_json)
+                print("Successfully extracted and validated JSON from generic code block")
+            except (json.JSONDecodeError, IndexError) as extract_error:
+                print(f"Failed to extract valid JSON from generic code block: {extract_error}")
+                # Fall back to a simple paragraph structure
+                formatted_content = json.dumps([
+                    {
+                        "type": "paragraph",
+                        "children": [{"text": "The AI formatting failed. Please try again or format manually."}]
+                    }
+                ])
+        else:
+            print("No code blocks found, using fallback structure")
+            # If all else fails, create a simple paragraph structure with the original content
+            formatted_content = json.dumps([
+                {
+                    "type": "paragraph",
+                    "children": [{"text": "The AI formatting failed. Please try again or format manually."}]
+                }
+            ])
+    
+    return formatted_content
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def format_document_with_ai(request):
+    """Format document content using AI."""
+    content = request.data.get('content')
+    if not content:
+        return Response({'error': 'No content provided'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    user = request.user
+    service = user.preferred_ai_service
+    
+    print(f"Using AI service: {service}")
+    print(f"User has OpenAI API key: {bool(user.openai_api_key)}")
+    print(f"User has Anthropic API key: {bool(user.anthropic_api_key)}")
+    
+    # Parse the content to understand the current structure
+    try:
+        # Handle the case where content might be a string representation of JSON
+        if isinstance(content, str):
+            try:
+                parsed_content = json.loads(content)
+                print(f"Successfully parsed content as JSON with {len(parsed_content)} nodes")
+            except json.JSONDecodeError:
+                print("Content is not valid JSON, treating as plain text")
+                parsed_content = None
+        else:
+            # If content is already a dict/list, use it directly
+            parsed_content = content
+            print(f"Content is already a Python object with type: {type(content)}")
+    except Exception as e:
+        print(f"Error parsing content: {str(e)}")
+        parsed_content = None
     
     if service == 'openai' and user.openai_api_key:
         try:
@@ -831,75 +903,14 @@ def format_document_with_ai(request):
             response = openai.ChatCompletion.create(
                 model="gpt-3.5-turbo",  # Use a more widely available model
                 messages=[
-                    {"role": "system", "content": slate_system_prompt},
+                    {"role": "system", "content": SLATE_FORMAT_SYSTEM_PROMPT},
                     {"role": "user", "content": content}
                 ]
             )
             print("OpenAI API response received")
             formatted_content = response.choices[0].message.content
             
-            # Try to parse the response to ensure it's valid JSON
-            try:
-                # First, try to parse as-is
-                parsed_json = json.loads(formatted_content)
-                print("Response is valid JSON")
-                
-                # Validate that it's an array (Slate.js document structure)
-                if not isinstance(parsed_json, list):
-                    print("JSON is not an array, wrapping it")
-                    parsed_json = [parsed_json]
-                
-                # Re-serialize to ensure clean JSON
-                formatted_content = json.dumps(parsed_json)
-            except json.JSONDecodeError as e:
-                print(f"Response is not valid JSON: {e}")
-                
-                # Try to extract JSON from code blocks
-                if "```json" in formatted_content:
-                    print("Extracting JSON from code block")
-                    try:
-                        json_text = formatted_content.split("```json")[1].split("```")[0].strip()
-                        parsed_json = json.loads(json_text)
-                        if not isinstance(parsed_json, list):
-                            parsed_json = [parsed_json]
-                        formatted_content = json.dumps(parsed_json)
-                        print("Successfully extracted and validated JSON from code block")
-                    except (json.JSONDecodeError, IndexError) as extract_error:
-                        print(f"Failed to extract valid JSON from code block: {extract_error}")
-                        # Fall back to a simple paragraph structure
-                        formatted_content = json.dumps([
-                            {
-                                "type": "paragraph",
-                                "children": [{"text": "The AI formatting failed. Please try again or format manually."}]
-                            }
-                        ])
-                elif "```" in formatted_content:
-                    print("Extracting from generic code block")
-                    try:
-                        code_text = formatted_content.split("```")[1].split("```")[0].strip()
-                        parsed_json = json.loads(code_text)
-                        if not isinstance(parsed_json, list):
-                            parsed_json = [parsed_json]
-                        formatted_content = json.dumps(parsed_json)
-                        print("Successfully extracted and validated JSON from generic code block")
-                    except (json.JSONDecodeError, IndexError) as extract_error:
-                        print(f"Failed to extract valid JSON from generic code block: {extract_error}")
-                        # Fall back to a simple paragraph structure
-                        formatted_content = json.dumps([
-                            {
-                                "type": "paragraph",
-                                "children": [{"text": "The AI formatting failed. Please try again or format manually."}]
-                            }
-                        ])
-                else:
-                    print("No code blocks found, using fallback structure")
-                    # If all else fails, create a simple paragraph structure with the original content
-                    formatted_content = json.dumps([
-                        {
-                            "type": "paragraph",
-                            "children": [{"text": "The AI formatting failed. Please try again or format manually."}]
-                        }
-                    ])
+            formatted_content = clean_formatted_slate_json(formatted_content)
             
             return Response({'formatted_content': formatted_content})
         except Exception as e:
@@ -917,7 +928,7 @@ def format_document_with_ai(request):
             response = client.messages.create(
                 model="claude-3-opus-20240229",
                 max_tokens=4000,
-                system=slate_system_prompt,
+                system=SLATE_FORMAT_SYSTEM_PROMPT,
                 messages=[
                     {"role": "user", "content": content}
                 ]
@@ -925,68 +936,7 @@ def format_document_with_ai(request):
             print("Anthropic API response received")
             formatted_content = response.content[0].text
             
-            # Try to parse the response to ensure it's valid JSON
-            try:
-                # First, try to parse as-is
-                parsed_json = json.loads(formatted_content)
-                print("Response is valid JSON")
-                
-                # Validate that it's an array (Slate.js document structure)
-                if not isinstance(parsed_json, list):
-                    print("JSON is not an array, wrapping it")
-                    parsed_json = [parsed_json]
-                
-                # Re-serialize to ensure clean JSON
-                formatted_content = json.dumps(parsed_json)
-            except json.JSONDecodeError as e:
-                print(f"Response is not valid JSON: {e}")
-                
-                # Try to extract JSON from code blocks
-                if "```json" in formatted_content:
-                    print("Extracting JSON from code block")
-                    try:
-                        json_text = formatted_content.split("```json")[1].split("```")[0].strip()
-                        parsed_json = json.loads(json_text)
-                        if not isinstance(parsed_json, list):
-                            parsed_json = [parsed_json]
-                        formatted_content = json.dumps(parsed_json)
-                        print("Successfully extracted and validated JSON from code block")
-                    except (json.JSONDecodeError, IndexError) as extract_error:
-                        print(f"Failed to extract valid JSON from code block: {extract_error}")
-                        # Fall back to a simple paragraph structure
-                        formatted_content = json.dumps([
-                            {
-                                "type": "paragraph",
-                                "children": [{"text": "The AI formatting failed. Please try again or format manually."}]
-                            }
-                        ])
-                elif "```" in formatted_content:
-                    print("Extracting from generic code block")
-                    try:
-                        code_text = formatted_content.split("```")[1].split("```")[0].strip()
-                        parsed_json = json.loads(code_text)
-                        if not isinstance(parsed_json, list):
-                            parsed_json = [parsed_json]
-                        formatted_content = json.dumps(parsed_json)
-                        print("Successfully extracted and validated JSON from generic code block")
-                    except (json.JSONDecodeError, IndexError) as extract_error:
-                        print(f"Failed to extract valid JSON from generic code block: {extract_error}")
-                        # Fall back to a simple paragraph structure
-                        formatted_content = json.dumps([
-                            {
-                                "type": "paragraph",
-                                "children": [{"text": "The AI formatting failed. Please try again or format manually."}]
-                            }
-                        ])
-                else:
-                    print("No code blocks found, using fallback structure")
-                    # If all else fails, create a simple paragraph structure with the original content
-                    formatted_content = json.dumps([
-                        {
-                            "type": "paragraph",
-                            "children": [{"text": "The AI formatting failed. Please try again or format manually."}]
-                        }
-                    ])
+            formatted_content = clean_formatted_slate_json(formatted_content)
             
             return Response({'formatted_content': formatted_content})
         except Exception as e:
@@ -999,6 +949,68 @@ def format_document_with_ai(request):
         return Response({'error': 'No API key configured for the selected AI service'}, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def format_document_with_ai_stream(request):
+    """
+    Format document content using AI, streaming the output as server-sent
+    events. The final 'done' event carries the validated Slate.js JSON.
+    """
+    content = request.data.get('content')
+    if not content:
+        return Response({'error': 'No content provided'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if not settings.OPENAI_API_KEY:
+        return Response(
+            {"detail": "OpenAI API key is not configured in the server settings."},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+    
+    if not isinstance(content, str):
+        content = json.dumps(content)
+    
+    response = StreamingHttpResponse(stream_document_formatting(content), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+
+def stream_document_formatting(content):
+    """
+    Yield 'token' events as the formatted document arrives, then 'done' with
+    the cleaned result or 'error'. Closing the generator closes the upstream
+    OpenAI stream.
+    """
+    chunks = []
+    stream = None
+    try:
+        client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
+        stream = client.chat.completions.create(
+            model=get_default_model_settings()['model'],
+            messages=[
+                {"role": "system", "content": SLATE_FORMAT_SYSTEM_PROMPT},
+                {"role": "user", "content": content}
+            ],
+            stream=True
+        )
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if text:
+                chunks.append(text)
+                yield sse_event('token', {'text': text})
+    except Exception as e:
+        print(f"OpenAI API error: {str(e)}")
+        yield sse_event('error', {'status_code': status.HTTP_500_INTERNAL_SERVER_ERROR, 'error': str(e)})
+        return
+    finally:
+        if stream is not None:
+            stream.close()
+    
+    yield sse_event('done', {'formatted_content': clean_formatted_slate_json(''.join(chunks))})
+
+
 class CommentViewSet(viewsets.ModelViewSet):
     """ViewSet for viewing and editing Comment instances."""
     
@@ -1052,10 +1064,11 @@ class StyleConstraintViewSet(viewsets.ModelViewSet):
         user = self.request.user
         
         # Get organization-specific and global style constraints
-        return StyleConstraint.objects.filter(
+        queryset = StyleConstraint.objects.filter(
             Q(organization=user.organization) | Q(organization__isnull=True),
             is_active=True
         ).order_by('-created_at')
+        return StyleConstraintSerializer.setup_eager_loading(queryset)
     
     def perform_create(self, serializer):
         """Create a new style constraint."""
@@ -1069,6 +1082,5 @@ class StyleConstraintViewSet(viewsets.ModelViewSet):
         # Get the reference documents
         reference_docs = style_constraint.reference_documents.all()
         
-        # Serialize the documents
-        serializer = TextDocumentListSerializer(reference_docs, many=True)
-        return Response(serializer.data)
+        # Serialize one page of the documents
+        return paginate_documents(request, reference_docs, TextDocumentListSerializer)
@@ -5,7 +5,6 @@ This is a standalone script that can be run directly without using Django's mana
 
 import os
 import django
-import json
 
 # Set up Django environment
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'textvault.settings')
@@ -13,43 +12,8 @@ django.setup()
 
 # Import models after Django setup
 from documents.models import TextDocument
+from documents.content import extract_plain_text
 
-def extract_plain_text(content):
-    """
-    Extract plain text from Slate.js JSON content.
-    This is a more robust version that handles different Slate.js structures.
-    """
-    if not content:
-        return ""
-        
-    text = []
-    
-    def extract_text_from_node(node):
-        if isinstance(node, dict):
-            # If it's a leaf node with text
-            if 'text' in node:
-                return node['text']
-            
-            # If it's an element with children
-            if 'children' in node:
-                return ' '.join(extract_text_from_node(child) for child in node['children'])
-            
-            return ''
-        
-        # If it's a list of nodes
-        elif isinstance(node, list):
-            return ' '.join(extract_text_from_node(child) for child in node)
-        
-        return ''
-    
-    # Handle both array and object formats
-    if isinstance(content, list):
-        for node in content:
-            text.append(extract_text_from_node(node))
-    elif isinstance(content, dict):
-        text.append(extract_text_from_node(content))
-    
-    return ' '.join(text).strip()
 
 def main():
     # Get all documents
@@ -103,6 +103,9 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Saved per-organization document similarity indexes (memory-mapped by every process)
+SIMILARITY_INDEX_DIR = os.getenv('SIMILARITY_INDEX_DIR', os.path.join(BASE_DIR, 'similarity_index'))
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -99,6 +99,21 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
+# PDF renders run on their own queue so a small worker pool bounds them:
+# celery -A textvault worker -Q pdf --concurrency=2
+CELERY_TASK_ROUTES = {
+    'documents.tasks.run_pdf_render_job': {'queue': 'pdf'},
+}
+
+# Cache settings - use Redis when configured so the web process and Celery workers share it
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+
 # Email settings - using Brevo for all environments
 EMAIL_BACKEND = os.getenv('EMAIL_BACKEND')
 EMAIL_HOST = os.getenv('EMAIL_HOST')
@@ -147,6 +147,30 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
+# PDF renders run on their own queue so a small worker pool bounds them:
+# celery -A textvault worker -Q pdf --concurrency=2
+CELERY_TASK_ROUTES = {
+    'documents.tasks.run_pdf_render_job': {'queue': 'pdf'},
+}
+
+# Cache settings - shared across web and Celery workers (AI config version stamps etc.)
+if IS_TESTING:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    # A per-process cache would keep AI config and category tree invalidations from reaching other processes
+    if not os.getenv('REDIS_URL'):
+        raise ValueError("REDIS_URL is not set for production environment")
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+
 # Email settings
 if IS_TESTING:
     # Use console backend for testing
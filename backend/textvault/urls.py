@@ -14,7 +14,7 @@ from rest_framework_simplejwt.views import (
     TokenVerifyView,
 )
 from django.views.decorators.csrf import csrf_exempt
-from documents.ai_views import generate_document_with_ai
+from documents.ai_views import generate_document_with_ai, generate_document_with_ai_stream, submit_generation_job
 from subscriptions import views as subscription_views
 from .webhook_handler import root_webhook_handler
 
@@ -45,6 +45,8 @@ urlpatterns = [
     
     # Direct AI document generation endpoint
     path('api/v1/documents/generate-with-ai', csrf_exempt(generate_document_with_ai), name='generate-document-with-ai'),
+    path('api/v1/documents/generate-with-ai/stream', csrf_exempt(generate_document_with_ai_stream), name='generate-document-with-ai-stream'),
+    path('api/v1/documents/generate-with-ai/jobs', csrf_exempt(submit_generation_job), name='submit-generation-job'),
     
     # API endpoints
     path('api/v1/', include('api.urls')),